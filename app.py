@@ -6,35 +6,55 @@ Gemini 图片生成器 - Flask 后端服务
 
 import os
 import json
+import time
 import uuid
 import base64
-from datetime import datetime
-from io import BytesIO
+import math
+import re
+import gzip
+import hashlib
+import functools
+import multiprocessing
+import heapq
+import random
+import shutil
+import tarfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
 from pathlib import Path
 
-from flask import Flask, render_template, request, jsonify, Response, send_from_directory
+from flask import Flask, render_template, request, jsonify, Response, send_from_directory, g, redirect
 from dotenv import load_dotenv
 
+from rendition_worker import render_rendition
+
 # 加载环境变量
 load_dotenv()
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB 上传限制
+# 调试模式（自动重载、页面引用未哈希的静态文件），只在开发时通过 FLASK_DEBUG=1 开启
+DEBUG_MODE = os.getenv("FLASK_DEBUG", "").strip().lower() in ("1", "true", "yes")
 
 # 数据目录配置
 BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.getenv("DATA_DIR") or BASE_DIR / "data")
 UPLOADS_DIR = DATA_DIR / "uploads"
 GENERATED_DIR = DATA_DIR / "generated"
-CONVERSATIONS_FILE = DATA_DIR / "conversations.json"
-
-# 确保目录存在
-for dir_path in [DATA_DIR, UPLOADS_DIR, GENERATED_DIR]:
-    dir_path.mkdir(parents=True, exist_ok=True)
-
-# 初始化对话存储
-if not CONVERSATIONS_FILE.exists():
-    CONVERSATIONS_FILE.write_text("[]", encoding="utf-8")
+PARTIAL_UPLOADS_DIR = DATA_DIR / "partial_uploads"  # 分片上传的临时文件
+SPILL_DIR = DATA_DIR / "spill"  # 生成过程中大缓冲区的临时落盘目录
+DETAILS_DIR = DATA_DIR / "details"  # 消息大字段（思考过程等）的外置存储
+CONVERSATIONS_DIR = DATA_DIR / "conversations"  # 每个对话一个文件（default 用户）
+TENANTS_DIR = DATA_DIR / "tenants"  # 其他用户的数据目录
+IMPORTS_DIR = DATA_DIR / "imports"  # 导入中的归档、进度和暂存文件
+LEGACY_CONVERSATIONS_FILE = DATA_DIR / "conversations.json"  # 旧版单文件存储，启动时自动迁移
+LAYOUT_FILE = DATA_DIR / "layout.json"  # 记录资源文件的存储布局版本
+ASSET_INDEX_FILE = DATA_DIR / "assets.db"  # 资源元数据索引
+SEARCH_INDEX_FILE = DATA_DIR / "search.db"  # 对话全文索引
+USAGE_DB_FILE = DATA_DIR / "usage.db"  # 模型调用用量记录
 
 # Vertex AI 客户端 (延迟初始化)
 _client = None
@@ -44,6 +64,89 @@ VALID_ASPECT_RATIOS = ["1:1", "3:2", "2:3", "3:4", "4:3", "4:5", "5:4", "9:16",
 # 有效的图片尺寸选项
 VALID_IMAGE_SIZES = ["1K", "2K", "4K"]
 
+# 分片上传配置
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024))  # 默认分片 4MB
+UPLOAD_MAX_CHUNK_SIZE = 16 * 1024 * 1024  # 客户端可请求的最大分片
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", 500 * 1024 * 1024))  # 分片上传的文件上限
+UPLOAD_SESSION_TTL = 24 * 3600  # 未完成的上传会话保留 24 小时
+STREAM_BLOCK_SIZE = 64 * 1024  # 读写磁盘的块大小
+IMPORT_MAX_ARCHIVE_SIZE = int(os.getenv("IMPORT_MAX_ARCHIVE_SIZE", 20 * 1024 * 1024 * 1024))  # 导入归档（经分片上传）的上限
+
+# 上传入库处理配置
+MODEL_INPUT_MAX_EDGE = int(os.getenv("MODEL_INPUT_MAX_EDGE", 2048))  # 发送给模型的参考图最长边
+INGEST_MAX_PIXELS = int(os.getenv("INGEST_MAX_PIXELS", 100_000_000))  # 超过该像素数视为解压炸弹
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+# 模型可直接接收的图片格式，其他格式（GIF、BMP、TIFF 等）统一转换
+MODEL_READY_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# PDF 按页发送：渲染分辨率（不超过 MODEL_INPUT_MAX_EDGE）、单个文件一次最多选择的页数
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", 150))
+PDF_MAX_SELECTED_PAGES = int(os.getenv("PDF_MAX_SELECTED_PAGES", 20))
+
+# 派生版本（rendition）配置：预设文件（不存在时不生成）、处理进程数
+RENDITION_PRESETS_FILE = Path(os.getenv("RENDITION_PRESETS_FILE", BASE_DIR / "renditions.json"))
+RENDITION_WORKERS = int(os.getenv("RENDITION_WORKERS", 2))
+
+# 局部区域编辑配置
+REGION_CONTEXT_RATIO = 0.15  # 框选区域四周额外携带的上下文比例
+REGION_MIN_CONTEXT = 32  # 上下文最少像素
+REGION_SIZE_STEPS = (("1K", 1024), ("2K", 2048), ("4K", 4096))  # 按裁剪尺寸选择输出分辨率
+
+# 旧版平铺文件迁移到分片目录时每秒最多移动的文件数（0 不限速）
+ASSET_MIGRATION_RATE = float(os.getenv("ASSET_MIGRATION_RATE", 200))
+
+# 思考过程图片保留策略：full 原图 / preview 低分辨率预览 / ephemeral 只在流中内联显示 / drop 丢弃
+THOUGHT_IMAGE_POLICIES = ("full", "preview", "ephemeral", "drop")
+THOUGHT_IMAGE_POLICY = os.getenv("THOUGHT_IMAGE_POLICY", "full")
+THOUGHT_PREVIEW_EDGE = int(os.getenv("THOUGHT_PREVIEW_EDGE", 512))  # 预览图最长边
+
+# 消息大字段外置：思考过程等字段合计超过该字节数时移到外置存储
+OUTLINE_MIN_BYTES = int(os.getenv("MESSAGE_OUTLINE_MIN_BYTES", 512))
+
+# 用量与预算：每个用户每天的 token 预算（0 不限），可按用户单独设置；单价（美元/百万 token）用于估算费用
+USAGE_DAILY_TOKEN_BUDGET = int(os.getenv("USAGE_DAILY_TOKEN_BUDGET", 0))
+USAGE_PRICE_INPUT_PER_M = float(os.getenv("USAGE_PRICE_INPUT_PER_M", 0))
+USAGE_PRICE_OUTPUT_PER_M = float(os.getenv("USAGE_PRICE_OUTPUT_PER_M", 0))
+
+# 多用户限制：每个用户同时进行的生成数、占用的存储空间(MB)，0 表示不限
+TENANT_MAX_CONCURRENT_GENERATIONS = int(os.getenv("TENANT_MAX_CONCURRENT_GENERATIONS", 0))
+TENANT_STORAGE_QUOTA_BYTES = int(float(os.getenv("TENANT_STORAGE_QUOTA_MB", 0)) * 1024 * 1024)
+
+# 性能诊断：管理员用户（逗号分隔，需配置 USER_TOKENS 才生效）、未配置 USER_TOKENS 时是否把 default 用户视为管理员、
+# 保留的慢请求数、记录的最短耗时(毫秒)、随机采样比例(0~1)
+ADMIN_USERS = {u.strip() for u in os.getenv("ADMIN_USERS", "").split(",") if u.strip()}
+ADMIN_LOCAL = os.getenv("ADMIN_LOCAL", "").strip().lower() in ("1", "true", "yes")
+FLIGHT_RECORDER_SIZE = int(os.getenv("FLIGHT_RECORDER_SIZE", 50))
+FLIGHT_RECORDER_MIN_MS = float(os.getenv("FLIGHT_RECORDER_MIN_MS", 200))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+
+# 资源回收与配额配置
+ASSET_GC_INTERVAL = float(os.getenv("ASSET_GC_INTERVAL_HOURS", 6)) * 3600  # 后台回收间隔，0 表示关闭
+ASSET_GC_GRACE = float(os.getenv("ASSET_GC_GRACE_HOURS", 48)) * 3600  # 新文件在此期限内不回收（可能尚未写入对话）
+ASSET_GC_RATE = float(os.getenv("ASSET_GC_RATE", 50))  # 每秒最多删除的文件数
+ASSET_QUOTA_BYTES = int(float(os.getenv("ASSET_QUOTA_MB", 0)) * 1024 * 1024)  # 全局配额，0 表示不限
+CONVERSATION_QUOTA_BYTES = int(float(os.getenv("CONVERSATION_QUOTA_MB", 0)) * 1024 * 1024)  # 单个对话配额
+
+# 内存预算配置
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_MB", 1024)) * 1024 * 1024  # 并发生成可预留的内存总量
+MEMORY_QUEUE_TIMEOUT = float(os.getenv("MEMORY_QUEUE_TIMEOUT", 120))  # 内存不足时最长排队秒数
+SPILL_THRESHOLD = int(os.getenv("SPILL_THRESHOLD", 4 * 1024 * 1024))  # 超过该大小的图片缓冲区先落盘
+SSE_INLINE_IMAGE_MAX = 1024 * 1024  # 超过该大小的图片不在 SSE 中内联 base64，前端按路径加载
+IMAGE_SIZE_PIXELS = {"1K": 1024 * 1024, "2K": 2048 * 2048, "4K": 4096 * 4096}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# 生成调度配置
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", 4))  # 同时进行的模型调用数，0 表示不限
+SCHEDULER_INTERACTIVE_RESERVED = int(os.getenv("SCHEDULER_INTERACTIVE_RESERVED", 1))  # 只留给交互请求的名额
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", 600))  # 最长排队秒数
+SCHEDULER_DEFAULT_PRIORITY = os.getenv("SCHEDULER_DEFAULT_PRIORITY", "background")  # 未指定优先级的请求
+# 网页端以外也允许使用 interactive 优先级的用户（逗号分隔），其他脚本请求 interactive 时按 background 处理
+SCHEDULER_INTERACTIVE_USERS = {u.strip() for u in os.getenv("SCHEDULER_INTERACTIVE_USERS", "").split(",") if u.strip()}
+
+# 图片解码/缩放的工作线程池（Pillow 在解码和缩放时会释放 GIL），限制并发解码的内存与 CPU；由 init_app 创建
+_ingest_pool = None
+# 异步写盘线程池（思考图片等不阻塞 SSE 流的写入）；由 init_app 创建
+_writer_pool = None
+
 
 def get_vertex_client():
     """获取 Vertex AI 客户端 (延迟初始化)"""
@@ -81,209 +184,4570 @@ def get_vertex_client():
     return _client
 
 
-def load_conversations():
-    """加载对话历史"""
+# ============ 多用户 ============
+# 用户由访问令牌（配置 USER_TOKENS 时必需：Authorization: Bearer <令牌>，或通过 /?token=<令牌> 写入的 Cookie）
+# 或 X-User 请求头（未配置令牌时）区分，未指定时为 default。
+# 每个用户的对话存放在各自目录（default 为 data/conversations，其他用户为 data/tenants/<用户>/conversations），
+# 读-改-写按用户加锁，一个用户的大量写入不会阻塞其他用户；上传和生成的文件在元数据索引中记录所属用户，
+# 只能访问自己的文件。可限制每个用户同时进行的生成数和占用的存储空间。
+
+DEFAULT_USER = "default"
+USER_TOKEN_COOKIE = "nb_token"
+_USER_NAME = re.compile(r"[^A-Za-z0-9_-]")
+
+_store_locks = {}  # 用户 -> 对话存储锁
+_store_locks_guard = threading.Lock()
+_active_generations = {}  # 用户 -> 进行中的生成数
+_active_generations_lock = threading.Lock()
+
+
+def parse_user_map(value: str) -> dict:
+    """解析 "用户=值,用户=值" 格式的配置"""
+    result = {}
+    for item in value.split(","):
+        name, _, setting = item.partition("=")
+        if name.strip() and setting.strip():
+            result[name.strip()] = setting.strip()
+    return result
+
+
+USER_TOKENS = {token: user for user, token in parse_user_map(os.getenv("USER_TOKENS", "")).items()}  # 令牌 -> 用户
+
+
+def normalize_user(name: str) -> str:
+    """用户名只保留字母、数字、下划线和连字符（同时用作目录名）"""
+    return _USER_NAME.sub("", name or "")[:64] or DEFAULT_USER
+
+
+def authenticate_user():
+    """按令牌或 X-User 请求头识别用户；配置了令牌但令牌无效时返回 None"""
+    if USER_TOKENS:
+        auth = request.headers.get("Authorization", "")
+        token = auth[len("Bearer "):].strip() if auth.startswith("Bearer ") else request.cookies.get(USER_TOKEN_COOKIE, "")
+        user = USER_TOKENS.get(token)
+        return normalize_user(user) if user else None
+    return normalize_user(request.headers.get("X-User", ""))
+
+
+def request_user() -> str:
+    """当前请求所属的用户（由 authenticate_request 识别）"""
+    return getattr(g, "user", None) or authenticate_user() or DEFAULT_USER
+
+
+def is_admin(user: str) -> bool:
+    """是否为管理员：配置 USER_TOKENS 时只认通过令牌识别的 ADMIN_USERS；
+    未配置时（用户名来自可伪造的 X-User 头）默认没有管理员，单人本地部署可设置 ADMIN_LOCAL=1 让 default 用户成为管理员"""
+    if USER_TOKENS:
+        return user in ADMIN_USERS
+    return ADMIN_LOCAL and user == DEFAULT_USER
+
+
+def tenant_root(user: str) -> Path:
+    """用户的数据目录（default 用户沿用 data/ 下的原有目录）"""
+    return DATA_DIR if user == DEFAULT_USER else TENANTS_DIR / user
+
+
+def conversations_dir(user: str) -> Path:
+    return tenant_root(user) / "conversations"
+
+
+def iter_tenants():
+    """所有有数据目录的用户"""
+    yield DEFAULT_USER
+    for path in sorted(TENANTS_DIR.iterdir()):
+        if path.is_dir():
+            yield path.name
+
+
+def store_lock(user: str):
+    """获取用户的对话存储锁（不同用户之间互不阻塞）"""
+    with _store_locks_guard:
+        lock = _store_locks.get(user)
+        if lock is None:
+            lock = _store_locks[user] = threading.RLock()
+        return lock
+
+
+def tenant_storage_bytes(user: str) -> int:
+    """用户上传和生成的文件占用的字节数（来自元数据索引）"""
+    with _asset_db_lock:
+        row = get_asset_db().execute("SELECT COALESCE(SUM(bytes), 0) FROM assets WHERE user = ?", (user,)).fetchone()
+    return row[0]
+
+
+def check_tenant_storage(user: str):
+    """写入新文件前检查用户存储配额，超出时返回错误信息"""
+    if TENANT_STORAGE_QUOTA_BYTES and tenant_storage_bytes(user) >= TENANT_STORAGE_QUOTA_BYTES:
+        return f"存储空间已用完（上限 {TENANT_STORAGE_QUOTA_BYTES // (1024 * 1024)}MB），请删除不需要的对话后再试"
+    return None
+
+
+def with_tenant_slot(user: str, stream):
+    """占用用户的一个生成名额后执行 SSE 生成流，超出同时生成数时直接返回错误事件"""
+    with _active_generations_lock:
+        active = _active_generations.get(user, 0)
+        if TENANT_MAX_CONCURRENT_GENERATIONS and active >= TENANT_MAX_CONCURRENT_GENERATIONS:
+            admitted = False
+        else:
+            admitted = True
+            _active_generations[user] = active + 1
+    if not admitted:
+        yield f"data: {json.dumps({'type': 'error', 'message': f'同时进行的生成已达上限（{TENANT_MAX_CONCURRENT_GENERATIONS}），请等待当前生成完成'})}\n\n"
+        return
     try:
-        return json.loads(CONVERSATIONS_FILE.read_text(encoding="utf-8"))
-    except:
-        return []
+        yield from stream
+    finally:
+        with _active_generations_lock:
+            _active_generations[user] -= 1
+            if not _active_generations[user]:
+                del _active_generations[user]
 
 
-def save_conversations(conversations):
-    """保存对话历史"""
-    CONVERSATIONS_FILE.write_text(
-        json.dumps(conversations, ensure_ascii=False, indent=2),
-        encoding="utf-8"
-    )
+def reject_generation(user: str):
+    """生成开始前检查用户的 token 预算和存储配额，超出时返回错误响应"""
+    error = check_usage_budget(user)
+    if error:
+        return jsonify({"error": error}), 429
+    error = check_tenant_storage(user)
+    if error:
+        return jsonify({"error": error}), 507
+    return None
 
 
-def save_image_from_bytes(image_bytes: bytes, prefix: str = "") -> tuple:
-    """保存图片并返回文件名和base64"""
-    from PIL import Image
+def active_generation_count(user: str) -> int:
+    with _active_generations_lock:
+        return _active_generations.get(user, 0)
+
+
+# ============ 性能诊断 ============
+# 每个请求记录一条时间线：各阶段耗时（模型调用、保存图片、构建上下文、写对话、索引等）、
+# 请求/响应大小和模型分片的到达时间。耗时最长的 FLIGHT_RECORDER_SIZE 个请求保留在内存中，
+# 管理员可通过 /api/debug/slow-requests 查看。
+# 管理员请求带 X-Profile: 1 请求头（或 ?profile=1）时用 cProfile 采样该请求，
+# 也可用 PROFILE_SAMPLE_RATE 按比例随机采样；同一时间只采样一个请求。
+# 时间线保存在线程局部变量中（请求及其 SSE 流在同一线程中执行），未在请求中调用时各记录函数不做任何事。
+
+TRACE_MAX_EVENTS = 500  # 单个请求最多记录的事件数
+UNTRACED_ENDPOINTS = ("static", "service_worker", "subscribe_conversation", "subscribe_renditions")  # 静态文件和长连接订阅不记录
+PROFILE_TOP_FUNCTIONS = 40  # 采样报告中列出的函数数
+
+_trace_local = threading.local()
+_flight_recorder = []  # 最小堆 [(耗时, 序号, 时间线)]，只保留最慢的若干个
+_flight_recorder_lock = threading.Lock()
+_recent_profiles = deque(maxlen=20)
+_profile_lock = threading.Lock()  # 同一时间只采样一个请求
+_trace_seq = 0
+
+
+class RequestTrace:
+    """单个请求的时间线"""
     
-    img = Image.open(BytesIO(image_bytes))
-    filename = f"{prefix}{uuid.uuid4()}.png"
-    output_path = GENERATED_DIR / filename
-    img.save(output_path)
+    def __init__(self, method: str, path: str, user: str, request_bytes: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.user = user
+        self.request_bytes = request_bytes
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration_ms = 0
+        self.stages = []
+        self.totals = {}  # 阶段名 -> 累计毫秒
+        self.events = []
+        self.dropped_events = 0
+        self.first_byte_ms = None
+        self.response_bytes = 0
+        self.status = None
+        self.profiler = None
+        self.profile = None
     
-    img_base64 = base64.b64encode(image_bytes).decode("utf-8")
-    return filename, img_base64
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+    
+    def add_time(self, name: str, ms: float):
+        self.totals[name] = self.totals.get(name, 0) + ms
+    
+    def add_stage(self, name: str, start_ms: float, ms: float, info: dict):
+        self.add_time(name, ms)
+        if len(self.stages) < TRACE_MAX_EVENTS:
+            self.stages.append({"name": name, "start_ms": round(start_ms, 1), "ms": round(ms, 1), **info})
+    
+    def add_event(self, name: str, info: dict):
+        if len(self.events) < TRACE_MAX_EVENTS:
+            self.events.append({"name": name, "at_ms": round(self.elapsed_ms(), 1), **info})
+        else:
+            self.dropped_events += 1
+    
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "user": self.user,
+            "status": self.status,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "duration_ms": round(self.duration_ms, 1),
+            "first_byte_ms": self.first_byte_ms,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "stage_totals_ms": {k: round(v, 1) for k, v in sorted(self.totals.items(), key=lambda kv: -kv[1])},
+            "profiled": self.profile is not None
+        }
+    
+    def detail(self) -> dict:
+        return {**self.summary(), "stages": self.stages, "events": self.events,
+                "dropped_events": self.dropped_events, "profile": self.profile}
 
 
-def parse_grounding_metadata(grounding_metadata) -> dict:
-    """解析 grounding 元数据"""
-    result = {
-        "sources": [],
-        "search_queries": [],
+def current_trace():
+    return getattr(_trace_local, "trace", None)
+
+
+class trace_stage:
+    """记录一个阶段的耗时（with trace_stage("save_image", bytes=...)），不在请求中时不做任何事"""
+    
+    def __init__(self, name: str, **info):
+        self.name = name
+        self.info = info
+        self.trace = current_trace()
+    
+    def __enter__(self):
+        if self.trace:
+            self.start_ms = self.trace.elapsed_ms()
+        return self
+    
+    def __exit__(self, *exc):
+        if self.trace:
+            self.trace.add_stage(self.name, self.start_ms, self.trace.elapsed_ms() - self.start_ms, self.info)
+        return False
+
+
+def traced(name: str):
+    """装饰器：把函数的每次调用记为一个阶段"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_event(name: str, **info):
+    """记录一个时间点事件（如模型分片到达）"""
+    trace = current_trace()
+    if trace:
+        trace.add_event(name, info)
+
+
+def traced_model_stream(response_stream):
+    """逐个产出模型分片，记录等待每个分片的时间（计入 vertex 阶段）和分片内容大小"""
+    trace = current_trace()
+    if not trace:
+        yield from response_stream
+        return
+    iterator = iter(response_stream)
+    index = 0
+    while True:
+        started = time.perf_counter()
+        chunk = next(iterator, None)
+        wait_ms = (time.perf_counter() - started) * 1000
+        trace.add_time("vertex", wait_ms)
+        if chunk is None:
+            return
+        parts = (chunk.candidates[0].content.parts or []) if chunk.candidates and chunk.candidates[0].content else []
+        trace.add_event("chunk", {
+            "index": index,
+            "wait_ms": round(wait_ms, 1),
+            "kinds": [("thought_" if getattr(p, "thought", False) else "") + ("image" if p.inline_data else "text") for p in parts],
+            "bytes": sum(len(p.inline_data.data) if p.inline_data else len(p.text or "") for p in parts)
+        })
+        index += 1
+        yield chunk
+
+
+def should_profile(user: str) -> bool:
+    if request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1":
+        return is_admin(user)
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_trace(user: str):
+    """请求开始时创建时间线，需要时开始采样"""
+    trace = RequestTrace(request.method, request.path, user, request.content_length or 0)
+    _trace_local.trace = trace
+    if should_profile(user) and _profile_lock.acquire(blocking=False):
+        import cProfile
+        
+        trace.profiler = cProfile.Profile()
+        trace.profiler.enable()
+    return trace
+
+
+def finish_trace(trace: RequestTrace):
+    """请求结束（响应体发送完毕）时停止采样并记入慢请求记录"""
+    if getattr(_trace_local, "trace", None) is trace:
+        _trace_local.trace = None
+    trace.duration_ms = trace.elapsed_ms()
+    if trace.profiler:
+        import pstats
+        
+        trace.profiler.disable()
+        _profile_lock.release()
+        out = StringIO()
+        pstats.Stats(trace.profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        trace.profile = out.getvalue()
+        trace.profiler = None
+        _recent_profiles.append(trace)
+    record_flight(trace)
+
+
+def record_flight(trace: RequestTrace):
+    """记入慢请求记录（只保留耗时最长的 FLIGHT_RECORDER_SIZE 个）"""
+    global _trace_seq
+    if trace.duration_ms < FLIGHT_RECORDER_MIN_MS:
+        return
+    with _flight_recorder_lock:
+        _trace_seq += 1
+        entry = (trace.duration_ms, _trace_seq, trace)
+        if len(_flight_recorder) < FLIGHT_RECORDER_SIZE:
+            heapq.heappush(_flight_recorder, entry)
+        elif FLIGHT_RECORDER_SIZE and trace.duration_ms > _flight_recorder[0][0]:
+            heapq.heapreplace(_flight_recorder, entry)
+
+
+def traced_body(trace: RequestTrace, body):
+    """包装流式响应体，记录首字节时间和发送的字节数"""
+    for chunk in body:
+        if trace.first_byte_ms is None:
+            trace.first_byte_ms = round(trace.elapsed_ms(), 1)
+        trace.response_bytes += len(chunk)
+        yield chunk
+
+
+def slow_requests() -> list:
+    """慢请求记录，按耗时倒序"""
+    with _flight_recorder_lock:
+        entries = sorted(_flight_recorder, reverse=True)
+    return [trace for _, _, trace in entries]
+
+
+def find_trace(trace_id: str):
+    with _flight_recorder_lock:
+        traces = [trace for _, _, trace in _flight_recorder] + list(_recent_profiles)
+    return next((t for t in traces if t.id == trace_id), None)
+
+
+# ============ 对话存储（消息树） ============
+# 每个对话一个文件 <用户数据目录>/conversations/<ID>.json，消息以节点树保存：
+#   {"id", "title", "owner", "created_at", "updated_at", "head": 当前分支末端节点 ID, "nodes": {节点 ID: 消息 + "parent"}}
+# 重试、改写提示词时新消息挂在原消息的父节点下成为兄弟分支，前面的公共部分共享，不复制也不删除旧结果。
+# 接口返回的 messages 是从根到 head 的当前分支，分支点上的消息附带 branch 信息用于切换。
+
+def conversation_path(conv_id: str, user: str = DEFAULT_USER) -> Path:
+    return conversations_dir(user) / f"{Path(conv_id).name}.json"
+
+
+def read_conversation(conv_id: str, user: str = DEFAULT_USER):
+    """读取用户的对话（树结构），不存在返回 None"""
+    try:
+        conv = json.loads(conversation_path(conv_id, user).read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+    conv["owner"] = user
+    return conv
+
+
+@traced("write_conversation")
+def write_conversation(conv: dict):
+    """原子写入对话文件（写到 owner 的目录）"""
+    path = conversation_path(conv["id"], conv.get("owner", DEFAULT_USER))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp_path.write_text(json.dumps(conv, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def delete_conversation_file(conv_id: str, user: str = DEFAULT_USER):
+    conversation_path(conv_id, user).unlink(missing_ok=True)
+
+
+def conversation_owner(conv_id: str):
+    """对话所属的用户，不存在返回 None"""
+    for user in iter_tenants():
+        if conversation_path(conv_id, user).exists():
+            return user
+    return None
+
+
+def iter_stored_conversations(user: str = None):
+    """逐个读取用户的对话（树结构），user 为 None 时遍历所有用户；一次只在内存中保留一个"""
+    for owner in ([user] if user else iter_tenants()):
+        for path in conversations_dir(owner).glob("*.json"):
+            conv = read_conversation(path.stem, owner)
+            if conv:
+                yield conv
+
+
+def conversation_nodes(conv: dict) -> list:
+    """对话中的所有消息节点（包括非当前分支）"""
+    return list(conv.get("nodes", {}).values())
+
+
+def active_path(conv: dict) -> list:
+    """从根到 head 的当前分支"""
+    nodes = conv.get("nodes", {})
+    path = []
+    node_id = conv.get("head")
+    while node_id and node_id in nodes:
+        path.append(nodes[node_id])
+        node_id = nodes[node_id].get("parent")
+    path.reverse()
+    return path
+
+
+def node_children(conv: dict) -> dict:
+    """父节点 ID -> 子节点 ID 列表（按创建顺序），根节点的父为 None"""
+    children = {}
+    for node_id, node in conv.get("nodes", {}).items():
+        children.setdefault(node.get("parent"), []).append(node_id)
+    return children
+
+
+def node_depths(conv: dict) -> dict:
+    """节点 ID -> 距根节点的深度（当前分支上即消息序号）"""
+    depths = {}
+    children = node_children(conv)
+    stack = [(node_id, 0) for node_id in children.get(None, [])]
+    while stack:
+        node_id, depth = stack.pop()
+        depths[node_id] = depth
+        stack.extend((child, depth + 1) for child in children.get(node_id, []))
+    return depths
+
+
+def conversation_view(conv: dict) -> dict:
+    """接口返回的对话：当前分支的消息列表，分支点附带兄弟节点信息"""
+    children = node_children(conv)
+    messages = []
+    for node in active_path(conv):
+        msg = {k: v for k, v in node.items() if k != "parent"}
+        siblings = children.get(node.get("parent"), [])
+        if len(siblings) > 1:
+            msg["branch"] = {"index": siblings.index(node["id"]), "count": len(siblings), "siblings": siblings}
+        messages.append(msg)
+    return {
+        "id": conv["id"],
+        "title": conv.get("title", "新对话"),
+        "messages": messages,
+        "head": conv.get("head"),
+        "seq": conv.get("seq", 0),
+        "created_at": conv.get("created_at"),
+        "updated_at": conv.get("updated_at")
+    }
+
+
+def store_message_node(conv: dict, msg: dict, parent_id) -> dict:
+    """写入（或覆盖同 ID 的）消息节点"""
+    node = {k: v for k, v in msg.items() if k not in ("branch", "parent")}
+    node.setdefault("id", uuid.uuid4().hex)
+    node["parent"] = parent_id
+    conv.setdefault("nodes", {})[node["id"]] = node
+    return node
+
+
+def append_messages(conv: dict, parent_id, messages: list) -> list:
+    """在 parent_id 下追加一串消息并设为当前分支，返回新节点；parent_id 已有子节点时形成兄弟分支"""
+    added = []
+    for msg in messages:
+        node = store_message_node(conv, msg, parent_id)
+        parent_id = node["id"]
+        added.append(node)
+    if added:
+        conv["head"] = added[-1]["id"]
+    return added
+
+
+def replace_active_path(conv: dict, messages: list) -> list:
+    """按完整消息列表更新当前分支（兼容整表保存），不在列表中的其他分支保留"""
+    nodes = []
+    parent_id = None
+    for msg in messages:
+        node = store_message_node(conv, msg, parent_id)
+        parent_id = node["id"]
+        nodes.append(node)
+    conv["head"] = parent_id
+    return nodes
+
+
+def remove_message_node(conv: dict, node_id: str):
+    """删除单个消息节点，其子节点改挂到它的父节点下"""
+    nodes = conv.get("nodes", {})
+    node = nodes.pop(node_id, None)
+    if not node:
+        return None
+    for child in nodes.values():
+        if child.get("parent") == node_id:
+            child["parent"] = node.get("parent")
+    if conv.get("head") == node_id:
+        conv["head"] = node.get("parent")
+    return node
+
+
+def latest_leaf(conv: dict, node_id: str) -> str:
+    """从节点向下沿最新创建的子节点走到分支末端"""
+    children = node_children(conv)
+    while children.get(node_id):
+        node_id = children[node_id][-1]
+    return node_id
+
+
+def branch_history(conv_id: str, parent_id: str, user: str = DEFAULT_USER, limit: int = 6) -> list:
+    """生成时的上下文：从 parent_id 沿父节点向上取最近 limit 条，只遍历当前分支"""
+    conv = read_conversation(conv_id, user)
+    if not conv or parent_id not in conv.get("nodes", {}):
+        return []
+    nodes = conv["nodes"]
+    history = []
+    node_id = parent_id
+    while node_id and node_id in nodes and len(history) < limit:
+        node = nodes[node_id]
+        history.append({"role": node.get("role"), "text": node.get("text") or "", "image": node.get("image")})
+        node_id = node.get("parent")
+    history.reverse()
+    return history
+
+
+def load_conversations(user: str = DEFAULT_USER):
+    """加载用户的对话列表（当前分支视图），按创建时间倒序"""
+    conversations = [conversation_view(c) for c in iter_stored_conversations(user)]
+    conversations.sort(key=lambda c: c.get("created_at") or "", reverse=True)
+    return conversations
+
+
+def migrate_legacy_conversations():
+    """把旧版单文件 conversations.json 拆成每个对话一个文件的消息树"""
+    if not LEGACY_CONVERSATIONS_FILE.exists():
+        return
+    try:
+        legacy = json.loads(LEGACY_CONVERSATIONS_FILE.read_text(encoding="utf-8"))
+    except ValueError:
+        legacy = []
+    for conv in legacy:
+        tree = {k: v for k, v in conv.items() if k != "messages"}
+        replace_active_path(tree, conv.get("messages", []))
+        write_conversation(tree)
+    LEGACY_CONVERSATIONS_FILE.rename(LEGACY_CONVERSATIONS_FILE.with_name("conversations.json.migrated"))
+    if legacy:
+        print(f"📦 已把 {len(legacy)} 个对话迁移为消息树存储")
+
+
+# ============ 对话变更日志 ============
+# 每次修改对话时 seq 加 1（随对话文件保存），并在内存中记录当前分支相对修改前的差异：
+#   {"seq", "from": 第一条变化的消息下标, "messages": 从该下标起的新消息, "length": 新的消息数, "title", "updated_at"}
+# 客户端按顺序应用差异即可得到最新的消息列表。日志只保留最近 CHANGE_LOG_SIZE 条且不跨进程，
+# 客户端的 seq 早于日志起点（或服务重启）时返回完整的当前分支。
+
+CHANGE_LOG_SIZE = 200
+CHANGE_STREAM_HEARTBEAT = 15  # SSE 订阅的心跳间隔（秒）
+
+_change_logs = {}  # 对话 ID -> deque[变更]
+_change_cond = threading.Condition()
+
+
+def message_list_patch(old_messages: list, new_messages: list) -> tuple:
+    """计算消息列表的差异，返回 (第一条不同的下标, 该下标起的新消息)"""
+    start = 0
+    limit = min(len(old_messages), len(new_messages))
+    while start < limit and old_messages[start] == new_messages[start]:
+        start += 1
+    return start, new_messages[start:]
+
+
+def publish_conversation(conv: dict, old_view: dict = None) -> dict:
+    """写入对话并记录变更，返回新的视图；old_view 为修改前的视图（新建时为 None）"""
+    conv["seq"] = conv.get("seq", 0) + 1
+    write_conversation(conv)
+    view = conversation_view(conv)
+    start, messages = message_list_patch(old_view["messages"] if old_view else [], view["messages"])
+    change = {
+        "seq": conv["seq"],
+        "from": start,
+        "messages": messages,
+        "length": len(view["messages"]),
+        "title": view["title"],
+        "updated_at": view["updated_at"]
     }
+    with _change_cond:
+        log = _change_logs.get(conv["id"])
+        if log is None or (log and log[-1].get("deleted")):
+            log = _change_logs[conv["id"]] = deque(maxlen=CHANGE_LOG_SIZE)
+        log.append(change)
+        _change_cond.notify_all()
+    return view
+
+
+def publish_conversation_deleted(conv_id: str, seq: int):
+    with _change_cond:
+        _change_logs[conv_id] = deque([{"seq": seq + 1, "deleted": True}], maxlen=CHANGE_LOG_SIZE)
+        _change_cond.notify_all()
+
+
+def conversation_changes(conv_id: str, since: int, user: str = DEFAULT_USER):
+    """seq 之后的变更；日志不连续时返回完整视图，对话不存在返回 None
+
+    返回 {"seq", "changes": [...]} 或 {"seq", "reset": True, "conversation": 视图} 或 {"seq", "deleted": True}
+    """
+    with _change_cond:
+        log = list(_change_logs.get(conv_id, ()))
+    if log and log[-1].get("deleted"):
+        return {"seq": log[-1]["seq"], "deleted": True}
+    conv = read_conversation(conv_id, user)
+    if not conv:
+        return None
+    seq = conv.get("seq", 0)
+    if since >= seq:
+        return {"seq": seq, "changes": []}
+    changes = [c for c in log if since < c["seq"] <= seq]
+    if changes and changes[0]["seq"] == since + 1 and changes[-1]["seq"] == seq:
+        return {"seq": seq, "changes": changes}
+    return {"seq": seq, "reset": True, "conversation": conversation_view(conv)}
+
+
+def wait_conversation_change(conv_id: str, since: int, timeout: float) -> bool:
+    """等待对话出现 seq 之后的变更，超时返回 False"""
+    def changed():
+        log = _change_logs.get(conv_id)
+        return bool(log) and log[-1]["seq"] > since
+    with _change_cond:
+        return _change_cond.wait_for(changed, timeout)
+
+
+
+# ============ 消息详情外置存储 ============
+# 助手消息的思考过程、思考图片和较大的搜索来源只在展开面板时才需要，却占了对话存储的大部分体积。
+# 保存对话时把这些字段压缩写入 data/details/<对话 ID>/<消息 ID>.json.gz，消息中只保留 details 摘要
+# （字段大小、引用的文件名、内容摘要），前端展开时再通过详情接口加载。
+
+OUTLINE_FIELDS = ("thinking", "thinking_images", "grounding")
+
+
+def details_path(conv_id: str, msg_id: str) -> Path:
+    """消息详情文件路径"""
+    return DETAILS_DIR / Path(conv_id).name / f"{Path(msg_id).name}.json.gz"
+
+
+def read_message_details(conv_id: str, msg_id: str):
+    """读取消息详情，不存在返回 None"""
+    try:
+        with gzip.open(details_path(conv_id, msg_id), "rt", encoding="utf-8") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def write_message_details(conv_id: str, msg_id: str, raw: str) -> int:
+    """压缩写入消息详情，返回写入的字节数"""
+    path = details_path(conv_id, msg_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as fp:
+        fp.write(raw)
+    os.replace(tmp_path, path)
+    return path.stat().st_size
+
+
+def outline_message(conv_id: str, msg: dict) -> bool:
+    """把助手消息的大字段移到外置存储，返回是否有改动
+
+    消息已是摘要且请求中没有带回完整字段时保持不变；带回了完整字段（前端展开过）则合并后重写
+    """
+    if msg.get("role") == "user":
+        return False
+    inline = {f: msg[f] for f in OUTLINE_FIELDS if msg.get(f)}
+    if not inline:
+        return False
+    stub = msg.get("details") or {}
+    if not stub and len(json.dumps(inline, ensure_ascii=False).encode("utf-8")) < OUTLINE_MIN_BYTES:
+        return False  # 内容很少，外置反而多一次请求
     
-    if not grounding_metadata:
-        return result
+    msg_id = msg.setdefault("id", uuid.uuid4().hex)
+    details = (read_message_details(conv_id, msg_id) or {}) if stub else {}
+    details.update(inline)
+    raw = json.dumps(details, ensure_ascii=False, sort_keys=True)
+    digest = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    stored_bytes = stub.get("stored_bytes")
+    if stub.get("digest") != digest or not details_path(conv_id, msg_id).exists():
+        stored_bytes = write_message_details(conv_id, msg_id, raw)
     
-    # 解析搜索查询
-    if grounding_metadata.web_search_queries:
-        result["search_queries"] = list(grounding_metadata.web_search_queries)
+    for field in inline:
+        msg.pop(field)
+    fields = {}
+    if details.get("thinking"):
+        fields["thinking"] = len(details["thinking"])
+    if details.get("thinking_images"):
+        fields["thinking_images"] = len(details["thinking_images"])
+    if details.get("grounding"):
+        fields["grounding"] = len(details["grounding"].get("sources") or [])
+    msg["details"] = {
+        "fields": fields,
+        "bytes": len(raw.encode("utf-8")),
+        "stored_bytes": stored_bytes,
+        "digest": digest,
+        "assets": [img["filename"] for img in details.get("thinking_images") or [] if img.get("filename")]
+    }
+    return True
+
+
+@traced("outline_details")
+def outline_conversation(conv: dict):
+    """外置一个对话中所有助手消息的大字段；写入失败的消息保持内联"""
+    for msg in conversation_nodes(conv):
+        try:
+            outline_message(conv["id"], msg)
+        except OSError as e:
+            print(f"⚠️ 消息详情写入失败: {conv['id']}/{msg.get('id')} ({e})")
+
+
+def expand_message(conv_id: str, msg: dict) -> dict:
+    """返回合并了外置详情的完整消息副本（导出、重建索引等需要完整内容时使用）"""
+    if not msg.get("details") or not msg.get("id"):
+        return msg
+    full = {k: v for k, v in msg.items() if k != "details"}
+    full.update(read_message_details(conv_id, msg["id"]) or {})
+    return full
+
+
+def forget_message_details(conv_id: str, msg: dict):
+    """删除消息时移除其外置详情"""
+    if msg.get("details") and msg.get("id"):
+        details_path(conv_id, msg["id"]).unlink(missing_ok=True)
+
+
+def forget_conversation_details(conv_id: str):
+    """删除对话时移除其全部外置详情"""
+    shutil.rmtree(DETAILS_DIR / Path(conv_id).name, ignore_errors=True)
+
+
+# ============ 资源文件分片存储 ============
+# 上传和生成的文件按文件 ID 的哈希前缀分两级目录存放（如 generated/ab/cd/<文件名>），
+# 单个目录不会随时间无限膨胀，解析文件名时直接计算出路径而无需逐个目录探测。
+# 同一文件的派生版本（如 .model.jpg）文件 ID 相同，与原图位于同一目录。
+# 旧版平铺在 uploads/、generated/ 下的文件由后台迁移任务逐个移入分片目录，迁移完成前解析时回退查找旧路径。
+
+def _read_layout() -> dict:
+    try:
+        return json.loads(LAYOUT_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+# 是否可能仍有旧版平铺存放的文件
+_legacy_layout = _read_layout().get("assets") != "sharded"
+
+
+def asset_shard_dir(root: Path, filename: str) -> Path:
+    """文件所在的分片目录：按文件 ID（第一个 . 之前的部分）的 MD5 前缀分两级"""
+    digest = hashlib.md5(filename.split(".")[0].encode("utf-8")).hexdigest()
+    return root / digest[:2] / digest[2:4]
+
+
+def asset_path(root: Path, filename: str, create: bool = False) -> Path:
+    """文件在分片布局下的路径，create=True 时创建所在目录"""
+    directory = asset_shard_dir(root, filename)
+    if create:
+        directory.mkdir(parents=True, exist_ok=True)
+    return directory / filename
+
+
+def resolve_asset(root: Path, filename: str):
+    """解析 uploads/generated 下的文件，不存在时返回 None"""
+    name = filename.split("/")[-1]
+    if not name or name.startswith("."):
+        return None
+    path = asset_path(root, name)
+    if path.exists():
+        return path
+    if _legacy_layout:
+        legacy = root / name
+        if legacy.exists():
+            return legacy
+        if path.exists():  # 两次检查之间恰好被迁移
+            return path
+    return None
+
+
+def migrate_flat_assets(rate_limit: float = 0, verbose: bool = False) -> int:
+    """把旧版平铺存放的文件移入分片目录（可在服务运行时执行），返回移动的文件数
+
+    rate_limit: 每秒最多移动的文件数，0 表示不限速
+    """
+    global _legacy_layout
+    moved = 0
+    for root in (UPLOADS_DIR, GENERATED_DIR):
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith(".") or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    os.replace(entry.path, asset_path(root, entry.name, create=True))
+                except FileNotFoundError:
+                    continue  # 已被其他进程迁移或删除
+                moved += 1
+                if verbose and moved % 1000 == 0:
+                    print(f"📦 已迁移 {moved} 个文件...")
+                if rate_limit:
+                    time.sleep(1 / rate_limit)
     
-    # 解析 grounding chunks
-    if grounding_metadata.grounding_chunks:
-        for chunk in grounding_metadata.grounding_chunks:
-            context = chunk.web or chunk.retrieved_context
-            if context:
-                source = {
-                    "title": getattr(context, "title", "Source") or "Source",
-                    "uri": getattr(context, "uri", "") or ""
-                }
-                # 转换 GCS URI 为 HTTPS
-                if source["uri"].startswith("gs://"):
-                    source["uri"] = source["uri"].replace(
-                        "gs://", "https://storage.googleapis.com/", 1
-                    )
-                result["sources"].append(source)
+    LAYOUT_FILE.write_text(json.dumps({"assets": "sharded"}), encoding="utf-8")
+    _legacy_layout = False
+    return moved
+
+
+def start_asset_migration():
+    """存在旧版布局时在后台线程中迁移"""
+    if not _legacy_layout:
+        return
     
-    return result
+    def run():
+        moved = migrate_flat_assets(rate_limit=ASSET_MIGRATION_RATE)
+        if moved:
+            print(f"📦 资源文件已迁移到分片目录: {moved} 个")
+    
+    threading.Thread(target=run, name="asset-migration", daemon=True).start()
 
 
-# ============ 路由 ============
+# ============ 资源回收与配额 ============
+# 删除对话或消息只会移除 JSON 记录，引用的图片由这里统一回收：
+# 从对话存储计算仍被引用的文件 ID，未被引用且超过保护期的文件视为孤儿，后台限速删除；
+# 不在任何对话中的 API 生成结果（索引中没有关联对话）属于调用方，视为存活，只有删除对话或消息后才会回收；
+# 配置了配额时按"思考图片 -> 派生版本 -> 其他文件"的顺序，各层内按最近使用时间（LRU）淘汰。
 
-@app.route("/")
-def index():
-    """主页"""
-    return render_template("index.html")
+def message_asset_names(msg: dict) -> list:
+    """消息引用的文件名"""
+    names = []
+    if msg.get("image"):
+        names.append(msg["image"].split("/")[-1])
+    for f in msg.get("files") or []:
+        if f.get("filename"):
+            names.append(f["filename"].split("/")[-1])
+    for img in msg.get("thinking_images") or []:
+        if img.get("filename"):
+            names.append(img["filename"])
+    # 思考图片已外置时，摘要中保留了文件名
+    names.extend((msg.get("details") or {}).get("assets") or [])
+    return names
 
 
-@app.route("/api/config")
-def get_config():
-    """获取可用配置选项"""
-    return jsonify({
-        "aspect_ratios": VALID_ASPECT_RATIOS,
-        "image_sizes": VALID_IMAGE_SIZES,
-        "modes": ["standard", "search", "edit"]
-    })
+def collect_asset_references(conversations) -> dict:
+    """计算存活引用：文件 ID -> 引用它的对话 ID 集合（所有分支上的消息都算引用）"""
+    refs = {}
+    for conv in conversations:
+        for msg in conversation_nodes(conv):
+            for name in message_asset_names(msg):
+                refs.setdefault(name.split(".")[0], set()).add(conv["id"])
+    # 草稿缓存中的草稿图尚未定稿，也视为存活
+    with _draft_cache_lock:
+        for entry in _draft_cache.values():
+            if entry["draft_filename"]:
+                refs.setdefault(entry["draft_filename"].split(".")[0], set())
+    return refs
 
 
-@app.route("/api/conversations", methods=["GET"])
-def get_conversations():
-    """获取所有对话列表（包含完整消息）"""
-    conversations = load_conversations()
-    return jsonify(conversations)
+def unlinked_generated_ids() -> set:
+    """索引中从未关联对话的生成图片（API 直接调用的结果）的文件 ID"""
+    with _asset_db_lock:
+        rows = get_asset_db().execute(
+            "SELECT filename FROM assets WHERE conversation_id IS NULL AND kind IN ('generated', 'thought')"
+        ).fetchall()
+    return {row[0].split(".")[0] for row in rows}
 
 
-@app.route("/api/conversations/<conv_id>", methods=["GET"])
-def get_conversation(conv_id):
-    """获取单个对话详情"""
-    conversations = load_conversations()
-    for c in conversations:
-        if c["id"] == conv_id:
-            return jsonify(c)
-    return jsonify({"error": "对话不存在"}), 404
+def iter_asset_files():
+    """遍历 uploads/generated 下的所有文件（兼容分片目录和旧版平铺），产出 (路径, 文件名, 大小, 最近使用时间)"""
+    stack = [UPLOADS_DIR, GENERATED_DIR]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(Path(entry.path))
+                elif entry.is_file() and not entry.name.startswith(".") and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    yield Path(entry.path), entry.name, st.st_size, max(st.st_atime, st.st_mtime)
 
 
-@app.route("/api/conversations", methods=["POST"])
-def create_conversation():
-    """创建新对话"""
-    conversations = load_conversations()
-    new_conv = {
-        "id": str(uuid.uuid4()),
-        "title": "新对话",
-        "messages": [],
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
+def asset_eviction_tier(name: str) -> int:
+    """配额淘汰顺序：0 思考图片，1 可重新生成的派生版本（如 .model.jpg），2 其他文件"""
+    if name.startswith("thought_"):
+        return 0
+    if name.count(".") > 1:
+        return 1
+    return 2
+
+
+def plan_asset_gc(now: float = None) -> dict:
+    """计算回收计划（不删除任何文件）"""
+    now = now or time.time()
+    refs = collect_asset_references(iter_stored_conversations())
+    for file_id in unlinked_generated_ids():
+        refs.setdefault(file_id, set())
+    
+    orphans = []
+    live = []
+    total_bytes = 0
+    conversation_bytes = {}
+    for path, name, size, last_used in iter_asset_files():
+        total_bytes += size
+        owners = refs.get(name.split(".")[0])
+        if owners is None:
+            if now - last_used > ASSET_GC_GRACE:
+                orphans.append({"path": path, "size": size})
+            continue
+        live.append({"path": path, "name": name, "size": size, "last_used": last_used, "owners": owners})
+        for conv_id in owners:
+            conversation_bytes[conv_id] = conversation_bytes.get(conv_id, 0) + size
+    
+    def evict_order(item):
+        return asset_eviction_tier(item["name"]), item["last_used"]
+    
+    evictions = []
+    evicted = set()
+    
+    # 单个对话超出配额
+    if CONVERSATION_QUOTA_BYTES:
+        for conv_id, used in conversation_bytes.items():
+            if used <= CONVERSATION_QUOTA_BYTES:
+                continue
+            for item in sorted((i for i in live if conv_id in i["owners"]), key=evict_order):
+                if used <= CONVERSATION_QUOTA_BYTES:
+                    break
+                if item["path"] not in evicted:
+                    evicted.add(item["path"])
+                    evictions.append({"path": item["path"], "size": item["size"], "reason": f"conversation:{conv_id}"})
+                used -= item["size"]
+    
+    # 全局配额（孤儿文件会先被删除，不计入）
+    if ASSET_QUOTA_BYTES:
+        used = total_bytes - sum(o["size"] for o in orphans) - sum(e["size"] for e in evictions)
+        for item in sorted(live, key=evict_order):
+            if used <= ASSET_QUOTA_BYTES:
+                break
+            if item["path"] in evicted:
+                continue
+            evicted.add(item["path"])
+            evictions.append({"path": item["path"], "size": item["size"], "reason": "global"})
+            used -= item["size"]
+    
+    return {
+        "total_bytes": total_bytes,
+        "live_files": len(live),
+        "orphans": orphans,
+        "evictions": evictions
     }
-    conversations.insert(0, new_conv)
-    save_conversations(conversations)
-    return jsonify(new_conv)
+
+
+def sweep_assets(plan: dict, rate_limit: float = ASSET_GC_RATE) -> tuple:
+    """按计划删除文件（限速），返回 (删除数, 释放字节)"""
+    removed = freed = 0
+    removed_names = []
+    for item in plan["orphans"] + plan["evictions"]:
+        try:
+            item["path"].unlink()
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += item["size"]
+        removed_names.append(item["path"].name)
+        if rate_limit:
+            time.sleep(1 / rate_limit)
+    if removed_names:
+        forget_assets(removed_names)
+    return removed, freed
+
+
+def format_gc_report(plan: dict) -> str:
+    """回收计划的文本报告"""
+    mb = 1024 * 1024
+    orphan_bytes = sum(o["size"] for o in plan["orphans"])
+    lines = [
+        f"资源总量: {plan['total_bytes'] / mb:.1f} MB（被引用文件 {plan['live_files']} 个）",
+        f"孤儿文件: {len(plan['orphans'])} 个，{orphan_bytes / mb:.1f} MB",
+    ]
+    by_reason = {}
+    for item in plan["evictions"]:
+        count, size = by_reason.get(item["reason"], (0, 0))
+        by_reason[item["reason"]] = (count + 1, size + item["size"])
+    for reason, (count, size) in sorted(by_reason.items()):
+        label = "全局配额" if reason == "global" else f"对话配额 {reason.split(':', 1)[1]}"
+        lines.append(f"{label}淘汰: {count} 个，{size / mb:.1f} MB")
+    return "\n".join(lines)
+
+
+def start_asset_gc():
+    """启动后台资源回收线程"""
+    if not ASSET_GC_INTERVAL:
+        return
+    
+    def run():
+        while True:
+            time.sleep(ASSET_GC_INTERVAL)
+            try:
+                removed, freed = sweep_assets(plan_asset_gc())
+                if removed:
+                    print(f"🧹 资源回收: 删除 {removed} 个文件，释放 {freed / (1024 * 1024):.1f} MB")
+            except Exception as e:
+                print(f"⚠️ 资源回收失败: {e}")
+    
+    threading.Thread(target=run, name="asset-gc", daemon=True).start()
+
+
+# ============ 资源元数据索引 ============
+# 每个上传/生成的文件在写入时记录一行元数据（大小、尺寸、格式、内容哈希、生成参数、所属对话/消息、编辑来源），
+# 存放在 data/assets.db（SQLite）。画廊、统计和管理工具直接查询索引，无需解码图片或扫描对话文件。
+# user 记录文件所属的用户，接口只返回当前用户的文件。
+
+ASSET_INDEX_COLUMNS = (
+    "filename", "kind", "bytes", "width", "height", "format", "sha256",
+    "mode", "aspect_ratio", "image_size", "prompt", "conversation_id", "message_id", "parent", "created_at", "phash", "user"
+)
+ASSET_META_FIELDS = ("mode", "aspect_ratio", "image_size", "prompt", "conversation_id", "message_id", "parent")
+ASSET_QUERY_FILTERS = (
+    "kind", "mode", "aspect_ratio", "image_size", "prompt", "conversation_id", "message_id", "parent", "sha256", "user"
+)
+
+_asset_db = None
+_asset_db_lock = threading.Lock()
+
+
+def get_asset_db():
+    """获取索引数据库连接（延迟初始化，所有访问在 _asset_db_lock 下进行）"""
+    global _asset_db
+    if _asset_db is None:
+        import sqlite3
+        
+        db = sqlite3.connect(ASSET_INDEX_FILE, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                filename TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                format TEXT,
+                sha256 TEXT,
+                mode TEXT,
+                aspect_ratio TEXT,
+                image_size TEXT,
+                prompt TEXT,
+                conversation_id TEXT,
+                message_id TEXT,
+                parent TEXT,
+                created_at REAL NOT NULL,
+                phash INTEGER,
+                user TEXT NOT NULL DEFAULT 'default'
+            )
+        """)
+        # 旧版索引补充新增字段（已有文件归 default 用户）
+        columns = {r["name"] for r in db.execute("PRAGMA table_info(assets)")}
+        if "phash" not in columns:
+            db.execute("ALTER TABLE assets ADD COLUMN phash INTEGER")
+        if "user" not in columns:
+            db.execute(f"ALTER TABLE assets ADD COLUMN user TEXT NOT NULL DEFAULT '{DEFAULT_USER}'")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_assets_created ON assets (created_at, filename)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_assets_kind_created ON assets (kind, created_at, filename)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_assets_conversation ON assets (conversation_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_assets_sha256 ON assets (sha256)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_assets_prompt ON assets (prompt)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_assets_user_created ON assets (user, created_at, filename)")
+        _asset_db = db
+    return _asset_db
+
+
+def asset_kind(filename: str, root: Path) -> str:
+    """文件类别：upload / generated / thought"""
+    if root == UPLOADS_DIR:
+        return "upload"
+    return "thought" if filename.startswith("thought_") else "generated"
+
+
+def probe_asset(filepath: Path) -> dict:
+    """读取文件大小、内容哈希和图片头信息（只读文件头，不解码像素）"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for block in iter(lambda: fp.read(STREAM_BLOCK_SIZE), b""):
+            digest.update(block)
+    info = {
+        "bytes": filepath.stat().st_size,
+        "sha256": digest.hexdigest(),
+        "width": None,
+        "height": None,
+        "format": filepath.suffix.lstrip(".").upper() or None,
+        "phash": None
+    }
+    try:
+        from PIL import Image
+        with Image.open(filepath) as img:
+            info["width"], info["height"] = img.size
+            info["format"] = img.format
+    except Exception:
+        pass  # 非图片文件（如 PDF）只记录大小和哈希
+    return info
+
+
+@traced("index_asset")
+def index_asset(filepath: Path, kind: str, meta: dict = None, created_at: float = None):
+    """写入（或覆盖）一个文件的元数据；索引失败只记录日志，不影响上传和生成
+
+    感知哈希需要解码像素，写入索引后在 ingest 线程池中补算，不阻塞上传和 SSE 生成流
+    """
+    placeholders = ", ".join("?" for _ in ASSET_INDEX_COLUMNS)
+    try:
+        row = probe_asset(filepath)
+        row.update({field: (meta or {}).get(field) for field in ASSET_META_FIELDS})
+        row.update(filename=filepath.name, kind=kind, created_at=created_at or time.time(), user=(meta or {}).get("user") or DEFAULT_USER)
+        with _asset_db_lock:
+            get_asset_db().execute(
+                f"INSERT OR REPLACE INTO assets ({', '.join(ASSET_INDEX_COLUMNS)}) VALUES ({placeholders})",
+                [row[c] for c in ASSET_INDEX_COLUMNS]
+            )
+        if row["width"] is not None and kind not in ("thought", "rendition"):  # 思考图片和派生版本不参与相似检索
+            _ingest_pool.submit(update_asset_phash, filepath)
+    except Exception as e:
+        print(f"⚠️ 索引文件失败: {filepath.name} ({e})")
+
+
+def update_asset_phash(filepath: Path) -> bool:
+    """计算图片的感知哈希并写入索引和相似图片索引；文件已删除或无法解码时返回 False"""
+    try:
+        from PIL import Image
+        with Image.open(filepath) as img:
+            phash = perceptual_hash(img)
+    except Exception:
+        return False
+    with _asset_db_lock:
+        updated = get_asset_db().execute(
+            "UPDATE assets SET phash = ? WHERE filename = ?", (to_signed64(phash), filepath.name)
+        ).rowcount
+    if updated:
+        similarity_index.add(filepath.name, phash)
+    return bool(updated)
+
+
+def asset_row_to_dict(row) -> dict:
+    """索引行转为 API 输出"""
+    item = dict(row)
+    item["created_at"] = datetime.fromtimestamp(item["created_at"]).isoformat()
+    if item.get("phash") is not None:
+        item["phash"] = f"{item['phash'] & _UINT64_MASK:016x}"
+    item["path"] = f"/{'uploads' if item['kind'] == 'upload' else 'generated'}/{item['filename']}"
+    return item
+
+
+def get_asset_meta(filename: str):
+    """查询单个文件的元数据，不存在返回 None"""
+    with _asset_db_lock:
+        row = get_asset_db().execute(
+            "SELECT * FROM assets WHERE filename = ?", (filename.split("/")[-1],)
+        ).fetchone()
+    return asset_row_to_dict(row) if row else None
+
+
+def asset_visible(filename: str, user: str) -> bool:
+    """文件是否可被用户访问：只有所属用户可见，派生版本按原文件判断
+
+    未索引的文件（多用户之前的旧文件、索引失败的文件）视为 default 用户所有，其他用户不可见
+    """
+    stem = filename.split("/")[-1].split(".")[0]
+    with _asset_db_lock:
+        row = get_asset_db().execute(
+            "SELECT user FROM assets WHERE filename > ? AND filename < ? LIMIT 1", (stem + ".", stem + ".\uffff")
+        ).fetchone()
+    return (row["user"] if row else DEFAULT_USER) == user
+
+
+def asset_query_clause(filters: dict) -> tuple:
+    """根据过滤条件构造 WHERE 子句"""
+    clauses = []
+    params = []
+    for field in ASSET_QUERY_FILTERS:
+        if filters.get(field):
+            clauses.append(f"{field} = ?")
+            params.append(filters[field])
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def query_assets(filters: dict, limit: int = 50, offset: int = 0) -> list:
+    """按条件查询元数据，按创建时间倒序"""
+    where, params = asset_query_clause(filters)
+    with _asset_db_lock:
+        rows = get_asset_db().execute(
+            f"SELECT * FROM assets {where} ORDER BY created_at DESC, filename DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+    return [asset_row_to_dict(r) for r in rows]
+
+
+def summarize_assets(filters: dict) -> dict:
+    """按条件统计文件数与总字节数"""
+    where, params = asset_query_clause(filters)
+    with _asset_db_lock:
+        row = get_asset_db().execute(
+            f"SELECT COUNT(*) AS count, COALESCE(SUM(bytes), 0) AS bytes FROM assets {where}", params
+        ).fetchone()
+    return {"count": row["count"], "bytes": row["bytes"]}
+
+
+def link_conversation_assets(conv_id: str, messages: list):
+    """对话保存时，把消息引用的文件关联到对话和消息（补全生成时未知的归属）"""
+    updates = []
+    for msg in messages:
+        for name in message_asset_names(msg):
+            updates.append((conv_id, msg.get("id"), name))
+    if not updates:
+        return
+    with _asset_db_lock:
+        get_asset_db().executemany(
+            "UPDATE assets SET conversation_id = ?, message_id = COALESCE(?, message_id) WHERE filename = ?",
+            updates
+        )
+
+
+def forget_assets(filenames: list):
+    """从索引中移除已删除的文件"""
+    with _asset_db_lock:
+        get_asset_db().executemany("DELETE FROM assets WHERE filename = ?", [(n,) for n in filenames])
+    similarity_index.remove(filenames)
+
+
+def reindex_assets(verbose: bool = False) -> int:
+    """为索引中缺失的已有文件补录元数据，并按对话记录补全生成参数和归属，返回补录数"""
+    with _asset_db_lock:
+        known = {r[0] for r in get_asset_db().execute("SELECT filename FROM assets")}
+    
+    added = 0
+    for path, name, size, last_used in iter_asset_files():
+        if name in known or name.count(".") > 1:
+            continue  # 已索引，或是 .model.jpg 等派生版本
+        root = UPLOADS_DIR if UPLOADS_DIR in path.parents else GENERATED_DIR
+        index_asset(path, asset_kind(name, root), created_at=path.stat().st_mtime)
+        added += 1
+        if verbose and added % 500 == 0:
+            print(f"  已补录 {added} 个文件")
+    
+    # 补算旧版索引中缺少的感知哈希
+    for row in pending_phash_rows():
+        root = UPLOADS_DIR if row["kind"] == "upload" else GENERATED_DIR
+        path = resolve_asset(root, row["filename"])
+        if path:
+            update_asset_phash(path)
+    
+    # 从对话记录中恢复生成参数：助手消息的图片来自前一条用户消息
+    updates = []
+    for conv in iter_stored_conversations():
+        nodes = conv.get("nodes", {})
+        for msg in nodes.values():
+            parent = nodes.get(msg.get("parent")) or {}
+            if msg.get("image") and parent.get("role") == "user":
+                updates.append((parent.get("mode"), parent.get("text"), msg["image"].split("/")[-1]))
+        link_conversation_assets(conv["id"], conversation_nodes(conv))
+    with _asset_db_lock:
+        get_asset_db().executemany(
+            "UPDATE assets SET mode = COALESCE(mode, ?), prompt = COALESCE(prompt, ?) WHERE filename = ?",
+            updates
+        )
+    return added
+
+
+def pending_phash_rows() -> list:
+    """索引中尚未计算感知哈希的图片"""
+    with _asset_db_lock:
+        return get_asset_db().execute(
+            "SELECT filename, kind FROM assets WHERE phash IS NULL AND width IS NOT NULL AND kind NOT IN ('thought', 'rendition')"
+        ).fetchall()
+
+
+def start_asset_reindex():
+    """索引数据库首次创建或旧版索引缺少感知哈希时，在后台为已有文件补录元数据"""
+    fresh = not ASSET_INDEX_FILE.exists()
+    get_asset_db()  # 先创建数据库，避免重启后重复补录
+    if not fresh and not pending_phash_rows():
+        return
+    
+    def run():
+        try:
+            added = reindex_assets()
+            if added:
+                print(f"🗂️ 已为 {added} 个已有文件建立元数据索引")
+        except Exception as e:
+            print(f"⚠️ 建立元数据索引失败: {e}")
+    
+    threading.Thread(target=run, name="asset-reindex", daemon=True).start()
+
+
+def request_history(data: dict) -> list:
+    """生成请求的上下文：带 context_parent 时从服务端消息树按当前分支取，否则使用客户端传来的 history"""
+    parent_id = data.get("context_parent")
+    if parent_id and data.get("conversation_id"):
+        return branch_history(data["conversation_id"], parent_id, request_user())
+    return data.get("history", [])
+
+
+def request_asset_meta(data: dict, mode: str, **extra) -> dict:
+    """从生成请求中提取要记录到索引的元数据"""
+    meta = {
+        "user": request_user(),
+        "mode": mode,
+        "prompt": str(data.get("prompt", "")).strip() or None,
+        "conversation_id": data.get("conversation_id"),
+        "message_id": data.get("message_id")
+    }
+    meta.update(extra)
+    return meta
+
+
+# ============ 相似图片索引 ============
+# 每张上传/生成图片计算 64 位差值哈希（dHash），存入元数据索引的 phash 列；
+# 内存中以紧凑数组（array('Q')）保存全部哈希，按汉明距离查找相似图片（安装了 numpy 时向量化计算）。
+# 批量去重用分段鸽巢原理：距离不超过 d 的两个哈希，切成 d+1 段后至少有一段完全相同，只需比较同段相同的候选对。
+
+SIMILAR_MAX_DISTANCE = 10  # 查找相似图片的默认最大汉明距离
+DUPLICATE_MAX_DISTANCE = 4  # 判定为近似重复的默认最大汉明距离
+_UINT64_MASK = (1 << 64) - 1
+
+
+def perceptual_hash(img) -> int:
+    """计算 64 位 dHash：缩成 9x8 灰度图，比较每行相邻像素的亮度"""
+    from PIL import Image
+    
+    img.draft("L", (64, 64))  # JPEG 直接按缩小尺寸解码
+    small = img.convert("L").resize((9, 8), Image.LANCZOS, reducing_gap=2.0)
+    pixels = small.tobytes()  # 灰度图每个像素一个字节
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            offset = row * 9 + col
+            bits = (bits << 1) | (pixels[offset] > pixels[offset + 1])
+    return bits
+
+
+def to_signed64(value: int) -> int:
+    """无符号 64 位哈希转为 SQLite 可存储的有符号整数"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class PerceptualIndex:
+    """内存中的哈希数组，首次使用时从元数据索引加载"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._filenames = []
+        self._hashes = None  # array('Q')
+        self._positions = {}
+    
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        from array import array
+        
+        with _asset_db_lock:
+            rows = get_asset_db().execute("SELECT filename, phash FROM assets WHERE phash IS NOT NULL").fetchall()
+        self._filenames = [r["filename"] for r in rows]
+        self._hashes = array("Q", (r["phash"] & _UINT64_MASK for r in rows))
+        self._positions = {name: i for i, name in enumerate(self._filenames)}
+        self._loaded = True
+    
+    def add(self, filename: str, phash: int):
+        with self._lock:
+            if not self._loaded:
+                return  # 尚未加载，加载时会从数据库读到
+            if filename in self._positions:
+                self._hashes[self._positions[filename]] = phash
+            else:
+                self._positions[filename] = len(self._filenames)
+                self._filenames.append(filename)
+                self._hashes.append(phash)
+    
+    def remove(self, filenames: list):
+        with self._lock:
+            if not self._loaded:
+                return
+            for name in filenames:
+                pos = self._positions.pop(name, None)
+                if pos is None:
+                    continue
+                # 与末尾元素交换后删除，保持数组紧凑
+                last = len(self._filenames) - 1
+                if pos != last:
+                    self._filenames[pos] = self._filenames[last]
+                    self._hashes[pos] = self._hashes[last]
+                    self._positions[self._filenames[pos]] = pos
+                self._filenames.pop()
+                self._hashes.pop()
+    
+    def get(self, filename: str):
+        with self._lock:
+            self._ensure_loaded()
+            pos = self._positions.get(filename)
+            return None if pos is None else self._hashes[pos]
+    
+    def search(self, phash: int, max_distance: int, limit: int) -> list:
+        """返回距离不超过 max_distance 的 (文件名, 距离)，按距离升序"""
+        with self._lock:
+            self._ensure_loaded()
+            try:
+                import numpy as np
+            except ImportError:
+                np = None
+            if np is not None and len(self._hashes):
+                hashes = np.frombuffer(self._hashes, dtype=np.uint64)
+                xor = np.bitwise_xor(hashes, np.uint64(phash))
+                distances = np.unpackbits(xor.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+                matches = [(self._filenames[i], int(distances[i])) for i in np.flatnonzero(distances <= max_distance)]
+            else:
+                matches = []
+                for i, value in enumerate(self._hashes):
+                    distance = hamming_distance(value, phash)
+                    if distance <= max_distance:
+                        matches.append((self._filenames[i], distance))
+        matches.sort(key=lambda m: m[1])
+        return matches[:limit]
+    
+    def duplicate_groups(self, max_distance: int, names: set = None) -> list:
+        """把距离不超过 max_distance 的图片聚成组，names 限定参与比较的文件"""
+        with self._lock:
+            self._ensure_loaded()
+            entries = [(n, h) for n, h in zip(self._filenames, self._hashes) if names is None or n in names]
+        
+        # 64 位切成 max_distance + 1 段，同段相同的才是候选
+        bands = max_distance + 1
+        bounds = [round(64 * i / bands) for i in range(bands + 1)]
+        parent = list(range(len(entries)))
+        
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        for b in range(bands):
+            width = bounds[b + 1] - bounds[b]
+            shift = 64 - bounds[b + 1]
+            buckets = {}
+            for i, (_, value) in enumerate(entries):
+                buckets.setdefault((value >> shift) & ((1 << width) - 1), []).append(i)
+            for members in buckets.values():
+                # 哈希完全相同的直接合并，只在不同的哈希值之间计算距离；已在同一组的跳过，不需要记录比较过的对
+                distinct = {}
+                for i in members:
+                    first = distinct.setdefault(entries[i][1], i)
+                    if first != i:
+                        parent[find(i)] = find(first)
+                representatives = list(distinct.values())
+                for x in range(len(representatives)):
+                    for y in range(x + 1, len(representatives)):
+                        i, j = representatives[x], representatives[y]
+                        if find(i) != find(j) and hamming_distance(entries[i][1], entries[j][1]) <= max_distance:
+                            parent[find(i)] = find(j)
+        
+        groups = {}
+        for i in range(len(entries)):
+            groups.setdefault(find(i), []).append(entries[i][0])
+        return [sorted(g) for g in groups.values() if len(g) > 1]
+
+
+similarity_index = PerceptualIndex()
+
+
+def find_similar_assets(filename: str, max_distance: int = SIMILAR_MAX_DISTANCE, limit: int = 20, user: str = None):
+    """查找与指定图片相似的图片（不含自身），图片未建立哈希时返回 None；指定 user 时只返回该用户的图片"""
+    filename = filename.split("/")[-1]
+    phash = similarity_index.get(filename)
+    if phash is None:
+        return None
+    results = []
+    for name, distance in similarity_index.search(phash, max_distance, limit + 1):
+        if name == filename:
+            continue
+        meta = get_asset_meta(name)
+        if meta and (user is None or meta["user"] == user):
+            meta["distance"] = distance
+            results.append(meta)
+    return results[:limit]
+
+
+def build_duplicate_report(max_distance: int = DUPLICATE_MAX_DISTANCE, user: str = None) -> dict:
+    """对生成图片做近似重复检测，每组保留最早的一张，其余列为可删除；指定 user 时只检测该用户的图片"""
+    with _asset_db_lock:
+        rows = get_asset_db().execute(
+            "SELECT filename, bytes, created_at FROM assets WHERE kind = 'generated' AND phash IS NOT NULL"
+            + (" AND user = ?" if user else ""), (user,) if user else ()
+        ).fetchall()
+    info = {r["filename"]: r for r in rows}
+    groups = []
+    redundant_bytes = 0
+    for names in similarity_index.duplicate_groups(max_distance, set(info)):
+        names.sort(key=lambda n: info[n]["created_at"])
+        redundant_bytes += sum(info[n]["bytes"] for n in names[1:])
+        groups.append({"keep": names[0], "duplicates": names[1:]})
+    groups.sort(key=lambda g: len(g["duplicates"]), reverse=True)
+    return {
+        "max_distance": max_distance,
+        "scanned": len(info),
+        "groups": groups,
+        "redundant_files": sum(len(g["duplicates"]) for g in groups),
+        "redundant_bytes": redundant_bytes
+    }
+
+
+def format_duplicate_report(report: dict) -> str:
+    """近似重复报告的文本形式"""
+    lines = [
+        f"扫描生成图片 {report['scanned']} 张（汉明距离 ≤ {report['max_distance']}）",
+        f"近似重复 {len(report['groups'])} 组，可删除 {report['redundant_files']} 张，"
+        f"{report['redundant_bytes'] / (1024 * 1024):.1f} MB",
+    ]
+    for group in report["groups"][:50]:
+        lines.append(f"  保留 {group['keep']} <- {', '.join(group['duplicates'])}")
+    if len(report["groups"]) > 50:
+        lines.append(f"  ... 另有 {len(report['groups']) - 50} 组")
+    return "\n".join(lines)
+
+
+# ============ 图片库 ============
+# /api/gallery 直接从元数据索引按 (created_at, filename) 做游标分页，不读取对话文件；
+# 缩略图在首次请求时生成并与原图同目录缓存为 <id>.thumb.jpg（PDF 取第 1 页，?page=N 取指定页）。
+
+GALLERY_FILTERS = ("user", "mode", "aspect_ratio", "image_size", "conversation_id")
+GALLERY_MAX_LIMIT = 200
+THUMBNAIL_EDGE = 320  # 缩略图最长边
+
+
+def encode_gallery_cursor(created_at: float, filename: str) -> str:
+    """把分页位置编码为不透明的游标"""
+    return base64.urlsafe_b64encode(json.dumps([created_at, filename]).encode("utf-8")).decode("ascii")
+
+
+def decode_gallery_cursor(cursor: str) -> tuple:
+    """解析游标，格式错误时抛出 ValueError"""
+    try:
+        created_at, filename = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(created_at), str(filename)
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+
+def parse_date_bound(value: str, end: bool = False):
+    """解析日期范围参数（ISO 日期或时间），只给日期时结束边界包含当天"""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"日期格式错误: {value}")
+    timestamp = moment.timestamp()
+    if end and len(value) == 10:
+        timestamp += 24 * 3600
+    return timestamp
+
+
+def query_gallery(filters: dict, limit: int, cursor: str = None, since: float = None, until: float = None) -> tuple:
+    """按创建时间倒序查询生成图片，返回 (条目, 下一页游标)"""
+    clauses = ["kind = 'generated'"]
+    params = []
+    for field in GALLERY_FILTERS:
+        if filters.get(field):
+            clauses.append(f"{field} = ?")
+            params.append(filters[field])
+    if since is not None:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("created_at < ?")
+        params.append(until)
+    if cursor:
+        created_at, filename = decode_gallery_cursor(cursor)
+        clauses.append("(created_at < ? OR (created_at = ? AND filename < ?))")
+        params.extend([created_at, created_at, filename])
+    
+    with _asset_db_lock:
+        rows = get_asset_db().execute(
+            f"SELECT * FROM assets WHERE {' AND '.join(clauses)} ORDER BY created_at DESC, filename DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_gallery_cursor(rows[-1]["created_at"], rows[-1]["filename"])
+    
+    items = []
+    for row in rows:
+        item = asset_row_to_dict(row)
+        item["thumbnail"] = f"/thumbnails/{row['filename']}"
+        del item["sha256"], item["kind"]
+        items.append(item)
+    return items, next_cursor
+
+
+def thumbnail_path(filepath: Path) -> Path:
+    """缩略图缓存路径（与原图同目录）"""
+    return filepath.with_name(f"{filepath.name.split('.')[0]}.thumb.jpg")
+
+
+def make_thumbnail(filepath: Path, page: int = None) -> Path:
+    """生成（或复用已缓存的）缩略图；PDF 使用指定页（默认第 1 页）的渲染结果"""
+    from PIL import Image
+    
+    thumb = pdf_page_path(filepath, page, "thumb.jpg") if page else thumbnail_path(filepath)
+    if thumb.exists():
+        return thumb
+    if page or is_pdf(filepath):
+        img = open_oriented_image(render_pdf_page(filepath, page or 1))
+    else:
+        img = open_oriented_image(filepath)
+    img.thumbnail((THUMBNAIL_EDGE, THUMBNAIL_EDGE), Image.LANCZOS)
+    tmp_path = thumb.with_name(f"{thumb.name}.{uuid.uuid4().hex[:8]}.tmp")
+    img.convert("RGB").save(tmp_path, format="JPEG", quality=80)
+    os.replace(tmp_path, thumb)
+    return thumb
+
+
+def write_png(output_path: Path, image_bytes: bytes):
+    """把图片字节写成 PNG 文件"""
+    if image_bytes[:8] == PNG_SIGNATURE:
+        # 模型返回的已是 PNG，直接写入，避免再解码出一份像素数据
+        output_path.write_bytes(image_bytes)
+    else:
+        from PIL import Image
+        with Image.open(BytesIO(image_bytes)) as img:
+            img.save(output_path, format="PNG")
+
+
+@traced("save_image")
+def save_image_from_bytes(image_bytes: bytes, prefix: str = "", meta: dict = None) -> tuple:
+    """保存图片并返回文件名和base64（大图不内联 base64，返回 None）；meta 为记录到元数据索引的生成参数"""
+    filename = f"{prefix}{uuid.uuid4()}.png"
+    output_path = asset_path(GENERATED_DIR, filename, create=True)
+    write_png(output_path, image_bytes)
+    index_asset(output_path, "generated", meta)
+    
+    img_base64 = None
+    if len(image_bytes) <= SSE_INLINE_IMAGE_MAX:
+        img_base64 = base64.b64encode(image_bytes).decode("utf-8")
+    return filename, img_base64
+
+
+# ============ 思考过程图片 ============
+# 一次生成可能产生多张思考图片，按保留策略处理（请求参数 thought_images 或全局 THOUGHT_IMAGE_POLICY）。
+# 落盘在写入线程池中异步完成，SSE 事件先行发出；写入完成前请求该文件会等待写入结束。
+
+_pending_writes = {}  # 文件名 -> Future
+_pending_writes_lock = threading.Lock()
+
+
+def write_asset_async(filename: str, writer, *args):
+    """提交异步写盘任务"""
+    future = _writer_pool.submit(writer, *args)
+    with _pending_writes_lock:
+        _pending_writes[filename] = future
+    
+    def done(_):
+        with _pending_writes_lock:
+            _pending_writes.pop(filename, None)
+    future.add_done_callback(done)
+    return future
+
+
+def wait_pending_write(filename: str, timeout: float = 30):
+    """等待尚未完成的异步写入"""
+    with _pending_writes_lock:
+        future = _pending_writes.get(filename)
+    if future:
+        try:
+            future.result(timeout=timeout)
+        except Exception as e:
+            print(f"⚠️ 异步写入失败: {filename} ({e})")
+
+
+def write_thought_preview(output_path, image_bytes: bytes):
+    """生成思考图片的低分辨率 JPEG 预览（output_path 也可以是文件对象）"""
+    from PIL import Image
+    
+    with Image.open(BytesIO(image_bytes)) as img:
+        img.thumbnail((THOUGHT_PREVIEW_EDGE, THOUGHT_PREVIEW_EDGE), Image.LANCZOS)
+        img.convert("RGB").save(output_path, format="JPEG", quality=70)
+
+
+def resolve_thought_policy(data: dict) -> str:
+    """请求中的思考图片保留策略，未指定或无效时使用全局配置"""
+    policy = str(data.get("thought_images") or THOUGHT_IMAGE_POLICY).strip()
+    return policy if policy in THOUGHT_IMAGE_POLICIES else "full"
+
+
+@traced("thought_image")
+def save_thought_image(image_bytes: bytes, policy: str, meta: dict = None) -> tuple:
+    """按保留策略处理一张思考图片，返回 (SSE 事件, 保存到消息中的记录)，不需要时对应项为 None"""
+    if policy == "drop":
+        return None, None
+    
+    inline = None
+    if len(image_bytes) <= SSE_INLINE_IMAGE_MAX:
+        inline = base64.b64encode(image_bytes).decode("utf-8")
+    if policy == "ephemeral":
+        # 只随流发送给前端实时显示，不落盘也不写入对话；没有文件可供前端按路径加载，
+        # 因此总是内联，超过 SSE_INLINE_IMAGE_MAX 时改为内联低分辨率预览
+        if inline is not None:
+            return {"type": "thinking_image", "base64": inline, "ephemeral": True}, None
+        buffer = BytesIO()
+        write_thought_preview(buffer, image_bytes)
+        preview = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return {"type": "thinking_image", "base64": preview, "mime": "image/jpeg", "ephemeral": True}, None
+    
+    if policy == "preview":
+        filename = f"thought_{uuid.uuid4()}.jpg"
+        writer = write_thought_preview
+    else:
+        filename = f"thought_{uuid.uuid4()}.png"
+        writer = write_png
+    output_path = asset_path(GENERATED_DIR, filename, create=True)
+    
+    def write():
+        writer(output_path, image_bytes)
+        index_asset(output_path, "thought", meta)
+    write_asset_async(filename, write)
+    
+    record = {"filename": filename, "path": f"/generated/{filename}"}
+    return {"type": "thinking_image", **record, "base64": inline}, record
+
+
+@traced("save_image")
+def save_spilled_image(spill_path: Path, prefix: str = "", meta: dict = None) -> tuple:
+    """把已落盘的大图移入生成目录，返回文件名和 None（不内联 base64）"""
+    filename = f"{prefix}{uuid.uuid4()}.png"
+    output_path = asset_path(GENERATED_DIR, filename, create=True)
+    
+    with open(spill_path, "rb") as fp:
+        is_png = fp.read(8) == PNG_SIGNATURE
+    if is_png:
+        os.replace(spill_path, output_path)
+    else:
+        from PIL import Image
+        with Image.open(spill_path) as img:
+            img.save(output_path, format="PNG")
+        spill_path.unlink(missing_ok=True)
+    index_asset(output_path, "generated", meta)
+    return filename, None
+
+
+def spill_large_buffer(data: bytes):
+    """大于 SPILL_THRESHOLD 的缓冲区写入临时文件并返回路径，小缓冲区原样返回"""
+    if len(data) <= SPILL_THRESHOLD:
+        return data
+    spill_path = SPILL_DIR / f"{uuid.uuid4()}.bin"
+    spill_path.write_bytes(data)
+    return spill_path
+
+
+def read_spilled_buffer(buffer) -> bytes:
+    """读取 spill_large_buffer 的结果，临时文件读取后删除"""
+    if isinstance(buffer, Path):
+        data = buffer.read_bytes()
+        buffer.unlink(missing_ok=True)
+        return data
+    return buffer
+
+
+# ============ 内存预算 ============
+# 每个生成请求按输出尺寸和输入文件估算峰值内存并预留，总量不超过 MEMORY_BUDGET_MB；
+# 超出时排队等待，等待超时则拒绝，避免多个 4K 生成同时把进程撑爆。
+
+class MemoryBudgetExceeded(Exception):
+    """排队超时仍无法获得内存预算"""
+
+
+class MemoryBudget:
+    """进程级内存预算"""
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.reserved = 0
+        self.peak = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+    
+    def acquire(self, nbytes: int, timeout: float = 0) -> bool:
+        """预留内存，超时返回 False；超过总预算的请求只在空闲时单独放行"""
+        nbytes = min(nbytes, self.limit)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.reserved + nbytes > self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.reserved += nbytes
+                self.peak = max(self.peak, self.reserved)
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+    
+    def release(self, nbytes: int):
+        with self._cond:
+            self.reserved = max(0, self.reserved - min(nbytes, self.limit))
+            self._cond.notify_all()
+    
+    def reject(self):
+        with self._cond:
+            self.rejected += 1
+    
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "limit_bytes": self.limit,
+                "reserved_bytes": self.reserved,
+                "peak_bytes": self.peak,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected
+            }
+
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES)
+
+
+def estimate_generation_memory(image_size: str, input_paths: list) -> int:
+    """估算一次生成的峰值内存（字节）
+
+    输出图：响应中的 base64 文本 + 解码后的字节 + 可能的格式转换，按每像素约 9 字节估算；
+    思考过程图片按两张 1K 估算；输入文件：原始字节 + 请求体中的 base64，按文件大小 3 倍估算
+    """
+    output = IMAGE_SIZE_PIXELS.get(image_size, IMAGE_SIZE_PIXELS["1K"]) * 9
+    thoughts = IMAGE_SIZE_PIXELS["1K"] * 3 * 2
+    inputs = 0
+    for path in input_paths:
+        try:
+            inputs += path.stat().st_size * 3
+        except OSError:
+            pass
+    return output + thoughts + inputs
+
+
+def admit_generation(image_size: str, input_paths: list):
+    """为生成请求预留内存（生成器）：需要排队时先产出 queued 事件，返回预留的字节数"""
+    nbytes = estimate_generation_memory(image_size, input_paths)
+    if not memory_budget.acquire(nbytes):
+        yield f"data: {json.dumps({'type': 'queued', 'message': '等待其他生成任务释放内存...'})}\n\n"
+        with trace_stage("memory_wait", bytes=nbytes):
+            admitted = memory_budget.acquire(nbytes, MEMORY_QUEUE_TIMEOUT)
+        if not admitted:
+            memory_budget.reject()
+            raise MemoryBudgetExceeded("服务器繁忙（内存不足），请稍后重试")
+    return nbytes
+
+
+def with_memory_budget(image_size: str, input_paths: list, stream):
+    """预留内存后再执行 SSE 生成流，结束或客户端断开时释放"""
+    try:
+        reserved = yield from admit_generation(image_size, input_paths)
+    except MemoryBudgetExceeded as e:
+        yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+        return
+    try:
+        yield from stream
+    finally:
+        memory_budget.release(reserved)
+
+
+# ============ 生成调度 ============
+# 模型调用按优先级分为 interactive（网页端）、background（默认，脚本调用）、bulk（批量任务）三类，
+# 总并发不超过 SCHEDULER_MAX_CONCURRENT，其中 SCHEDULER_INTERACTIVE_RESERVED 个名额只给交互请求；
+# 排队的请求按加权公平排队（每类请求的虚拟完成时间 = max(当前虚拟时间, 该类上一个请求) + 1/权重）依次放行，
+# 大批量脚本不会让网页端的请求一直排在后面。排队位置和预计等待时间在 start 事件中返回。
+
+PRIORITY_CLASSES = ("interactive", "background", "bulk")
+SCHEDULER_WEIGHTS = {"interactive": 8.0, "background": 3.0, "bulk": 1.0}
+SCHEDULER_WEIGHTS.update({
+    name: float(weight) for name, weight in parse_user_map(os.getenv("SCHEDULER_WEIGHTS", "")).items()
+    if name in PRIORITY_CLASSES and float(weight) > 0
+})
+SCHEDULER_POLL_SECONDS = 2  # 排队时检查位置变化的间隔
+SCHEDULER_INITIAL_ESTIMATE = 30.0  # 还没有完成的生成时假定的单次耗时（秒）
+
+
+class GenerationScheduler:
+    """按优先级加权公平排队的生成名额"""
+    
+    def __init__(self, capacity: int, reserved: int, weights: dict):
+        self.capacity = capacity
+        # 至少给其他优先级留一个名额，否则 background/bulk 永远无法执行
+        self.reserved = max(0, min(reserved, capacity - 1)) if capacity else 0
+        self.weights = weights
+        self.running = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.admitted = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.rejected = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.waiting = []
+        self.virtual_time = 0.0
+        self.last_finish = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+        self.avg_seconds = SCHEDULER_INITIAL_ESTIMATE
+        self._cond = threading.Condition()
+    
+    def _slots(self, priority: str) -> int:
+        return self.capacity if priority == "interactive" else self.capacity - self.reserved
+    
+    def _eligible(self, priority: str) -> bool:
+        if priority == "interactive" or not self.capacity:  # capacity 为 0 表示不限并发
+            return True
+        return sum(self.running.values()) - self.running["interactive"] < self._slots(priority)
+    
+    def _dispatch(self):
+        """在持有锁时按虚拟完成时间放行排队的请求"""
+        granted = False
+        while self.waiting and (not self.capacity or sum(self.running.values()) < self.capacity):
+            candidates = [t for t in self.waiting if self._eligible(t["priority"])]
+            if not candidates:
+                break
+            ticket = min(candidates, key=lambda t: t["tag"])
+            self.waiting.remove(ticket)
+            ticket["granted"] = True
+            ticket["granted_at"] = time.monotonic()
+            self.running[ticket["priority"]] += 1
+            self.admitted[ticket["priority"]] += 1
+            self.virtual_time = max(self.virtual_time, ticket["tag"])
+            granted = True
+        if granted:
+            self._cond.notify_all()
+    
+    def enqueue(self, priority: str) -> dict:
+        """加入队列（有空闲名额时立即放行），返回排队凭据"""
+        with self._cond:
+            tag = max(self.virtual_time, self.last_finish[priority]) + 1 / self.weights[priority]
+            self.last_finish[priority] = tag
+            ticket = {"priority": priority, "tag": tag, "granted": False,
+                      "enqueued_at": time.monotonic(), "granted_at": None}
+            self.waiting.append(ticket)
+            self._dispatch()
+            return ticket
+    
+    def wait(self, ticket: dict, timeout: float) -> bool:
+        """等待放行，超时返回 False（凭据仍在队列中）"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not ticket["granted"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+    
+    def finish(self, ticket: dict, completed: bool = True):
+        """生成结束释放名额，仍在排队（超时或客户端断开）时移出队列"""
+        with self._cond:
+            if ticket["granted"]:
+                self.running[ticket["priority"]] -= 1
+                if completed:
+                    elapsed = time.monotonic() - ticket["granted_at"]
+                    self.avg_seconds = self.avg_seconds * 0.8 + elapsed * 0.2
+            elif ticket in self.waiting:
+                self.waiting.remove(ticket)
+                if not completed:
+                    self.rejected[ticket["priority"]] += 1
+            self._dispatch()
+            self._cond.notify_all()
+    
+    def queue_info(self, ticket: dict) -> dict:
+        """排队位置（前面还有几个请求）和预计等待秒数"""
+        with self._cond:
+            if ticket["granted"]:
+                return {"priority": ticket["priority"], "queue_position": 0, "estimated_wait": 0}
+            ahead = sum(1 for t in self.waiting if t["tag"] < ticket["tag"])
+            slots = max(1, self._slots(ticket["priority"]))
+            return {
+                "priority": ticket["priority"],
+                "queue_position": ahead + 1,
+                "estimated_wait": round(self.avg_seconds * (ahead // slots + 1))
+            }
+    
+    def snapshot(self) -> dict:
+        with self._cond:
+            waiting = dict.fromkeys(PRIORITY_CLASSES, 0)
+            for ticket in self.waiting:
+                waiting[ticket["priority"]] += 1
+            return {
+                "capacity": self.capacity,
+                "interactive_reserved": self.reserved,
+                "weights": self.weights,
+                "running": dict(self.running),
+                "waiting": waiting,
+                "admitted": dict(self.admitted),
+                "rejected": dict(self.rejected),
+                "avg_generation_seconds": round(self.avg_seconds, 1)
+            }
+
+
+generation_scheduler = GenerationScheduler(SCHEDULER_MAX_CONCURRENT, SCHEDULER_INTERACTIVE_RESERVED, SCHEDULER_WEIGHTS)
+
+
+def is_web_ui_request() -> bool:
+    """请求是否由本站网页发出：浏览器的同源请求，配置令牌时还要求令牌来自 Cookie 而不是 Authorization 头"""
+    same_origin = (request.headers.get("Sec-Fetch-Site") == "same-origin"
+                   or request.headers.get("Origin", "").rstrip("/") == request.host_url.rstrip("/"))
+    return same_origin and not (USER_TOKENS and request.headers.get("Authorization"))
+
+
+def request_priority(data: dict) -> str:
+    """请求的优先级：请求体 priority 或 X-Priority 头，无效或未指定时使用 SCHEDULER_DEFAULT_PRIORITY
+
+    interactive 只给网页端和 SCHEDULER_INTERACTIVE_USERS 中的用户，其他请求降为 background，
+    避免脚本自称 interactive 占用为网页端保留的名额
+    """
+    priority = str(data.get("priority") or request.headers.get("X-Priority", "")).strip().lower()
+    if priority == "interactive" and not (is_web_ui_request() or request_user() in SCHEDULER_INTERACTIVE_USERS):
+        return "background"
+    if priority in PRIORITY_CLASSES:
+        return priority
+    return SCHEDULER_DEFAULT_PRIORITY if SCHEDULER_DEFAULT_PRIORITY in PRIORITY_CLASSES else "background"
+
+
+def with_generation_slot(priority: str, stream):
+    """按优先级排队获得生成名额后执行 SSE 生成流
+
+    先产出带排队位置和预计等待时间的 start 事件，排队期间位置变化时产出 queued 事件
+    """
+    ticket = generation_scheduler.enqueue(priority)
+    completed = False
+    try:
+        info = generation_scheduler.queue_info(ticket)
+        if ticket["granted"]:
+            message = "开始生成..."
+        else:
+            message = f"排队中：第 {info['queue_position']} 位，预计等待约 {info['estimated_wait']} 秒"
+        yield f"data: {json.dumps({'type': 'start', 'message': message, **info})}\n\n"
+        
+        if not ticket["granted"]:
+            deadline = time.monotonic() + SCHEDULER_QUEUE_TIMEOUT
+            with trace_stage("queue_wait", priority=priority):
+                while not generation_scheduler.wait(ticket, SCHEDULER_POLL_SECONDS):
+                    if time.monotonic() >= deadline:
+                        yield f"data: {json.dumps({'type': 'error', 'message': '排队超时，服务器繁忙，请稍后重试'})}\n\n"
+                        return
+                    latest = generation_scheduler.queue_info(ticket)
+                    if latest["queue_position"] != info["queue_position"]:
+                        info = latest
+                        message = f"排队中：第 {info['queue_position']} 位，预计等待约 {info['estimated_wait']} 秒"
+                        yield f"data: {json.dumps({'type': 'queued', 'message': message, **info})}\n\n"
+        
+        yield from stream
+        completed = True
+    finally:
+        generation_scheduler.finish(ticket, completed)
+
+
+def hidden_request_input(files: list, history: list = (), extra: tuple = ()):
+    """请求引用的文件（files、历史消息中的图片、遮罩等）中第一个当前用户无权访问的文件名，都可访问时返回 None"""
+    user = request_user()
+    names = [str(f.get("filename", "")) for f in files] + [str(name) for name in extra]
+    names += [msg["image"] for msg in history if str(msg.get("image") or "").startswith(("/generated/", "/uploads/"))]
+    for name in names:
+        name = name.split("/")[-1]
+        if name and not asset_visible(name, user):
+            return name
+    return None
+
+
+def request_input_paths(files: list, history: list = ()) -> list:
+    """请求引用的本地文件（用于内存估算）"""
+    paths = []
+    for f in files:
+        filepath = find_image_file(f.get("filename", ""))
+        if filepath:
+            paths.append(filepath)
+    for msg in history:
+        image = msg.get("image") or ""
+        if image.startswith(("/generated/", "/uploads/")):
+            filepath = find_image_file(image.split("/")[-1])
+            if filepath:
+                paths.append(filepath)
+    return paths
+
+
+def parse_grounding_metadata(grounding_metadata) -> dict:
+    """解析 grounding 元数据"""
+    result = {
+        "sources": [],
+        "search_queries": [],
+    }
+    
+    if not grounding_metadata:
+        return result
+    
+    # 解析搜索查询
+    if grounding_metadata.web_search_queries:
+        result["search_queries"] = list(grounding_metadata.web_search_queries)
+    
+    # 解析 grounding chunks
+    if grounding_metadata.grounding_chunks:
+        for chunk in grounding_metadata.grounding_chunks:
+            context = chunk.web or chunk.retrieved_context
+            if context:
+                source = {
+                    "title": getattr(context, "title", "Source") or "Source",
+                    "uri": getattr(context, "uri", "") or ""
+                }
+                # 转换 GCS URI 为 HTTPS
+                if source["uri"].startswith("gs://"):
+                    source["uri"] = source["uri"].replace(
+                        "gs://", "https://storage.googleapis.com/", 1
+                    )
+                result["sources"].append(source)
+    
+    return result
+
+
+# ============ 用量记录 ============
+# 每次调用模型记录一行用量（data/usage.db）：token 数（输入/输出/思考）、输入图片字节数、
+# 输出图片大小和尺寸、模式、上下文条数、耗时和结果；/api/usage 按天、对话、模式等汇总。
+# 配置了 token 预算时，生成开始前检查请求用户当天的用量，超出返回 429。
+
+USAGE_GROUPS = {
+    "day": "day",
+    "conversation": "conversation_id",
+    "mode": "mode",
+    "image_size": "image_size",
+    "aspect_ratio": "aspect_ratio",
+    "user": "user",
+    "status": "status"
+}
+USAGE_INT_FIELDS = (
+    "history_messages", "input_images", "input_bytes", "prompt_tokens", "candidate_tokens",
+    "thought_tokens", "total_tokens", "output_bytes", "output_width", "output_height", "latency_ms"
+)
+
+_usage_db = None
+_usage_db_lock = threading.Lock()
+
+
+USAGE_USER_BUDGETS = {user: int(amount) for user, amount in parse_user_map(os.getenv("USAGE_USER_BUDGETS", "")).items()}
+
+
+def get_usage_db():
+    """获取用量数据库连接（延迟初始化，所有访问在 _usage_db_lock 下进行）"""
+    global _usage_db
+    if _usage_db is None:
+        import sqlite3
+        
+        db = sqlite3.connect(USAGE_DB_FILE, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"""
+            CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                day TEXT NOT NULL,
+                user TEXT NOT NULL,
+                conversation_id TEXT,
+                message_id TEXT,
+                mode TEXT,
+                model TEXT,
+                aspect_ratio TEXT,
+                image_size TEXT,
+                status TEXT,
+                {", ".join(f"{f} INTEGER" for f in USAGE_INT_FIELDS)}
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_usage_day ON usage (day)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_usage_user_day ON usage (user, day)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_usage_conversation ON usage (conversation_id)")
+        _usage_db = db
+    return _usage_db
+
+
+def usage_budget(user: str) -> int:
+    """用户每天的 token 预算，0 表示不限"""
+    return USAGE_USER_BUDGETS.get(user, USAGE_DAILY_TOKEN_BUDGET)
+
+
+def tokens_used_today(user: str) -> int:
+    with _usage_db_lock:
+        row = get_usage_db().execute(
+            "SELECT COALESCE(SUM(total_tokens), 0) FROM usage WHERE user = ? AND day = ?",
+            (user, datetime.now().strftime("%Y-%m-%d"))
+        ).fetchone()
+    return row[0]
+
+
+def check_usage_budget(user: str):
+    """生成前检查预算，超出时返回错误信息"""
+    budget = usage_budget(user)
+    if budget and tokens_used_today(user) >= budget:
+        return f"今日 token 用量已达上限（{budget}），请明天再试"
+    return None
+
+
+def new_usage_record(asset_meta: dict, history: list = (), input_paths: list = ()) -> dict:
+    """生成请求开始时创建用量记录，调用过程中逐步填入 token 数和输出信息"""
+    input_bytes = 0
+    for path in input_paths:
+        try:
+            input_bytes += path.stat().st_size
+        except OSError:
+            pass
+    return {
+        "user": request_user(),
+        "conversation_id": asset_meta.get("conversation_id"),
+        "message_id": asset_meta.get("message_id"),
+        "mode": asset_meta.get("mode"),
+        "model": "gemini-3-pro-image-preview",
+        "aspect_ratio": asset_meta.get("aspect_ratio"),
+        "image_size": asset_meta.get("image_size"),
+        "status": "error",
+        "history_messages": len(history),
+        "input_images": len(input_paths),
+        "input_bytes": input_bytes
+    }
+
+
+def note_usage_metadata(usage: dict, usage_metadata):
+    """记录响应中的 usage_metadata（流式响应中为累计值，取最新一次）"""
+    if usage is None or usage_metadata is None:
+        return
+    for field, attr in (("prompt_tokens", "prompt_token_count"), ("candidate_tokens", "candidates_token_count"),
+                        ("thought_tokens", "thoughts_token_count"), ("total_tokens", "total_token_count")):
+        value = getattr(usage_metadata, attr, None)
+        if value is not None:
+            usage[field] = value
+
+
+def note_usage_output(usage: dict, filename: str):
+    """记录输出图片的大小和尺寸（取自元数据索引）"""
+    if usage is None:
+        return
+    meta = get_asset_meta(filename) or {}
+    usage.update(status="ok", output_bytes=meta.get("bytes"), output_width=meta.get("width"), output_height=meta.get("height"))
+
+
+def record_usage(usage: dict):
+    """写入一行用量记录；失败只记录日志"""
+    now = time.time()
+    row = {**usage, "ts": now, "day": datetime.fromtimestamp(now).strftime("%Y-%m-%d")}
+    columns = ["ts", "day", "user", "conversation_id", "message_id", "mode", "model", "aspect_ratio", "image_size", "status",
+               *USAGE_INT_FIELDS]
+    try:
+        with _usage_db_lock:
+            get_usage_db().execute(
+                f"INSERT INTO usage ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [row.get(c) for c in columns]
+            )
+    except Exception as e:
+        print(f"⚠️ 记录用量失败: {e}")
+
+
+def with_usage(usage: dict, stream):
+    """执行 SSE 生成流并在结束（包括出错和客户端断开）时写入用量记录"""
+    started = time.time()
+    try:
+        yield from stream
+    except GeneratorExit:
+        usage["status"] = "cancelled"
+        raise
+    finally:
+        usage["latency_ms"] = int((time.time() - started) * 1000)
+        record_usage(usage)
+
+
+def usage_cost(prompt_tokens: int, output_tokens: int):
+    """按配置的单价估算费用（美元），未配置单价时返回 None"""
+    if not (USAGE_PRICE_INPUT_PER_M or USAGE_PRICE_OUTPUT_PER_M):
+        return None
+    return round((prompt_tokens * USAGE_PRICE_INPUT_PER_M + output_tokens * USAGE_PRICE_OUTPUT_PER_M) / 1_000_000, 4)
+
+
+def summarize_usage(group: str, since: str = None, until: str = None, user: str = None, limit: int = 100) -> list:
+    """按维度汇总用量，since/until 为 YYYY-MM-DD（含）"""
+    column = USAGE_GROUPS[group]
+    clauses, params = [], []
+    if since:
+        clauses.append("day >= ?")
+        params.append(since)
+    if until:
+        clauses.append("day <= ?")
+        params.append(until)
+    if user:
+        clauses.append("user = ?")
+        params.append(user)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    order = "key DESC" if group == "day" else "total_tokens DESC"
+    with _usage_db_lock:
+        rows = get_usage_db().execute(
+            f"SELECT {column} AS key, COUNT(*) AS calls, SUM(status = 'ok') AS succeeded, "
+            f"COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, COALESCE(SUM(candidate_tokens), 0) AS candidate_tokens, "
+            f"COALESCE(SUM(thought_tokens), 0) AS thought_tokens, COALESCE(SUM(total_tokens), 0) AS total_tokens, "
+            f"COALESCE(SUM(input_bytes), 0) AS input_bytes, COALESCE(SUM(output_bytes), 0) AS output_bytes, "
+            f"CAST(AVG(history_messages) AS REAL) AS avg_history, CAST(AVG(latency_ms) AS INTEGER) AS avg_latency_ms "
+            f"FROM usage {where} GROUP BY {column} ORDER BY {order} LIMIT ?",
+            params + [limit]
+        ).fetchall()
+    items = []
+    for row in rows:
+        item = dict(row)
+        item["avg_history"] = round(item["avg_history"] or 0, 2)
+        cost = usage_cost(item["prompt_tokens"], item["candidate_tokens"] + item["thought_tokens"])
+        if cost is not None:
+            item["cost_usd"] = cost
+        items.append(item)
+    return items
+
+
+def format_usage_report(group: str, items: list) -> str:
+    """用量汇总的文本报告（CLI 使用）"""
+    lines = [f"{group:<38} {'调用':>6} {'成功':>6} {'输入 token':>12} {'输出 token':>12} {'思考 token':>12} {'平均耗时':>10}"]
+    for item in items:
+        lines.append(
+            f"{str(item['key']):<38} {item['calls']:>6} {item['succeeded']:>6} {item['prompt_tokens']:>12} "
+            f"{item['candidate_tokens']:>12} {item['thought_tokens']:>12} {(item['avg_latency_ms'] or 0) / 1000:>9.1f}s"
+        )
+    return "\n".join(lines)
+
+
+# ============ 全文搜索 ============
+# 对话标题、用户提示词、模型回复、思考过程和搜索查询写入 data/search.db 的 FTS5 索引。
+# 中日韩文字没有空格分词，入库前把连续的 CJK 字符切成重叠二元组（末字额外保留单字），
+# 其他文字按单词切分，因此两个字的中文查询也能命中；单字查询用前缀匹配。
+# 对话保存时按 (消息, 字段) 对比摘要，只重新索引有变化的字段。
+
+SEARCH_FIELDS = ("title", "prompt", "text", "thinking", "grounding")
+SEARCH_SNIPPET_CHARS = 120
+SEARCH_TOKENIZER_VERSION = 2  # 分词规则变化时加 1，已有索引会清空并在后台重建
+_CJK_CHARS = "぀-ヿ㐀-䶿一-鿿豈-﫿가-힯"
+_CJK_RUN = re.compile(f"[{_CJK_CHARS}]+")
+# 单词部分排除 CJK 字符，紧跟在字母数字后面的中文（如 "logo设计图"）也会单独切成二元组
+_SEARCH_TERM = re.compile(f"[{_CJK_CHARS}]+|(?:(?![{_CJK_CHARS}])[^\\W_])+")
+
+_search_db = None
+_search_db_lock = threading.Lock()
+_search_rebuild_needed = False  # 索引为空或分词规则已变化，需要为已有对话重建
+
+
+def get_search_db():
+    """获取全文索引数据库连接（延迟初始化，所有访问在 _search_db_lock 下进行）"""
+    global _search_db, _search_rebuild_needed
+    if _search_db is None:
+        import sqlite3
+        
+        db = sqlite3.connect(SEARCH_INDEX_FILE, check_same_thread=False, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS search_docs (
+                id INTEGER PRIMARY KEY,
+                conversation_id TEXT NOT NULL,
+                doc_key TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                message_id TEXT,
+                role TEXT,
+                field TEXT NOT NULL,
+                body TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                user TEXT NOT NULL DEFAULT 'default'
+            )
+        """)
+        if "user" not in {r["name"] for r in db.execute("PRAGMA table_info(search_docs)")}:
+            db.execute(f"ALTER TABLE search_docs ADD COLUMN user TEXT NOT NULL DEFAULT '{DEFAULT_USER}'")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_search_docs_conversation ON search_docs (conversation_id)")
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(tokens, tokenize='unicode61 remove_diacritics 2')")
+        if db.execute("PRAGMA user_version").fetchone()[0] < SEARCH_TOKENIZER_VERSION:
+            # 旧规则生成的索引词与新查询对不上，清空后由 start_search_reindex 重建
+            db.execute("DELETE FROM search_docs")
+            db.execute("DELETE FROM search_fts")
+            db.execute(f"PRAGMA user_version = {SEARCH_TOKENIZER_VERSION}")
+            _search_rebuild_needed = True
+        _search_db = db
+    return _search_db
+
+
+def search_tokens(text: str) -> str:
+    """把文本转为空格分隔的索引词：CJK 连续字符切成二元组，其他按单词
+
+    >>> search_tokens("生成一张logo设计图，4K海报")
+    '生成 成一 一张 张 logo 设计 计图 图 4k 海报 报'
+    """
+    tokens = []
+    for term in _SEARCH_TERM.findall(text.lower()):
+        if _CJK_RUN.fullmatch(term):
+            tokens.extend(term[i:i + 2] for i in range(len(term) - 1))
+            tokens.append(term[-1])
+        else:
+            tokens.append(term)
+    return " ".join(tokens)
+
+
+def build_search_query(query: str) -> tuple:
+    """把用户输入转为 FTS5 查询，返回 (MATCH 表达式, 用于高亮的原始词)"""
+    terms = _SEARCH_TERM.findall(query.lower())
+    clauses = []
+    for term in terms:
+        if _CJK_RUN.fullmatch(term) and len(term) > 1:
+            # 相邻二元组组成短语，保证命中的是连续原文
+            clauses.append('"' + " ".join(term[i:i + 2] for i in range(len(term) - 1)) + '"')
+        else:
+            clauses.append(f'"{term}" *')
+    return " AND ".join(clauses), terms
+
+
+def message_search_fields(msg: dict) -> list:
+    """消息中需要索引的 (字段, 文本)"""
+    fields = []
+    if msg.get("role") == "user":
+        fields.append(("prompt", msg.get("text")))
+    else:
+        fields.append(("text", msg.get("text")))
+        fields.append(("thinking", msg.get("thinking")))
+        queries = (msg.get("grounding") or {}).get("search_queries") or []
+        fields.append(("grounding", " / ".join(q for q in queries if isinstance(q, str))))
+    return [(field, text) for field, text in fields if isinstance(text, str) and text.strip()]
+
+
+@traced("search_index")
+def index_conversation_text(conv: dict):
+    """增量更新一个对话（消息树）的全文索引：只重写新增或内容变化的字段
+
+    所有分支上的消息都会被索引，position 为消息在所属分支中的序号
+    """
+    docs = {}
+    preserved = set()  # 已外置且本次未带回内容的字段，保留原索引
+    if conv.get("title"):
+        docs[("title", "title")] = {"position": -1, "message_id": None, "role": None, "field": "title", "body": conv["title"]}
+    position_of = node_depths(conv)
+    for msg in conversation_nodes(conv):
+        key = msg["id"]
+        position = position_of.get(key, 0)
+        for field in (msg.get("details") or {}).get("fields", {}):
+            if field in SEARCH_FIELDS and not msg.get(field):
+                preserved.add((key, field))
+        for field, text in message_search_fields(msg):
+            docs[(key, field)] = {
+                "position": position, "message_id": msg.get("id"), "role": msg.get("role"), "field": field, "body": text
+            }
+    
+    now = time.time()
+    with _search_db_lock:
+        db = get_search_db()
+        existing = {
+            (r["doc_key"], r["field"]): r
+            for r in db.execute("SELECT id, doc_key, field, position, digest FROM search_docs WHERE conversation_id = ?", (conv["id"],))
+        }
+        db.execute("BEGIN")
+        try:
+            for key, row in existing.items():
+                if key in preserved:
+                    if row["position"] != position_of.get(key[0], row["position"]):
+                        db.execute("UPDATE search_docs SET position = ? WHERE id = ?", (position_of[key[0]], row["id"]))
+                    continue
+                if key not in docs:
+                    db.execute("DELETE FROM search_docs WHERE id = ?", (row["id"],))
+                    db.execute("DELETE FROM search_fts WHERE rowid = ?", (row["id"],))
+            for key, doc in docs.items():
+                digest = hashlib.sha1(doc["body"].encode("utf-8")).hexdigest()
+                row = existing.get(key)
+                if row and row["digest"] == digest:
+                    if row["position"] != doc["position"]:
+                        # 前面的消息被删除导致位置变化，无需重新分词
+                        db.execute("UPDATE search_docs SET position = ? WHERE id = ?", (doc["position"], row["id"]))
+                    continue
+                if row:
+                    db.execute("DELETE FROM search_fts WHERE rowid = ?", (row["id"],))
+                    db.execute("DELETE FROM search_docs WHERE id = ?", (row["id"],))
+                cursor = db.execute(
+                    "INSERT INTO search_docs (conversation_id, doc_key, position, message_id, role, field, body, digest, updated_at, user) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (conv["id"], key[0], doc["position"], doc["message_id"], doc["role"], doc["field"], doc["body"], digest, now,
+                     conv.get("owner", DEFAULT_USER))
+                )
+                db.execute("INSERT INTO search_fts (rowid, tokens) VALUES (?, ?)", (cursor.lastrowid, search_tokens(doc["body"])))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+
+def forget_conversation_text(conv_id: str):
+    """从全文索引中移除一个对话"""
+    with _search_db_lock:
+        db = get_search_db()
+        db.execute("BEGIN")
+        db.execute("DELETE FROM search_fts WHERE rowid IN (SELECT id FROM search_docs WHERE conversation_id = ?)", (conv_id,))
+        db.execute("DELETE FROM search_docs WHERE conversation_id = ?", (conv_id,))
+        db.execute("COMMIT")
+
+
+def update_search_index(conv: dict):
+    """对话保存后更新全文索引；失败只记录日志，不影响保存"""
+    try:
+        index_conversation_text(conv)
+    except Exception as e:
+        print(f"⚠️ 更新搜索索引失败: {conv.get('id')} ({e})")
+
+
+def make_search_snippet(body: str, terms: list) -> dict:
+    """截取命中位置附近的片段，返回片段文本和高亮区间"""
+    lowered = body.lower()
+    hits = [lowered.find(t) for t in terms]
+    first = min((h for h in hits if h >= 0), default=0)
+    start = max(0, first - SEARCH_SNIPPET_CHARS // 4)
+    end = min(len(body), start + SEARCH_SNIPPET_CHARS)
+    snippet = body[start:end]
+    
+    ranges = []
+    window = lowered[start:end]
+    for term in terms:
+        pos = window.find(term)
+        while pos >= 0:
+            ranges.append([pos, pos + len(term)])
+            pos = window.find(term, pos + len(term))
+    ranges.sort()
+    merged = []
+    for r in ranges:
+        if merged and r[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], r[1])
+        else:
+            merged.append(r)
+    
+    prefix = "…" if start > 0 else ""
+    if prefix:
+        merged = [[a + 1, b + 1] for a, b in merged]
+    return {"snippet": prefix + snippet + ("…" if end < len(body) else ""), "highlights": merged}
+
+
+def search_messages(query: str, limit: int = 20, offset: int = 0, fields: list = None, conversation_id: str = None,
+                    user: str = DEFAULT_USER) -> dict:
+    """全文搜索用户的对话，按 BM25 相关度排序"""
+    match, terms = build_search_query(query)
+    if not match:
+        return {"items": [], "total": 0}
+    
+    clauses = ["search_fts MATCH ?", "d.user = ?"]
+    params = [match, user]
+    if fields:
+        clauses.append(f"d.field IN ({', '.join('?' for _ in fields)})")
+        params.extend(fields)
+    if conversation_id:
+        clauses.append("d.conversation_id = ?")
+        params.append(conversation_id)
+    where = " AND ".join(clauses)
+    
+    with _search_db_lock:
+        db = get_search_db()
+        total = db.execute(
+            f"SELECT COUNT(*) FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid WHERE {where}", params
+        ).fetchone()[0]
+        rows = db.execute(
+            f"SELECT d.*, bm25(search_fts) AS score FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid "
+            f"WHERE {where} ORDER BY score, d.updated_at DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        conv_ids = sorted({r["conversation_id"] for r in rows})
+        titles = {}
+        if conv_ids:
+            titles = {
+                r["conversation_id"]: r["body"]
+                for r in db.execute(
+                    f"SELECT conversation_id, body FROM search_docs WHERE field = 'title' "
+                    f"AND conversation_id IN ({', '.join('?' for _ in conv_ids)})", conv_ids
+                )
+            }
+    
+    items = []
+    for row in rows:
+        item = {
+            "conversation_id": row["conversation_id"],
+            "conversation_title": titles.get(row["conversation_id"]),
+            "message_index": row["position"] if row["position"] >= 0 else None,
+            "message_id": row["message_id"],
+            "role": row["role"],
+            "field": row["field"],
+            "score": round(-row["score"], 4),
+            "updated_at": datetime.fromtimestamp(row["updated_at"]).isoformat()
+        }
+        item.update(make_search_snippet(row["body"], terms))
+        items.append(item)
+    return {"items": items, "total": total}
+
+
+def reindex_search(verbose: bool = False) -> int:
+    """重建全文索引（已有且未变化的字段会被跳过），返回处理的对话数"""
+    live_ids = {p.stem for user in iter_tenants() for p in conversations_dir(user).glob("*.json")}
+    with _search_db_lock:
+        stale = [r[0] for r in get_search_db().execute("SELECT DISTINCT conversation_id FROM search_docs")
+                 if r[0] not in live_ids]
+    for conv_id in stale:
+        forget_conversation_text(conv_id)
+    i = 0
+    for i, conv in enumerate(iter_stored_conversations(), 1):
+        conv["nodes"] = {k: expand_message(conv["id"], m) for k, m in conv.get("nodes", {}).items()}
+        index_conversation_text(conv)
+        if verbose and i % 200 == 0:
+            print(f"  已索引 {i} 个对话")
+    return i
+
+
+def start_search_reindex():
+    """全文索引首次创建（或分词规则变化）时，在后台为已有对话建立索引"""
+    with _search_db_lock:
+        get_search_db()
+    if not _search_rebuild_needed:
+        return
+    
+    def run():
+        try:
+            count = reindex_search()
+            if count:
+                print(f"🔎 已为 {count} 个对话建立全文索引")
+        except Exception as e:
+            print(f"⚠️ 建立全文索引失败: {e}")
+    
+    threading.Thread(target=run, name="search-reindex", daemon=True).start()
+
+
+# ============ 导出与导入 ============
+# 归档为 tar 流，按对话依次写入，全程流式读写，内存占用与归档大小无关：
+#   manifest.json                         格式与版本
+#   blobs/<sha256>                        文件内容，相同内容只写一次（跨对话去重）
+#   details/<对话ID>/<消息ID>.json.gz     外置的消息详情（原样）
+#   conversations/<对话ID>.assets.json    该对话引用的文件：[{root, filename, sha256}]
+#   conversations/<对话ID>.json           对话消息树，最后写入，作为该对话的提交标记
+# 导入时每提交一个对话就记录归档中的字节偏移（data/imports/<导入ID>.json），中断后从该位置继续；
+# 已导入的文件和消息会被跳过，重复导入同一归档不会产生重复数据。
+
+ARCHIVE_FORMAT = "nanobanana-archive"
+ARCHIVE_VERSION = 1
+ARCHIVE_ROOTS = {"uploads": UPLOADS_DIR, "generated": GENERATED_DIR}
+_BLOB_NAME = re.compile(r"^[0-9a-f]{64}$")
+_import_lock = threading.Lock()  # 同一时间只执行一个导入
+_running_imports = set()  # 正在后台执行的导入 ID
+
+
+class ImportConflict(Exception):
+    """归档中的文件名已被其他用户的文件占用，导入后对话会引用看不到的文件"""
+
+
+def file_sha256(filepath: Path) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for block in iter(lambda: fp.read(STREAM_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tar_header(name: str, size: int, mtime: float = None) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime or time.time())
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def tar_bytes(name: str, data: bytes):
+    """tar 成员（内存中的小内容）"""
+    yield tar_header(name, len(data))
+    yield data
+    yield b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+
+
+def tar_file(name: str, fp, size: int, mtime: float = None):
+    """tar 成员（按块读取文件；文件在读取期间变短时补零，保证归档结构完整）"""
+    yield tar_header(name, size, mtime)
+    remaining = size
+    while remaining > 0:
+        block = fp.read(min(STREAM_BLOCK_SIZE, remaining)) or b"\0" * min(STREAM_BLOCK_SIZE, remaining)
+        remaining -= len(block)
+        yield block
+    yield b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def conversation_asset_files(conv: dict):
+    """对话引用的文件及其派生版本（model-ready 等），返回 [(root 名, 路径)]；缩略图可重新生成，不导出"""
+    files = {}
+    for msg in conversation_nodes(conv):
+        for name in message_asset_names(msg):
+            for root_name, root in ARCHIVE_ROOTS.items():
+                path = resolve_asset(root, name)
+                if not path:
+                    continue
+                stem = path.name.split(".")[0]
+                for candidate in path.parent.glob(f"{stem}.*"):
+                    if ".thumb." not in candidate.name and not candidate.name.endswith(".tmp"):
+                        files[(root_name, candidate.name)] = candidate
+                break
+    return sorted(files.items())
+
+
+def indexed_sha256(filename: str):
+    """元数据索引中记录的内容哈希，未索引返回 None"""
+    with _asset_db_lock:
+        row = get_asset_db().execute("SELECT sha256, bytes FROM assets WHERE filename = ?", (filename,)).fetchone()
+    return (row["sha256"], row["bytes"]) if row else (None, None)
+
+
+def iter_export_archive(conv_ids: list = None, user: str = DEFAULT_USER):
+    """生成导出归档的字节流（用户的对话）；conv_ids 为空时导出该用户的全部对话"""
+    written = 0
+    blobs = set()  # 已写入的内容哈希
+
+    def emit(chunks):
+        nonlocal written
+        for chunk in chunks:
+            written += len(chunk)
+            yield chunk
+    
+    manifest = {"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION, "created_at": datetime.now().isoformat()}
+    yield from emit(tar_bytes("manifest.json", json.dumps(manifest).encode("utf-8")))
+    
+    conversations = (read_conversation(i, user) for i in conv_ids) if conv_ids else iter_stored_conversations(user)
+    for conv in conversations:
+        if not conv:
+            continue
+        assets = []
+        for (root_name, name), path in conversation_asset_files(conv):
+            try:
+                fp = open(path, "rb")
+            except OSError:
+                continue  # 导出期间被回收
+            with fp:
+                size = os.fstat(fp.fileno()).st_size
+                sha, indexed_bytes = indexed_sha256(name)
+                if not sha or indexed_bytes != size:
+                    sha = file_sha256(path)
+                if sha not in blobs:
+                    yield from emit(tar_file(f"blobs/{sha}", fp, size, path.stat().st_mtime))
+                    blobs.add(sha)
+            assets.append({"root": root_name, "filename": name, "sha256": sha})
+        
+        for msg in conversation_nodes(conv):
+            path = details_path(conv["id"], msg["id"]) if msg.get("details") else None
+            if path and path.exists():
+                with open(path, "rb") as fp:
+                    yield from emit(tar_file(f"details/{conv['id']}/{path.name}", fp, os.fstat(fp.fileno()).st_size))
+        
+        yield from emit(tar_bytes(f"conversations/{conv['id']}.assets.json", json.dumps(assets).encode("utf-8")))
+        yield from emit(tar_bytes(f"conversations/{conv['id']}.json", json.dumps(conv, ensure_ascii=False).encode("utf-8")))
+    
+    # 结束标记（两个空块），并补齐到 tar 记录大小
+    end = tarfile.BLOCKSIZE * 2
+    yield b"\0" * (end + (-(written + end) % tarfile.RECORDSIZE))
+
+
+def import_checkpoint_path(import_id: str) -> Path:
+    return IMPORTS_DIR / f"{Path(import_id).name}.json"
+
+
+def new_import_checkpoint(import_id: str, archive_path: Path, user: str) -> dict:
+    return {
+        "import_id": import_id, "archive": str(archive_path), "user": user, "offset": 0,
+        "conversations": 0, "skipped_conversations": 0, "assets": 0, "skipped_assets": 0, "done": False
+    }
+
+
+def load_import_checkpoint(import_id: str):
+    try:
+        return json.loads(import_checkpoint_path(import_id).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def save_import_checkpoint(checkpoint: dict):
+    path = import_checkpoint_path(checkpoint["import_id"])
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(checkpoint, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def copy_member(tar, member, target: Path):
+    """把归档成员流式写到目标路径（先写临时文件再替换）"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+    with tar.extractfile(member) as src, open(tmp_path, "wb") as dst:
+        for block in iter(lambda: src.read(STREAM_BLOCK_SIZE), b""):
+            dst.write(block)
+    os.replace(tmp_path, target)
+
+
+def merge_imported_conversation(imported: dict, user: str = DEFAULT_USER):
+    """把导入的对话合并进用户的对话：不存在则新建；已存在则只补充本地没有的消息节点，保留本地的当前分支
+
+    同一对话 ID 已属于其他用户时跳过，返回 None
+    """
+    owner = conversation_owner(imported["id"])
+    if owner not in (None, user):
+        return None
+    with store_lock(user):
+        conv = read_conversation(imported["id"], user)
+        old_view = conversation_view(conv) if conv else None
+        if conv:
+            for node_id, node in imported.get("nodes", {}).items():
+                conv.setdefault("nodes", {}).setdefault(node_id, node)
+        else:
+            conv = {**imported, "owner": user, "seq": 0}
+        publish_conversation(conv, old_view)
+    link_conversation_assets(conv["id"], conversation_nodes(conv))
+    expanded = {**conv, "nodes": {k: expand_message(conv["id"], m) for k, m in conv.get("nodes", {}).items()}}
+    update_search_index(expanded)
+    return conv
+
+
+def import_archive(archive_path: Path, import_id: str, user: str = DEFAULT_USER, verbose: bool = False) -> dict:
+    """把归档导入到用户名下（可重复调用：从上次提交的对话之后继续），返回导入统计"""
+    checkpoint = load_import_checkpoint(import_id) or new_import_checkpoint(import_id, archive_path, user)
+    if checkpoint["done"]:
+        return checkpoint
+    checkpoint.pop("error", None)
+    staging = IMPORTS_DIR / f"{Path(import_id).name}.blobs"
+    staging.mkdir(parents=True, exist_ok=True)
+    
+    with open(archive_path, "rb") as fp:
+        base = checkpoint["offset"]
+        fp.seek(base)
+        with tarfile.open(fileobj=fp, mode="r|") as tar:
+            for member in tar:
+                tar.members = []  # 流式读取，不保留已读成员
+                name = member.name
+                if not member.isfile():
+                    continue
+                if name == "manifest.json":
+                    manifest = json.loads(tar.extractfile(member).read())
+                    if manifest.get("format") != ARCHIVE_FORMAT or manifest.get("version", 0) > ARCHIVE_VERSION:
+                        raise ValueError("不支持的归档格式")
+                elif name.startswith("blobs/"):
+                    sha = name[len("blobs/"):]
+                    if _BLOB_NAME.match(sha) and not (staging / sha).exists():
+                        copy_member(tar, member, staging / sha)
+                elif name.startswith("details/"):
+                    parts = name.split("/")
+                    # 先确认对话归属：属于其他用户的对话会被跳过，不写入它的详情文件
+                    if len(parts) == 3 and parts[2].endswith(".json.gz") and conversation_owner(parts[1]) in (None, user):
+                        target = details_path(parts[1], parts[2][:-len(".json.gz")])
+                        if not target.exists():
+                            copy_member(tar, member, target)
+                elif name.startswith("conversations/") and name.endswith(".assets.json"):
+                    conv_id = Path(name[:-len(".assets.json")]).name
+                    if conversation_owner(conv_id) not in (None, user):
+                        continue  # 对话属于其他用户，随后会被跳过，不导入它的文件
+                    for entry in json.loads(tar.extractfile(member).read()):
+                        root = ARCHIVE_ROOTS.get(entry.get("root"))
+                        filename = Path(str(entry.get("filename", ""))).name
+                        blob = staging / str(entry.get("sha256", ""))
+                        if not root or not filename or filename.startswith(".") or not _BLOB_NAME.match(blob.name):
+                            continue
+                        if resolve_asset(root, filename):
+                            owner = (get_asset_meta(filename) or {}).get("user", DEFAULT_USER)
+                            if owner != user:
+                                raise ImportConflict(f"文件 {filename} 已属于其他用户，无法导入到 {user} 名下")
+                            checkpoint["skipped_assets"] += 1
+                            continue
+                        if not blob.exists():
+                            checkpoint["skipped_assets"] += 1
+                            continue
+                        target = asset_path(root, filename, create=True)
+                        tmp_path = target.with_name(f"{filename}.{uuid.uuid4().hex[:8]}.tmp")
+                        shutil.copyfile(blob, tmp_path)
+                        os.replace(tmp_path, target)
+                        if filename.count(".") == 1:  # 派生版本（.model.jpg、PDF 页面等）不单独索引
+                            index_asset(target, asset_kind(filename, root), {"user": user})
+                        checkpoint["assets"] += 1
+                elif name.startswith("conversations/") and name.endswith(".json"):
+                    conv = json.loads(tar.extractfile(member).read())
+                    if not isinstance(conv, dict) or not conv.get("id") or not isinstance(conv.get("nodes"), dict):
+                        raise ValueError(f"对话数据无效: {name}")
+                    conv["id"] = Path(str(conv["id"])).name
+                    if merge_imported_conversation(conv, user):
+                        checkpoint["conversations"] += 1
+                    else:
+                        checkpoint["skipped_conversations"] = checkpoint.get("skipped_conversations", 0) + 1
+                    # 对话提交后记录下一个成员的位置，中断后从这里继续
+                    checkpoint["offset"] = base + tar.offset
+                    save_import_checkpoint(checkpoint)
+                    if verbose and checkpoint["conversations"] % 50 == 0:
+                        print(f"  已导入 {checkpoint['conversations']} 个对话")
+    
+    checkpoint["done"] = True
+    save_import_checkpoint(checkpoint)
+    shutil.rmtree(staging, ignore_errors=True)
+    print(f"📥 导入完成: {checkpoint['conversations']} 个对话，{checkpoint['assets']} 个文件")
+    return checkpoint
+
+
+# ============ 上传入库处理 ============
+# 上传时一次性完成：识别真实格式、按 EXIF 旋转、拒绝损坏文件和解压炸弹，
+# 并在原图旁生成 <名称>.model.jpg/png（最长边不超过 MODEL_INPUT_MAX_EDGE），
+# 之后每轮生成都发送该版本，而不是原始的大尺寸照片。
+
+def model_variant_path(filepath: Path, ext: str) -> Path:
+    """model-ready 版本的文件路径（与原图同目录）"""
+    return filepath.with_name(f"{filepath.name.split('.')[0]}.model{ext}")
+
+
+def find_model_variant(filepath: Path):
+    """查找已生成的 model-ready 版本，返回 (路径, MIME) 或 None"""
+    for ext, mime_type in ((".jpg", "image/jpeg"), (".png", "image/png")):
+        variant = model_variant_path(filepath, ext)
+        if variant.exists():
+            return variant, mime_type
+    return None
+
+
+def ingest_image(filepath: Path, full_check: bool = True) -> dict:
+    """校验图片并在需要时生成 model-ready 版本（在 ingest 线程池中执行）
+
+    返回 {"mime_type", "width", "height", "model_path", "model_mime_type"}（PDF 另有 "page_count"），
+    文件无效或像素过大时抛出 ValueError
+    """
+    from PIL import Image, ImageOps
+    
+    if is_pdf(filepath):
+        # PDF 只读取页数（同时校验文件能否打开），页面在按页发送或请求缩略图时再渲染
+        return {"mime_type": "application/pdf", "width": None, "height": None,
+                "model_path": filepath, "model_mime_type": "application/pdf",
+                "page_count": pdf_page_count(filepath)}
+    
+    try:
+        with Image.open(filepath) as img:
+            # Image.open 只读取文件头，在真正解码前检查像素数
+            width, height = img.size
+            if width * height > INGEST_MAX_PIXELS:
+                raise ValueError(f"图片像素过大 ({width}x{height})，已拒绝")
+            
+            fmt = img.format
+            mime_type = Image.MIME.get(fmt, "application/octet-stream")
+            orientation = img.getexif().get(0x0112, 1)  # EXIF Orientation
+            needs_variant = (
+                fmt not in MODEL_READY_FORMATS
+                or orientation not in (0, 1)
+                or max(width, height) > MODEL_INPUT_MAX_EDGE
+                or getattr(img, "n_frames", 1) > 1
+            )
+            
+            if not needs_variant:
+                if full_check:
+                    img.load()  # 完整解码一次，截断或损坏的文件在此报错
+                return {"mime_type": mime_type, "width": width, "height": height,
+                        "model_path": filepath, "model_mime_type": mime_type}
+            
+            img.load()
+            out = ImageOps.exif_transpose(img)
+            width, height = out.size
+            out.thumbnail((MODEL_INPUT_MAX_EDGE, MODEL_INPUT_MAX_EDGE), Image.LANCZOS)
+            has_alpha = out.mode in ("RGBA", "LA") or (out.mode == "P" and "transparency" in out.info)
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"⚠️ 图片校验失败: {filepath.name} ({e})")
+        raise ValueError("无法识别的图片文件或文件已损坏")
+    
+    if has_alpha:
+        ext, model_mime, save_kwargs = ".png", "image/png", {"format": "PNG", "optimize": True}
+        out = out.convert("RGBA")
+    else:
+        ext, model_mime, save_kwargs = ".jpg", "image/jpeg", {"format": "JPEG", "quality": 90}
+        out = out.convert("RGB")
+    
+    variant = model_variant_path(filepath, ext)
+    tmp_path = variant.with_name(variant.name + ".tmp")
+    out.save(tmp_path, **save_kwargs)
+    os.replace(tmp_path, variant)
+    print(f"🗜️ 已生成 model-ready 图片: {variant.name} ({out.size[0]}x{out.size[1]})")
+    
+    return {"mime_type": mime_type, "width": width, "height": height,
+            "model_path": variant, "model_mime_type": model_mime}
+
+
+@traced("load_input")
+def load_model_input(filepath: Path, mime_type: str) -> tuple:
+    """读取要发送给模型的文件，返回 (bytes, mime_type)
+
+    图片优先使用 model-ready 版本；尚未处理过的图片（如历史生成图）在此补做一次
+    """
+    variant = find_model_variant(filepath)
+    if variant:
+        path, mime_type = variant
+    else:
+        try:
+            info = _ingest_pool.submit(ingest_image, filepath, False).result()
+            path, mime_type = info["model_path"], info["model_mime_type"]
+        except ValueError as e:
+            print(f"⚠️ 图片预处理失败，发送原文件: {filepath.name} ({e})")
+            path = filepath
+    
+    with open(path, "rb") as fp:
+        return fp.read(), mime_type
+
+
+def load_file_inputs(filepath: Path, file_ref: dict) -> list:
+    """请求 files 中的一项要发送给模型的内容，返回 [(bytes, mime_type)]
+
+    PDF 指定了 pages 时每个选中的页一张图片，否则整个文件一项
+    """
+    pages = file_ref.get("pages")
+    if not pages:
+        return [load_model_input(filepath, file_ref.get("mime_type", ""))]
+    inputs = []
+    for page in pages:
+        page_path = _ingest_pool.submit(render_pdf_page, filepath, page).result()
+        inputs.append((page_path.read_bytes(), "image/jpeg"))
+    size = sum(len(data) for data, _ in inputs)
+    print(f"📄 PDF 按页发送: {filepath.name} 第 {format_page_selection(pages)} 页 ({size / 1024:.0f} KB)")
+    return inputs
+
+
+# ============ PDF 按页处理 ============
+# 上传 PDF 时读取页数；请求 files 中的条目可以带 "pages"（如 [1, 3] 或 "1-3,5"，页码从 1 开始），
+# 此时只把选中的页渲染为图片发送给模型，而不是每轮都发送整份 PDF。
+# 渲染结果与原文件同目录缓存为 <id>.page<N>.jpg（最长边不超过 MODEL_INPUT_MAX_EDGE），
+# 页面缩略图为 <id>.page<N>.thumb.jpg，都是可重新生成的派生版本。
+# 渲染依赖可选的 pypdfium2，未安装时 PDF 只能整份发送。
+
+_pdf_lock = threading.Lock()  # pdfium 不是线程安全的，同一时间只处理一个文档
+
+
+def pdfium_module():
+    """pypdfium2 为可选依赖，未安装时返回 None"""
+    try:
+        import pypdfium2
+        return pypdfium2
+    except ImportError:
+        return None
+
+
+def is_pdf(filepath: Path) -> bool:
+    """按文件头判断是否为 PDF"""
+    with open(filepath, "rb") as fp:
+        return fp.read(5) == b"%PDF-"
+
+
+def pdf_page_path(filepath: Path, page: int, suffix: str = "jpg") -> Path:
+    """PDF 页面渲染结果（或缩略图）的缓存路径（与原文件同目录）"""
+    return filepath.with_name(f"{filepath.name.split('.')[0]}.page{page}.{suffix}")
+
+
+@functools.lru_cache(maxsize=256)
+def _read_pdf_page_count(path: str, mtime: float) -> int:
+    pdfium = pdfium_module()
+    with _pdf_lock:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def pdf_page_count(filepath: Path):
+    """PDF 页数；未安装 pypdfium2 时返回 None，文件损坏或加密时抛出 ValueError"""
+    if not pdfium_module():
+        return None
+    try:
+        return _read_pdf_page_count(str(filepath), filepath.stat().st_mtime)
+    except Exception as e:
+        print(f"⚠️ 读取 PDF 失败: {filepath.name} ({e})")
+        raise ValueError("无法读取 PDF 文件（文件已损坏或已加密）")
+
+
+def parse_page_selection(value, page_count: int) -> list:
+    """解析页码选择（页码列表或 "1-3,5" 形式的字符串），返回去重后的页码，格式错误或越界时抛出 ValueError"""
+    items = value.split(",") if isinstance(value, str) else value
+    if not isinstance(items, list):
+        raise ValueError("pages 格式错误")
+    pages = []
+    for item in items:
+        try:
+            if isinstance(item, str) and "-" in item.strip()[1:]:
+                start, end = (int(part) for part in item.split("-", 1))
+            else:
+                start = end = int(item)
+        except (TypeError, ValueError):
+            raise ValueError(f"无效的页码: {item}")
+        if start < 1 or end > page_count or start > end:
+            raise ValueError(f"页码超出范围（共 {page_count} 页）: {item}")
+        for page in range(start, end + 1):
+            if page not in pages:
+                pages.append(page)
+            if len(pages) > PDF_MAX_SELECTED_PAGES:
+                raise ValueError(f"每个 PDF 一次最多选择 {PDF_MAX_SELECTED_PAGES} 页")
+    if not pages:
+        raise ValueError("没有选择任何页")
+    return pages
+
+
+def format_page_selection(pages: list) -> str:
+    """把页码列表压缩为 "1-3,5" 形式（用于日志和显示）"""
+    ranges = []
+    for page in sorted(pages):
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def normalize_page_selections(files: list):
+    """校验请求 files 中的 pages 并规范为页码列表，返回错误信息或 None"""
+    for f in files:
+        if not f.get("pages"):
+            continue
+        filepath = find_image_file(str(f.get("filename", "")))
+        if not filepath or not is_pdf(filepath):
+            return f"只有 PDF 文件可以选择页码: {f.get('filename')}"
+        try:
+            page_count = pdf_page_count(filepath)
+            if page_count is None:
+                return "服务器未安装 pypdfium2，无法按页选择 PDF"
+            f["pages"] = parse_page_selection(f["pages"], page_count)
+        except ValueError as e:
+            return str(e)
+    return None
+
+
+@traced("render_pdf_page")
+def render_pdf_page(filepath: Path, page: int) -> Path:
+    """把 PDF 的一页渲染为 JPEG 并缓存（在 ingest 线程池中执行），返回缓存路径"""
+    target = pdf_page_path(filepath, page)
+    if target.exists():
+        return target
+    pdfium = pdfium_module()
+    if not pdfium:
+        raise ValueError("服务器未安装 pypdfium2，无法渲染 PDF 页面")
+    
+    with _pdf_lock:
+        pdf = pdfium.PdfDocument(str(filepath))
+        try:
+            pdf_page = pdf[page - 1]
+            width, height = pdf_page.get_size()  # 单位为点（1/72 英寸）
+            scale = min(PDF_RENDER_DPI / 72, MODEL_INPUT_MAX_EDGE / max(width, height, 1))
+            img = pdf_page.render(scale=scale).to_pil().convert("RGB")
+        finally:
+            pdf.close()
+    
+    tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+    img.save(tmp_path, format="JPEG", quality=90)
+    os.replace(tmp_path, target)
+    print(f"📄 已渲染 PDF 页面: {target.name} ({img.size[0]}x{img.size[1]})")
+    return target
+
+
+# ============ 派生版本预设 ============
+# renditions.json 中配置的预设（社交平台尺寸、网页 JPEG/WebP、打印 PNG 等）在最终图片保存后自动执行：
+# 依次按比例居中裁剪（aspect）、缩放（scale / width / height / max_edge）、转换格式和质量（format / quality / dpi），
+# 并可写入生成信息（metadata）。处理在独立的进程池中进行，不占用生成请求；
+# 结果与原图同目录保存为 <id>.<预设名>.<扩展名>，进度通过 /api/renditions/<文件名>/events 推送。
+
+RENDITION_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+RENDITION_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9_-]{0,31}$")
+RENDITION_RESERVED_NAMES = re.compile(r"^(model|thumb|page\d+)$")  # 与已有的派生文件名冲突
+RENDITION_JOB_HISTORY = 500  # 内存中保留进度的原图数量
+RENDITION_SOFTWARE = "Nanobanana Pro Image Generator"
+
+_rendition_pool = None
+_rendition_pool_lock = threading.Lock()
+_rendition_jobs = OrderedDict()  # 原图文件名 -> {预设名: 状态}
+_rendition_cond = threading.Condition()
+
+
+def parse_rendition_preset(name: str, preset: dict) -> dict:
+    """校验并规范一个预设，格式错误时抛出 ValueError"""
+    if not RENDITION_NAME.match(name) or RENDITION_RESERVED_NAMES.match(name):
+        raise ValueError("预设名只能包含字母、数字、下划线和连字符，且不能是 model/thumb/pageN")
+    if not isinstance(preset, dict):
+        raise ValueError("预设必须是对象")
+    fmt = str(preset.get("format", "JPEG")).upper().replace("JPG", "JPEG")
+    if fmt not in RENDITION_FORMATS:
+        raise ValueError(f"不支持的格式: {fmt}")
+    result = {
+        "format": fmt,
+        "quality": max(1, min(100, int(preset.get("quality", 90)))),
+        "auto": bool(preset.get("auto", True)),
+        "background": str(preset.get("background", "#ffffff")),
+    }
+    if preset.get("aspect"):
+        width, height = (float(x) for x in str(preset["aspect"]).split(":"))
+        if width <= 0 or height <= 0:
+            raise ValueError(f"无效的比例: {preset['aspect']}")
+        result["aspect"] = [width, height]
+    for field in ("width", "height", "max_edge", "dpi"):
+        if preset.get(field):
+            value = int(preset[field])
+            if not 0 < value <= 16384:
+                raise ValueError(f"{field} 超出范围: {value}")
+            result[field] = value
+    if preset.get("scale"):
+        result["scale"] = float(preset["scale"])
+        if not 0 < result["scale"] <= 8:
+            raise ValueError(f"scale 超出范围: {result['scale']}")
+    metadata = preset.get("metadata")
+    if metadata:
+        result["metadata"] = {str(k): str(v) for k, v in metadata.items()} if isinstance(metadata, dict) else {}
+    return result
+
+
+def load_rendition_presets() -> dict:
+    """读取预设文件，无效的预设跳过并记录日志"""
+    try:
+        raw = json.loads(RENDITION_PRESETS_FILE.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 读取派生版本预设失败: {RENDITION_PRESETS_FILE} ({e})")
+        return {}
+    presets = {}
+    for name, preset in (raw.items() if isinstance(raw, dict) else ()):
+        try:
+            presets[name] = parse_rendition_preset(name, preset)
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ 派生版本预设 {name} 无效，已跳过 ({e})")
+    if presets:
+        print(f"🎞️ 已加载 {len(presets)} 个派生版本预设: {', '.join(presets)}")
+    return presets
+
+
+RENDITION_PRESETS = {}  # 由 init_app 读取
+
+
+def rendition_path(filepath: Path, preset_name: str) -> Path:
+    """派生版本的保存路径（与原图同目录）"""
+    ext = RENDITION_FORMATS[RENDITION_PRESETS[preset_name]["format"]]
+    return filepath.with_name(f"{filepath.name.split('.')[0]}.{preset_name}{ext}")
+
+
+def get_rendition_pool() -> ProcessPoolExecutor:
+    """派生版本处理进程池（首次使用时创建，进程异常退出后重建）"""
+    global _rendition_pool
+    with _rendition_pool_lock:
+        if _rendition_pool is None:
+            # spawn 启动的子进程不继承 fork 时其他线程持有的锁（SQLite、日志、线程池），避免子进程死锁
+            _rendition_pool = ProcessPoolExecutor(
+                max_workers=RENDITION_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _rendition_pool
+
+
+def reset_rendition_pool(pool: ProcessPoolExecutor):
+    global _rendition_pool
+    with _rendition_pool_lock:
+        if _rendition_pool is pool:
+            _rendition_pool = None
+    pool.shutdown(wait=False)
+
+
+def request_renditions(data: dict) -> list:
+    """请求要生成的派生版本：renditions 为预设名列表时只生成这些，为 false 或 [] 时不生成，未指定时生成 auto 预设"""
+    value = data.get("renditions")
+    if value is None:
+        return [name for name, preset in RENDITION_PRESETS.items() if preset["auto"]]
+    if not isinstance(value, list):
+        return []
+    return [name for name in dict.fromkeys(str(v) for v in value) if name in RENDITION_PRESETS]
+
+
+def rendition_entry(filepath: Path, preset_name: str, status: str) -> dict:
+    path = rendition_path(filepath, preset_name)
+    return {"preset": preset_name, "status": status, "filename": path.name, "path": f"/generated/{path.name}"}
+
+
+def update_rendition_job(filename: str, preset_name: str, **fields):
+    with _rendition_cond:
+        job = _rendition_jobs.get(filename)
+        if job is not None and preset_name in job:
+            job[preset_name].update(fields, updated=time.monotonic())
+            _rendition_cond.notify_all()
+
+
+def start_renditions(filepath: Path, preset_names: list, asset_meta: dict = None) -> list:
+    """把最终图片提交到进程池生成派生版本（不等待完成），返回各预设的初始状态"""
+    if not preset_names:
+        return []
+    meta = asset_meta or {}
+    stamp = {
+        "prompt": meta.get("prompt") or "",
+        "mode": meta.get("mode") or "",
+        "source": filepath.name,
+        "model": "gemini-3-pro-image-preview",
+        "software": RENDITION_SOFTWARE,
+        "created": datetime.now().strftime("%Y:%m:%d %H:%M:%S"),
+    }
+    # 派生版本按原图所属用户写入索引，计入该用户的存储配额
+    index_meta = {"user": meta.get("user") or DEFAULT_USER, "conversation_id": meta.get("conversation_id"),
+                  "message_id": meta.get("message_id"), "parent": filepath.name}
+    entries = [rendition_entry(filepath, name, "queued") for name in preset_names]
+    with _rendition_cond:
+        _rendition_jobs[filepath.name] = {e["preset"]: dict(e, updated=time.monotonic()) for e in entries}
+        _rendition_jobs.move_to_end(filepath.name)
+        while len(_rendition_jobs) > RENDITION_JOB_HISTORY:
+            _rendition_jobs.popitem(last=False)
+    
+    pool = get_rendition_pool()
+    for entry in entries:
+        name = entry["preset"]
+        target = filepath.with_name(entry["filename"])
+        try:
+            future = pool.submit(render_rendition, str(filepath), str(target), RENDITION_PRESETS[name], stamp)
+        except Exception as e:  # 进程池已损坏（如子进程被杀），重建后下次再试
+            reset_rendition_pool(pool)
+            update_rendition_job(filepath.name, name, status="error", error=str(e))
+            continue
+        
+        def done(fut, name=name, target=target):
+            try:
+                result = fut.result()
+            except Exception as e:
+                print(f"⚠️ 派生版本 {name} 生成失败: {filepath.name} ({e})")
+                update_rendition_job(filepath.name, name, status="error", error=str(e) or type(e).__name__)
+                return
+            index_asset(target, "rendition", index_meta)
+            update_rendition_job(filepath.name, name, status="done", **result)
+        future.add_done_callback(done)
+    print(f"🎞️ 已提交派生版本: {filepath.name} -> {', '.join(preset_names)}")
+    return entries
+
+
+def rendition_status(filepath: Path) -> list:
+    """图片各预设的派生版本状态：进行中的任务来自内存，已完成的文件从磁盘确认"""
+    with _rendition_cond:
+        job = {name: dict(entry) for name, entry in _rendition_jobs.get(filepath.name, {}).items()}
+    items = []
+    for name in RENDITION_PRESETS:
+        entry = job.get(name)
+        if entry is None:
+            path = rendition_path(filepath, name)
+            if not path.exists():
+                continue
+            entry = rendition_entry(filepath, name, "done")
+            entry["bytes"] = path.stat().st_size
+        entry.pop("updated", None)
+        items.append(entry)
+    return items
+
+
+def wait_rendition_change(filename: str, since: float, timeout: float) -> bool:
+    """等待该图片的派生任务在 since 之后有状态变化，超时返回 False"""
+    def changed():
+        return any(e["updated"] > since for e in _rendition_jobs.get(filename, {}).values())
+    with _rendition_cond:
+        return _rendition_cond.wait_for(changed, timeout)
+
+
+# ============ 静态资源与响应压缩 ============
+# python app.py build-assets（服务启动时也会自动执行）把 STATIC_BUNDLE 中的文件按内容哈希复制为
+# static/dist/<路径>.<哈希>.<扩展名>，并预先压缩出 .gz（安装了 brotli 时还有 .br），映射写入 static/dist/manifest.json。
+# 页面通过 asset_url() 引用带哈希的文件名，/assets/ 按 Accept-Encoding 返回预压缩版本并允许永久缓存，
+# 每次部署内容变化时文件名随之变化，不会读到旧版本。
+# JSON 响应超过 RESPONSE_COMPRESS_MIN_BYTES 时按 Accept-Encoding 即时压缩（SSE 流不压缩）。
+
+STATIC_BUNDLE = ("css/style.css", "js/main.js")
+STATIC_DIST_DIR = BASE_DIR / "static" / "dist"
+STATIC_MANIFEST_FILE = STATIC_DIST_DIR / "manifest.json"
+STATIC_DIST_RETENTION = 7 * 24 * 3600  # 旧版本文件保留 7 天（已打开的页面可能还在引用）
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", 1024))
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5  # 即时压缩用较低的等级，预压缩用最高等级
+
+_static_manifest = {}  # 源路径 -> 带哈希的路径
+
+
+def brotli_module():
+    """brotli 为可选依赖，未安装时返回 None（只使用 gzip）"""
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def build_static_assets(verbose: bool = False) -> dict:
+    """生成带哈希的静态文件和预压缩版本，返回新的映射；内容未变的文件不会重写"""
+    static_dir = Path(app.static_folder)
+    brotli = brotli_module()
+    manifest = {}
+    for source in STATIC_BUNDLE:
+        data = (static_dir / source).read_bytes()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, ext = os.path.splitext(source)
+        target_name = f"{stem}.{digest}{ext}"
+        target = STATIC_DIST_DIR / target_name
+        manifest[source] = target_name
+        if target.exists():
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        variants = {"": data, ".gz": gzip.compress(data, 9)}
+        if brotli:
+            variants[".br"] = brotli.compress(data, quality=11)
+        # 先写压缩版本，最后写原文件（原文件存在即表示该版本已完整生成）
+        for suffix in sorted(variants, key=lambda s: s == ""):
+            tmp_path = target.with_name(f"{target.name}{suffix}.tmp")
+            tmp_path.write_bytes(variants[suffix])
+            os.replace(tmp_path, target.with_name(target.name + suffix))
+        if verbose:
+            sizes = ", ".join(f"{s or '原始'} {len(v) / 1024:.1f} KB" for s, v in variants.items())
+            print(f"  {source} -> {target_name}（{sizes}）")
+    
+    tmp_path = STATIC_MANIFEST_FILE.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    os.replace(tmp_path, STATIC_MANIFEST_FILE)
+    
+    # 清理不再引用且超过保留期的旧版本
+    current = {STATIC_DIST_DIR / name for name in manifest.values()}
+    deadline = time.time() - STATIC_DIST_RETENTION
+    for path in STATIC_DIST_DIR.rglob("*.*"):
+        base = path.with_name(path.name.removesuffix(".gz").removesuffix(".br"))
+        if path != STATIC_MANIFEST_FILE and base not in current and path.stat().st_mtime < deadline:
+            path.unlink(missing_ok=True)
+    
+    _static_manifest.clear()
+    _static_manifest.update(manifest)
+    return manifest
+
+
+def load_static_manifest():
+    """读取已生成的映射（生成失败或未生成时页面退回未压缩的原始文件）"""
+    try:
+        _static_manifest.update(json.loads(STATIC_MANIFEST_FILE.read_text(encoding="utf-8")))
+    except (OSError, ValueError):
+        pass
+
+
+def asset_url(source: str) -> str:
+    """页面中引用静态文件的地址：有带哈希的版本时用 /assets/，否则用原始路径
+
+    调试模式（FLASK_DEBUG=1）下总是用原始路径：开发时修改的 main.js/style.css 刷新即生效，不会读到启动时生成的旧版本
+    """
+    name = None if app.debug else _static_manifest.get(source)
+    return f"/assets/{name}" if name else f"/static/{source}"
+
+
+def accepted_encoding(available: tuple = ("br", "gzip")):
+    """按 Accept-Encoding 选择压缩方式（优先 brotli），都不接受时返回 None"""
+    accept = request.accept_encodings
+    for encoding in available:
+        if accept[encoding] and (encoding != "br" or brotli_module()):
+            return encoding
+    return None
+
+
+def compress_response(response):
+    """按需压缩 JSON 响应；ETag 改为弱校验，压缩前后都可用 If-None-Match 命中"""
+    if (response.mimetype != "application/json" or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    encoding = accepted_encoding() if len(data) >= RESPONSE_COMPRESS_MIN_BYTES else None
+    if not encoding:
+        return response
+    if encoding == "br":
+        data = brotli_module().compress(data, quality=RESPONSE_BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, RESPONSE_GZIP_LEVEL)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ============ 初始化 ============
+# 启动时的副作用集中在 init_app：创建数据目录、清理临时文件、迁移旧版对话、创建线程池、读取预设和静态资源映射。
+# 派生版本进程池以 spawn 启动子进程，python app.py 启动时子进程会以 __mp_main__ 重新执行本文件，
+# 子进程只需要 rendition_worker 中的执行目标，因此跳过初始化。
+
+def init_app():
+    """执行启动时的初始化（导入模块时自动调用一次）"""
+    global _ingest_pool, _writer_pool, RENDITION_PRESETS
+    
+    # 确保目录存在
+    for dir_path in [DATA_DIR, CONVERSATIONS_DIR, TENANTS_DIR, IMPORTS_DIR, UPLOADS_DIR, GENERATED_DIR, PARTIAL_UPLOADS_DIR, SPILL_DIR, DETAILS_DIR]:
+        dir_path.mkdir(parents=True, exist_ok=True)
+    
+    # 清理上次运行遗留的临时落盘文件（保留最近一小时的，避免误删其他进程正在使用的）
+    for leftover in SPILL_DIR.glob("*.bin"):
+        if leftover.stat().st_mtime < time.time() - 3600:
+            leftover.unlink(missing_ok=True)
+    
+    _ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+    _writer_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="writer")
+    migrate_legacy_conversations()
+    RENDITION_PRESETS = load_rendition_presets()
+    load_static_manifest()
+
+
+if __name__ != "__mp_main__":
+    init_app()
+
+# ============ 路由 ============
+
+@app.before_request
+def authenticate_request():
+    """识别请求所属的用户；配置了访问令牌时，除主页和静态文件外的请求都需要有效令牌"""
+    g.user = authenticate_user()
+    if g.user is None and request.endpoint not in ("index", "static", "service_worker"):
+        return jsonify({"error": "需要有效的访问令牌"}), 401
+
+
+@app.before_request
+def start_request_trace():
+    """为请求创建性能时间线"""
+    if request.endpoint not in UNTRACED_ENDPOINTS:
+        start_trace(g.user or DEFAULT_USER)
+
+
+@app.after_request
+def finish_request_trace(response):
+    """响应发送完毕后结束时间线；SSE 流记录首字节时间和发送的字节数"""
+    trace = current_trace()
+    if trace is None:
+        return response
+    trace.status = response.status_code
+    if response.mimetype == "text/event-stream":
+        response.response = traced_body(trace, response.response)
+    else:
+        trace.response_bytes = response.content_length or 0
+    response.headers["X-Trace-Id"] = trace.id
+    response.call_on_close(lambda: finish_trace(trace))
+    return response
+
+
+@app.after_request
+def compress_json_response(response):
+    return compress_response(response)
+
+
+@app.context_processor
+def inject_asset_url():
+    return {"asset_url": asset_url}
+
+
+@app.route("/")
+def index():
+    """主页；?token=<令牌> 时写入 Cookie 后跳转，之后页面和图片请求都带上该令牌"""
+    token = request.args.get("token")
+    if token and USER_TOKENS:
+        if token not in USER_TOKENS:
+            return "访问令牌无效", 401
+        response = redirect("/")
+        response.set_cookie(USER_TOKEN_COOKIE, token, max_age=365 * 24 * 3600, httponly=True, samesite="Lax")
+        return response
+    if g.user is None:
+        return "需要访问令牌：请通过 /?token=<令牌> 打开", 401
+    response = app.make_response(render_template("index.html"))
+    response.cache_control.no_cache = True  # 页面每次确认，保证引用的是最新的静态文件
+    return response
+
+
+@app.route("/assets/<path:filename>")
+def serve_static_asset(filename):
+    """带内容哈希的静态文件：按 Accept-Encoding 返回预压缩版本，允许永久缓存"""
+    from werkzeug.security import safe_join
+    import mimetypes
+    
+    path = safe_join(str(STATIC_DIST_DIR), filename)
+    if not path or not os.path.isfile(path):
+        return jsonify({"error": "文件不存在"}), 404
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            response = send_from_directory(STATIC_DIST_DIR, filename + suffix, mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_from_directory(STATIC_DIST_DIR, filename, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@app.route("/sw.js")
+def service_worker():
+    """Service Worker（需从根路径提供才能缓存 /api、/generated 等请求）"""
+    response = send_from_directory(Path(app.static_folder) / "js", "sw.js")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.route("/api/metrics")
+def get_metrics():
+    """运行指标（全局）：多用户时仅管理员，未配置 USER_TOKENS 的单用户部署中 default 用户可查看"""
+    user = request_user()
+    if not is_admin(user) and (USER_TOKENS or user != DEFAULT_USER):
+        return jsonify({"error": "需要管理员权限"}), 403
+    return jsonify({
+        "memory": memory_budget.snapshot(),
+        "scheduler": generation_scheduler.snapshot()
+    })
+
+
+def require_admin():
+    """非管理员请求返回 403 响应"""
+    if not is_admin(request_user()):
+        return jsonify({"error": "需要管理员权限"}), 403
+    return None
+
+
+@app.route("/api/debug/slow-requests", methods=["GET"])
+def get_slow_requests():
+    """耗时最长的请求（按耗时倒序，只含摘要，详情见 /api/debug/requests/<ID>）"""
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify({
+        "size": FLIGHT_RECORDER_SIZE,
+        "min_ms": FLIGHT_RECORDER_MIN_MS,
+        "items": [trace.summary() for trace in slow_requests()]
+    })
+
+
+@app.route("/api/debug/slow-requests", methods=["DELETE"])
+def clear_slow_requests():
+    """清空慢请求记录"""
+    denied = require_admin()
+    if denied:
+        return denied
+    with _flight_recorder_lock:
+        _flight_recorder.clear()
+    return jsonify({"success": True})
+
+
+@app.route("/api/debug/profiles")
+def get_recent_profiles():
+    """最近采样的请求（X-Profile: 1 触发或随机采样）"""
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify({"items": [trace.summary() for trace in reversed(_recent_profiles)]})
+
+
+@app.route("/api/debug/requests/<trace_id>")
+def get_request_trace(trace_id):
+    """单个请求的完整时间线：各阶段、模型分片到达时间和采样报告（响应头 X-Trace-Id 为其 ID）"""
+    denied = require_admin()
+    if denied:
+        return denied
+    trace = find_trace(trace_id)
+    if not trace:
+        return jsonify({"error": "记录不存在（可能不在最慢的请求中或已被替换）"}), 404
+    return jsonify(trace.detail())
+
+
+@app.route("/api/me")
+def get_current_user():
+    """当前用户及其限制（limit/quota 为 0 表示不限）"""
+    user = request_user()
+    return jsonify({
+        "user": user,
+        "active_generations": active_generation_count(user),
+        "max_concurrent_generations": TENANT_MAX_CONCURRENT_GENERATIONS,
+        "storage_bytes": tenant_storage_bytes(user),
+        "storage_quota_bytes": TENANT_STORAGE_QUOTA_BYTES
+    })
+
+
+@app.route("/api/assets/gc-report")
+def get_gc_report():
+    """资源回收预演报告（不删除文件，包含所有用户的文件，仅管理员）"""
+    denied = require_admin()
+    if denied:
+        return denied
+    plan = plan_asset_gc()
+    return jsonify({
+        "total_bytes": plan["total_bytes"],
+        "live_files": plan["live_files"],
+        "orphan_files": len(plan["orphans"]),
+        "orphan_bytes": sum(o["size"] for o in plan["orphans"]),
+        "eviction_files": len(plan["evictions"]),
+        "eviction_bytes": sum(e["size"] for e in plan["evictions"]),
+        "report": format_gc_report(plan)
+    })
+
+
+@app.route("/api/assets")
+def list_assets():
+    """按条件查询资源元数据（不解码图片）
+
+    过滤参数：kind, mode, aspect_ratio, image_size, prompt, conversation_id, message_id, parent, sha256
+    分页参数：limit（默认 50，最大 500）, offset
+    """
+    filters = {field: request.args.get(field) for field in ASSET_QUERY_FILTERS}
+    filters["user"] = request_user()
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        return jsonify({"error": "分页参数格式错误"}), 400
+    return jsonify({
+        "items": query_assets(filters, limit, offset),
+        "summary": summarize_assets(filters)
+    })
+
+
+@app.route("/api/assets/duplicates")
+def get_duplicate_report():
+    """生成图片的近似重复报告（不删除文件）"""
+    try:
+        max_distance = max(0, min(int(request.args.get("max_distance", DUPLICATE_MAX_DISTANCE)), 16))
+    except ValueError:
+        return jsonify({"error": "参数格式错误"}), 400
+    return jsonify(build_duplicate_report(max_distance, request_user()))
+
+
+@app.route("/api/assets/<filename>/similar")
+def get_similar_assets(filename):
+    """查找与指定图片视觉相似的图片，按汉明距离升序"""
+    try:
+        max_distance = max(0, min(int(request.args.get("max_distance", SIMILAR_MAX_DISTANCE)), 32))
+        limit = max(1, min(int(request.args.get("limit", 20)), 200))
+    except ValueError:
+        return jsonify({"error": "参数格式错误"}), 400
+    user = request_user()
+    items = find_similar_assets(filename, max_distance, limit, user) if asset_visible(filename, user) else None
+    if items is None:
+        return jsonify({"error": "该图片没有相似度索引"}), 404
+    return jsonify({"items": items})
+
+
+@app.route("/api/assets/<filename>")
+def get_asset(filename):
+    """查询单个文件的元数据"""
+    meta = get_asset_meta(filename)
+    if not meta or meta["user"] != request_user():
+        return jsonify({"error": "文件未索引"}), 404
+    return jsonify(meta)
+
+
+@app.route("/api/gallery")
+def get_gallery():
+    """跨对话浏览生成图片（游标分页，由元数据索引提供）
+
+    过滤参数：mode, aspect_ratio, image_size, conversation_id, from, to（ISO 日期/时间）
+    分页参数：limit（默认 50），cursor（上一页返回的 next_cursor）
+    """
+    filters = {field: request.args.get(field) for field in GALLERY_FILTERS}
+    filters["user"] = request_user()
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), GALLERY_MAX_LIMIT))
+    except ValueError:
+        return jsonify({"error": "分页参数格式错误"}), 400
+    try:
+        since = parse_date_bound(request.args.get("from"))
+        until = parse_date_bound(request.args.get("to"), end=True)
+        items, next_cursor = query_gallery(filters, limit, request.args.get("cursor"), since, until)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+
+@app.route("/api/search")
+def search():
+    """全文搜索对话内容（标题、提示词、回复、思考过程、搜索查询）
+
+    参数：q 查询词，field 限定字段（逗号分隔），conversation_id，limit（默认 20，最大 100），offset
+    """
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "请输入搜索内容"}), 400
+    fields = [f for f in request.args.get("field", "").split(",") if f in SEARCH_FIELDS]
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 100))
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        return jsonify({"error": "分页参数格式错误"}), 400
+    
+    started = time.perf_counter()
+    result = search_messages(query, limit, offset, fields, request.args.get("conversation_id"), request_user())
+    result["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return jsonify(result)
+
+
+@app.route("/api/usage")
+def get_usage():
+    """用量汇总
+
+    参数：group 汇总维度（day/conversation/mode/image_size/aspect_ratio/user/status，默认 day），
+    since/until 日期范围（YYYY-MM-DD），user 只看某个用户（仅管理员，其他用户只能看自己的），limit（默认 100，最大 1000）
+    """
+    group = request.args.get("group", "day")
+    if group not in USAGE_GROUPS:
+        return jsonify({"error": f"不支持的汇总维度: {group}"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+    except ValueError:
+        return jsonify({"error": "limit 格式错误"}), 400
+    user = request.args.get("user") if is_admin(request_user()) else request_user()
+    items = summarize_usage(group, request.args.get("since"), request.args.get("until"), user, limit)
+    return jsonify({"group": group, "items": items})
+
+
+@app.route("/api/usage/budget")
+def get_usage_budget():
+    """当前用户今天的 token 用量和预算（budget 为 0 表示不限）"""
+    user = request_user()
+    used = tokens_used_today(user)
+    budget = usage_budget(user)
+    return jsonify({
+        "user": user,
+        "used_tokens": used,
+        "budget_tokens": budget,
+        "remaining_tokens": max(0, budget - used) if budget else None
+    })
+
+
+@app.route("/api/config")
+def get_config():
+    """获取可用配置选项"""
+    return jsonify({
+        "aspect_ratios": VALID_ASPECT_RATIOS,
+        "image_sizes": VALID_IMAGE_SIZES,
+        "modes": ["standard", "search", "edit"],
+        "thought_image_policies": list(THOUGHT_IMAGE_POLICIES),
+        "thought_image_policy": THOUGHT_IMAGE_POLICY
+    })
+
+
+def conversation_etag(paths) -> str:
+    """按对话文件的修改时间和大小计算 ETag，无需读取内容"""
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        digest.update(f"{path.name}:{stat.st_mtime_ns}:{stat.st_size};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def conditional_json(etag: str, load):
+    """If-None-Match 命中时返回 304，否则调用 load() 生成 JSON；客户端每次使用前都需重新验证"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(load())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/conversations", methods=["GET"])
+def get_conversations():
+    """获取当前用户的对话列表（包含当前分支的完整消息）"""
+    user = request_user()
+    return conditional_json(conversation_etag(conversations_dir(user).glob("*.json")), lambda: load_conversations(user))
+
+
+@app.route("/api/conversations/<conv_id>", methods=["GET"])
+def get_conversation(conv_id):
+    """获取单个对话详情"""
+    user = request_user()
+    path = conversation_path(conv_id, user)
+    if not path.exists():
+        return jsonify({"error": "对话不存在"}), 404
+    return conditional_json(conversation_etag([path]), lambda: conversation_view(read_conversation(conv_id, user)))
+
+
+@app.route("/api/conversations", methods=["POST"])
+def create_conversation():
+    """创建新对话"""
+    new_conv = {
+        "id": str(uuid.uuid4()),
+        "title": "新对话",
+        "owner": request_user(),
+        "head": None,
+        "nodes": {},
+        "created_at": datetime.now().isoformat(),
+        "updated_at": datetime.now().isoformat()
+    }
+    write_conversation(new_conv)
+    return jsonify(conversation_view(new_conv))
+
+
+@app.route("/api/conversations/<conv_id>/messages/<msg_id>/details", methods=["GET"])
+def get_message_details(conv_id, msg_id):
+    """获取消息的外置详情（思考过程、思考图片、搜索来源）"""
+    if not conversation_path(conv_id, request_user()).exists():
+        return jsonify({"error": "对话不存在"}), 404
+    details = read_message_details(conv_id, msg_id)
+    if details is None:
+        return jsonify({"error": "消息详情不存在"}), 404
+    return jsonify(details)
+
+
+def commit_conversation(conv: dict, nodes: list, old_view: dict) -> dict:
+    """保存对话改动：关联资源、更新索引（用请求中带回的完整内容）、外置大字段后写盘，返回新的视图"""
+    if nodes:
+        link_conversation_assets(conv["id"], nodes)
+    conv["updated_at"] = datetime.now().isoformat()
+    update_search_index(conv)
+    outline_conversation(conv)
+    return publish_conversation(conv, old_view)
 
 
 @app.route("/api/conversations/<conv_id>", methods=["PUT"])
 def update_conversation(conv_id):
-    """更新对话"""
+    """更新对话标题，或以完整消息列表覆盖当前分支（其他分支保留）"""
     data = request.json
-    conversations = load_conversations()
-    for c in conversations:
-        if c["id"] == conv_id:
-            if "title" in data:
-                c["title"] = data["title"]
-            if "messages" in data:
-                c["messages"] = data["messages"]
-            c["updated_at"] = datetime.now().isoformat()
-            save_conversations(conversations)
-            return jsonify(c)
-    return jsonify({"error": "对话不存在"}), 404
+    with store_lock(request_user()):
+        conv = read_conversation(conv_id, request_user())
+        if not conv:
+            return jsonify({"error": "对话不存在"}), 404
+        old_view = conversation_view(conv)
+        if "title" in data:
+            conv["title"] = data["title"]
+        nodes = replace_active_path(conv, data["messages"]) if "messages" in data else []
+        return jsonify(commit_conversation(conv, nodes, old_view))
+
+
+@app.route("/api/conversations/<conv_id>/messages", methods=["POST"])
+def append_conversation_messages(conv_id):
+    """在指定父消息下追加消息并切换到该分支
+
+    请求: {"parent_id": 父消息 ID（空为根）, "messages": [...], "title": 可选}
+    父消息已有后续时，新消息成为其兄弟分支，原有消息不受影响
+    """
+    data = request.json or {}
+    messages = data.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return jsonify({"error": "缺少消息"}), 400
+    parent_id = data.get("parent_id") or None
+    with store_lock(request_user()):
+        conv = read_conversation(conv_id, request_user())
+        if not conv:
+            return jsonify({"error": "对话不存在"}), 404
+        if parent_id and parent_id not in conv.get("nodes", {}):
+            return jsonify({"error": "父消息不存在"}), 400
+        old_view = conversation_view(conv)
+        if data.get("title"):
+            conv["title"] = data["title"]
+        nodes = append_messages(conv, parent_id, messages)
+        return jsonify(commit_conversation(conv, nodes, old_view))
+
+
+@app.route("/api/conversations/<conv_id>/branches", methods=["GET"])
+def get_message_branches(conv_id):
+    """列出某条消息所在分支点的所有兄弟分支"""
+    conv = read_conversation(conv_id, request_user())
+    if not conv:
+        return jsonify({"error": "对话不存在"}), 404
+    node = conv.get("nodes", {}).get(request.args.get("message_id", ""))
+    if not node:
+        return jsonify({"error": "消息不存在"}), 404
+    active_ids = {m["id"] for m in active_path(conv)}
+    items = []
+    for sibling_id in node_children(conv).get(node.get("parent"), []):
+        sibling = conv["nodes"][sibling_id]
+        items.append({
+            "id": sibling_id,
+            "role": sibling.get("role"),
+            "preview": (sibling.get("text") or "")[:80],
+            "image": sibling.get("image"),
+            "active": sibling_id in active_ids
+        })
+    return jsonify({"parent_id": node.get("parent"), "items": items})
+
+
+@app.route("/api/conversations/<conv_id>/branches/switch", methods=["POST"])
+def switch_branch(conv_id):
+    """切换到包含指定消息的分支（沿最新的后续消息走到末端）"""
+    message_id = (request.json or {}).get("message_id")
+    with store_lock(request_user()):
+        conv = read_conversation(conv_id, request_user())
+        if not conv:
+            return jsonify({"error": "对话不存在"}), 404
+        if message_id not in conv.get("nodes", {}):
+            return jsonify({"error": "消息不存在"}), 404
+        old_view = conversation_view(conv)
+        conv["head"] = latest_leaf(conv, message_id)
+        return jsonify(publish_conversation(conv, old_view))
+
+
+@app.route("/api/conversations/<conv_id>/changes", methods=["GET"])
+def get_conversation_changes(conv_id):
+    """获取 ?since=<seq> 之后的变更（日志不连续时返回完整的当前分支）"""
+    since = request.args.get("since", 0, type=int)
+    result = conversation_changes(conv_id, since, request_user())
+    if result is None:
+        return jsonify({"error": "对话不存在"}), 404
+    return jsonify(result)
+
+
+@app.route("/api/conversations/<conv_id>/events", methods=["GET"])
+def subscribe_conversation(conv_id):
+    """订阅对话变更 (SSE)：先补发 ?since=<seq> 之后的变更，之后实时推送"""
+    since = request.args.get("since", 0, type=int)
+    user = request_user()
+    if conversation_changes(conv_id, since, user) is None:
+        return jsonify({"error": "对话不存在"}), 404
+    
+    def generate():
+        seq = since
+        while True:
+            result = conversation_changes(conv_id, seq, user)
+            if result is None or result.get("deleted"):
+                yield f"data: {json.dumps({'type': 'deleted', 'seq': (result or {}).get('seq', seq)})}\n\n"
+                return
+            if result.get("reset") or result["changes"]:
+                event_type = "reset" if result.get("reset") else "changes"
+                yield f"data: {json.dumps({'type': event_type, **result}, ensure_ascii=False)}\n\n"
+            seq = result["seq"]
+            if not wait_conversation_change(conv_id, seq, CHANGE_STREAM_HEARTBEAT):
+                yield ": ping\n\n"  # 心跳，及时发现断开的连接
+    
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @app.route("/api/conversations/<conv_id>", methods=["DELETE"])
 def delete_conversation(conv_id):
     """删除对话"""
-    conversations = load_conversations()
-    conversations = [c for c in conversations if c["id"] != conv_id]
-    save_conversations(conversations)
+    user = request_user()
+    with store_lock(user):
+        conv = read_conversation(conv_id, user)
+        if not conv:
+            return jsonify({"success": True})
+        delete_conversation_file(conv_id, user)
+    publish_conversation_deleted(conv_id, conv.get("seq", 0))
+    forget_conversation_details(conv_id)
+    try:
+        forget_conversation_text(conv_id)
+    except Exception as e:
+        print(f"⚠️ 更新搜索索引失败: {conv_id} ({e})")
     return jsonify({"success": True})
 
 
 @app.route("/api/conversations/<conv_id>/messages/<int:msg_index>", methods=["DELETE"])
 def delete_message(conv_id, msg_index):
-    """删除对话中的单条消息"""
-    conversations = load_conversations()
-    for c in conversations:
-        if c["id"] == conv_id:
-            messages = c.get("messages", [])
-            if 0 <= msg_index < len(messages):
-                messages.pop(msg_index)
-                c["messages"] = messages
-                c["updated_at"] = datetime.now().isoformat()
-                save_conversations(conversations)
-                return jsonify({"success": True, "messages": messages})
-            else:
-                return jsonify({"error": "消息索引超出范围"}), 400
-    return jsonify({"error": "对话不存在"}), 404
+    """删除当前分支中的单条消息（其后续消息接到它的上一条之后）"""
+    with store_lock(request_user()):
+        conv = read_conversation(conv_id, request_user())
+        if not conv:
+            return jsonify({"error": "对话不存在"}), 404
+        path = active_path(conv)
+        if not 0 <= msg_index < len(path):
+            return jsonify({"error": "消息索引超出范围"}), 400
+        old_view = conversation_view(conv)
+        forget_message_details(conv_id, remove_message_node(conv, path[msg_index]["id"]))
+        conv["updated_at"] = datetime.now().isoformat()
+        view = publish_conversation(conv, old_view)
+    update_search_index(conv)
+    return jsonify({"success": True, "messages": view["messages"], "seq": view["seq"]})
+
+
+@app.route("/api/export", methods=["GET"])
+def export_conversations():
+    """流式导出对话及其引用的文件（tar）；?conversation_id= 可重复指定，省略时导出全部"""
+    conv_ids = request.args.getlist("conversation_id")
+    user = request_user()
+    for conv_id in conv_ids:
+        if not conversation_path(conv_id, user).exists():
+            return jsonify({"error": f"对话不存在: {conv_id}"}), 404
+    filename = f"nanobanana-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tar"
+    return Response(
+        iter_export_archive(conv_ids or None, user),
+        mimetype="application/x-tar",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+def import_status(checkpoint: dict, running: bool = None) -> dict:
+    """对外返回的导入进度：running 表示正在后台执行（省略时按当前状态判断），失败时带 error"""
+    if running is None:
+        running = checkpoint["import_id"] in _running_imports
+    return {**checkpoint, "running": running}
+
+
+def run_import(import_id: str, user: str):
+    """在后台线程中把已上传到 data/imports 的归档导入到用户名下，立即返回 202 和导入 ID；
+    进度通过 GET /api/import/<导入ID> 查询，中断或失败的导入再次调用时继续
+    """
+    archive_path = IMPORTS_DIR / f"{import_id}.tar"
+    checkpoint = load_import_checkpoint(import_id)
+    if checkpoint and checkpoint.get("user", DEFAULT_USER) != user:
+        return jsonify({"error": "导入任务不存在"}), 404
+    if checkpoint and checkpoint["done"]:
+        return jsonify(import_status(checkpoint))
+    if not archive_path.exists():
+        return jsonify({"error": "导入归档不存在"}), 404
+    if not _import_lock.acquire(blocking=False):
+        return jsonify({"error": "已有导入正在进行"}), 409
+    # 先写入检查点记录归属，查询进度时据此校验用户
+    checkpoint = checkpoint or new_import_checkpoint(import_id, archive_path, user)
+    checkpoint.pop("error", None)  # 重试时清除上次的失败原因
+    save_import_checkpoint(checkpoint)
+    _running_imports.add(import_id)
+    
+    def run():
+        try:
+            import_archive(archive_path, import_id, user)
+            archive_path.unlink(missing_ok=True)
+        except Exception as e:
+            print(f"⚠️ 导入失败: {import_id} ({e})")
+            failed = load_import_checkpoint(import_id) or checkpoint
+            invalid = isinstance(e, (tarfile.TarError, ValueError))
+            failed["error"] = f"归档无效: {e}" if invalid else f"导入失败: {e}"
+            save_import_checkpoint(failed)
+        finally:
+            _running_imports.discard(import_id)
+            _import_lock.release()
+    
+    # 先取状态再启动线程：很快结束（如归档无效）的导入不会让 202 响应显示为未运行且没有结果
+    status = import_status(checkpoint)
+    threading.Thread(target=run, name=f"import-{import_id[:8]}", daemon=True).start()
+    return jsonify(status), 202
+
+
+@app.route("/api/import/<import_id>", methods=["GET"])
+def get_import_status(import_id):
+    """查询导入进度"""
+    # 先判断是否仍在执行再读取检查点：导入线程写完最终结果后才移除运行标记，已结束时读到的一定是最终结果
+    running = import_id in _running_imports
+    checkpoint = load_import_checkpoint(import_id)
+    if not checkpoint or checkpoint.get("user", DEFAULT_USER) != request_user():
+        return jsonify({"error": "导入任务不存在"}), 404
+    return jsonify(import_status(checkpoint, running))
+
+
+@app.route("/api/import/<import_id>", methods=["POST"])
+def resume_import(import_id):
+    """继续中断或失败的导入（归档经分片上传完成后会自动在后台开始导入）"""
+    try:
+        uuid.UUID(import_id)
+    except ValueError:
+        return jsonify({"error": "导入任务不存在"}), 404
+    return run_import(import_id, request_user())
+
+
+@traced("ingest_upload")
+def ingest_upload(filepath: Path, original_name: str, conversation_id: str = None, user: str = DEFAULT_USER) -> tuple:
+    """对已落盘的上传文件执行入库处理，返回 (上传结果, 错误信息)
+
+    处理失败时删除文件；/api/upload 与分片上传共用
+    """
+    try:
+        info = _ingest_pool.submit(ingest_image, filepath).result()
+    except ValueError as e:
+        filepath.unlink(missing_ok=True)
+        return None, str(e)
+    index_asset(filepath, "upload", {"conversation_id": conversation_id, "user": user})
+    
+    result = {
+        "filename": filepath.name,
+        "original_name": original_name,
+        "mime_type": info["mime_type"],
+        "path": f"/uploads/{filepath.name}",
+        "width": info["width"],
+        "height": info["height"]
+    }
+    if info["model_path"] != filepath:
+        result["model_filename"] = info["model_path"].name
+    if info.get("page_count"):
+        result["page_count"] = info["page_count"]
+    return result, None
 
 
 @app.route("/api/upload", methods=["POST"])
 def upload_file():
-    """上传文件"""
+    """上传文件（小文件一次性上传，大文件请使用分片上传）"""
     if "file" not in request.files:
         return jsonify({"error": "没有文件"}), 400
     
     file = request.files["file"]
     if file.filename == "":
         return jsonify({"error": "文件名为空"}), 400
+    storage_error = check_tenant_storage(request_user())
+    if storage_error:
+        return jsonify({"error": storage_error}), 507
     
     ext = Path(file.filename).suffix.lower()
     filename = f"{uuid.uuid4()}{ext}"
-    filepath = UPLOADS_DIR / filename
+    filepath = asset_path(UPLOADS_DIR, filename, create=True)
     
     file.save(filepath)
     
-    mime_map = {
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".gif": "image/gif",
-        ".webp": "image/webp",
-        ".pdf": "application/pdf"
+    result, error = ingest_upload(filepath, file.filename, request.form.get("conversation_id"), request_user())
+    if error:
+        return jsonify({"error": error}), 400
+    return jsonify(result)
+
+
+# ============ 分片上传 ============
+# 协议：init -> 按偏移量 PUT 分片 -> complete
+# 分片直接追加写入 partial_uploads/<id>.part，内存占用不超过一个读写块；
+# 会话元数据保存在 <id>.json，断线后可通过 GET 查询已确认的偏移量继续上传。
+
+_upload_locks = {}  # 上传 ID -> [锁, 持有和等待的请求数]
+_upload_locks_guard = threading.Lock()
+
+
+class upload_lock:
+    """持有单个上传会话的锁（with upload_lock(id) as acquired），不同会话之间互不阻塞
+
+    锁按引用计数管理：没有请求持有或等待时才从锁表中移除，删除会话时不会让仍在等待的请求拿到另一把新锁
+    """
+    
+    def __init__(self, upload_id: str, blocking: bool = True):
+        self.upload_id = upload_id
+        self.blocking = blocking
+        self.acquired = False
+    
+    def __enter__(self):
+        with _upload_locks_guard:
+            self.entry = _upload_locks.setdefault(self.upload_id, [threading.Lock(), 0])
+            self.entry[1] += 1
+        self.acquired = self.entry[0].acquire(blocking=self.blocking)
+        return self.acquired
+    
+    def __exit__(self, *exc):
+        if self.acquired:
+            self.entry[0].release()
+        with _upload_locks_guard:
+            self.entry[1] -= 1
+            if not self.entry[1]:
+                del _upload_locks[self.upload_id]
+        return False
+
+
+def _upload_session_paths(upload_id: str) -> tuple:
+    """返回 (元数据文件, 数据文件) 路径"""
+    return PARTIAL_UPLOADS_DIR / f"{upload_id}.json", PARTIAL_UPLOADS_DIR / f"{upload_id}.part"
+
+
+def load_upload_session(upload_id: str, user: str):
+    """读取用户的上传会话元数据，不存在（或属于其他用户）时返回 None"""
+    try:
+        uuid.UUID(upload_id)
+    except ValueError:
+        return None
+    meta_path, _ = _upload_session_paths(upload_id)
+    try:
+        session = json.loads(meta_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return session if session.get("user", DEFAULT_USER) == user else None
+
+
+def save_upload_session(session: dict):
+    """原子写入上传会话元数据"""
+    meta_path, _ = _upload_session_paths(session["upload_id"])
+    tmp_path = meta_path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(session, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, meta_path)
+
+
+def remove_upload_session(upload_id: str):
+    """删除上传会话的元数据和数据文件"""
+    for path in _upload_session_paths(upload_id):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def cleanup_stale_uploads():
+    """清理超过保留期限的未完成上传"""
+    deadline = time.time() - UPLOAD_SESSION_TTL
+    for meta_path in PARTIAL_UPLOADS_DIR.glob("*.json"):
+        try:
+            if meta_path.stat().st_mtime < deadline:
+                with upload_lock(meta_path.stem, blocking=False) as acquired:
+                    if acquired:  # 正在写入的会话跳过
+                        remove_upload_session(meta_path.stem)
+        except OSError:
+            pass
+
+
+def upload_session_status(session: dict) -> dict:
+    """对外返回的会话状态"""
+    return {
+        "upload_id": session["upload_id"],
+        "offset": session["offset"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"]
+    }
+
+
+@app.route("/api/upload/chunked", methods=["POST"])
+def init_chunked_upload():
+    """初始化分片上传会话"""
+    data = request.json or {}
+    original_name = str(data.get("filename", "")).strip()
+    try:
+        size = int(data.get("size", -1))
+        chunk_size = int(data.get("chunk_size") or UPLOAD_CHUNK_SIZE)
+    except (TypeError, ValueError):
+        return jsonify({"error": "参数格式错误"}), 400
+    
+    if not original_name:
+        return jsonify({"error": "文件名为空"}), 400
+    purpose = "import" if data.get("purpose") == "import" else "upload"  # import: 上传的是导出归档
+    max_size = IMPORT_MAX_ARCHIVE_SIZE if purpose == "import" else UPLOAD_MAX_FILE_SIZE
+    if size <= 0:
+        return jsonify({"error": "文件大小无效"}), 400
+    if size > max_size:
+        return jsonify({"error": f"文件超过上限 {max_size // (1024 * 1024)}MB"}), 413
+    storage_error = check_tenant_storage(request_user()) if purpose == "upload" else None
+    if storage_error:
+        return jsonify({"error": storage_error}), 507
+    
+    cleanup_stale_uploads()
+    
+    session = {
+        "upload_id": str(uuid.uuid4()),
+        "original_name": original_name,
+        "ext": Path(original_name).suffix.lower(),
+        "size": size,
+        "chunk_size": max(STREAM_BLOCK_SIZE, min(chunk_size, UPLOAD_MAX_CHUNK_SIZE)),
+        "sha256": str(data.get("sha256", "")).lower() or None,
+        "conversation_id": data.get("conversation_id"),
+        "purpose": purpose,
+        "user": request_user(),
+        "offset": 0,
+        "created_at": datetime.now().isoformat()
     }
-    mime_type = mime_map.get(ext, "application/octet-stream")
+    _, part_path = _upload_session_paths(session["upload_id"])
+    part_path.touch()
+    save_upload_session(session)
     
-    return jsonify({
-        "filename": filename,
-        "original_name": file.filename,
-        "mime_type": mime_type,
-        "path": f"/uploads/{filename}"
-    })
+    return jsonify(upload_session_status(session))
+
+
+@app.route("/api/upload/chunked/<upload_id>", methods=["GET"])
+def get_chunked_upload(upload_id):
+    """查询上传进度（用于断点续传）"""
+    session = load_upload_session(upload_id, request_user())
+    if not session:
+        return jsonify({"error": "上传会话不存在或已过期"}), 404
+    return jsonify(upload_session_status(session))
+
+
+@app.route("/api/upload/chunked/<upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id):
+    """写入一个分片：?offset=<字节偏移>，请求体为原始字节，可选 X-Chunk-SHA256 校验"""
+    # 先确认会话存在，不为伪造或已删除的 ID 创建锁
+    if not load_upload_session(upload_id, request_user()):
+        return jsonify({"error": "上传会话不存在或已过期"}), 404
+    with upload_lock(upload_id, blocking=False) as acquired:
+        if not acquired:
+            return jsonify({"error": "该上传正在写入其他分片"}), 409
+        session = load_upload_session(upload_id, request_user())
+        if not session:
+            return jsonify({"error": "上传会话不存在或已过期"}), 404
+        
+        offset = request.args.get("offset", type=int)
+        if offset != session["offset"]:
+            # 偏移量不一致时返回服务端已确认的位置，客户端据此续传
+            return jsonify({"error": "偏移量不匹配", **upload_session_status(session)}), 409
+        
+        length = request.content_length
+        if not length:
+            return jsonify({"error": "分片为空"}), 400
+        if length > session["chunk_size"] or offset + length > session["size"]:
+            return jsonify({"error": "分片大小超出范围"}), 413
+        
+        _, part_path = _upload_session_paths(upload_id)
+        digest = hashlib.sha256()
+        written = 0
+        with open(part_path, "r+b") as fp:
+            fp.seek(offset)
+            fp.truncate()
+            while written < length:
+                block = request.stream.read(min(STREAM_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                fp.write(block)
+                digest.update(block)
+                written += len(block)
+            
+            expected = request.headers.get("X-Chunk-SHA256", "").lower()
+            if written != length or (expected and expected != digest.hexdigest()):
+                # 分片不完整或校验失败，回滚到上次确认的位置
+                fp.truncate(offset)
+                return jsonify({"error": "分片传输不完整或校验失败", **upload_session_status(session)}), 400
+            fp.flush()
+            os.fsync(fp.fileno())
+        
+        session["offset"] = offset + written
+        save_upload_session(session)
+        return jsonify(upload_session_status(session))
+
+
+@app.route("/api/upload/chunked/<upload_id>/complete", methods=["POST"])
+def complete_chunked_upload(upload_id):
+    """完成分片上传：校验完整性并移入上传目录"""
+    if not load_upload_session(upload_id, request_user()):
+        return jsonify({"error": "上传会话不存在或已过期"}), 404
+    with upload_lock(upload_id):
+        session = load_upload_session(upload_id, request_user())
+        if not session:
+            return jsonify({"error": "上传会话不存在或已过期"}), 404
+        if session["offset"] != session["size"]:
+            return jsonify({"error": "文件尚未上传完整", **upload_session_status(session)}), 409
+        
+        _, part_path = _upload_session_paths(upload_id)
+        expected = str((request.get_json(silent=True) or {}).get("sha256", "") or session.get("sha256") or "").lower()
+        if expected:
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as fp:
+                for block in iter(lambda: fp.read(STREAM_BLOCK_SIZE), b""):
+                    digest.update(block)
+            if digest.hexdigest() != expected:
+                remove_upload_session(upload_id)
+                return jsonify({"error": "文件校验失败，请重新上传"}), 400
+        
+        if session.get("purpose") == "import":
+            archive_path = IMPORTS_DIR / f"{upload_id}.tar"
+            os.replace(part_path, archive_path)
+            remove_upload_session(upload_id)
+            return run_import(upload_id, session.get("user", DEFAULT_USER))
+        filepath = asset_path(UPLOADS_DIR, f"{uuid.uuid4()}{session['ext']}", create=True)
+        os.replace(part_path, filepath)
+        remove_upload_session(upload_id)
+    
+    result, error = ingest_upload(filepath, session["original_name"], session.get("conversation_id"), session.get("user", DEFAULT_USER))
+    if error:
+        return jsonify({"error": error}), 400
+    return jsonify(result)
+
+
+@app.route("/api/upload/chunked/<upload_id>", methods=["DELETE"])
+def abort_chunked_upload(upload_id):
+    """取消分片上传"""
+    if not load_upload_session(upload_id, request_user()):
+        return jsonify({"error": "上传会话不存在或已过期"}), 404
+    with upload_lock(upload_id):
+        remove_upload_session(upload_id)
+    return jsonify({"success": True})
+
+
+def immutable_response(response):
+    """上传和生成的文件（及其缩略图）名称唯一、内容不会改变，允许浏览器长期缓存（文件按用户隔离，不允许共享缓存）"""
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response
 
 
 @app.route("/uploads/<filename>")
 def serve_upload(filename):
     """提供上传文件访问"""
-    return send_from_directory(UPLOADS_DIR, filename)
+    filepath = resolve_asset(UPLOADS_DIR, filename)
+    if not filepath or not asset_visible(filename, request_user()):
+        return jsonify({"error": "文件不存在"}), 404
+    return immutable_response(send_from_directory(filepath.parent, filepath.name))
 
 
 @app.route("/generated/<filename>")
 def serve_generated(filename):
     """提供生成图片访问"""
-    return send_from_directory(GENERATED_DIR, filename)
+    wait_pending_write(filename)
+    filepath = resolve_asset(GENERATED_DIR, filename)
+    if not filepath or not asset_visible(filename, request_user()):
+        return jsonify({"error": "文件不存在"}), 404
+    return immutable_response(send_from_directory(filepath.parent, filepath.name))
+
+
+@app.route("/thumbnails/<filename>")
+def serve_thumbnail(filename):
+    """提供图片缩略图（首次访问时生成并缓存）；PDF 可用 ?page=N 指定页"""
+    wait_pending_write(filename)
+    filepath = find_image_file(filename)
+    if not filepath or not asset_visible(filename, request_user()):
+        return jsonify({"error": "文件不存在"}), 404
+    page = request.args.get("page", type=int)
+    if page is not None:
+        try:
+            page_count = pdf_page_count(filepath) if is_pdf(filepath) else 0
+        except ValueError:
+            page_count = 0
+        if page_count is not None and not 1 <= page <= page_count:
+            return jsonify({"error": "页面不存在"}), 404
+    try:
+        thumb = _ingest_pool.submit(make_thumbnail, filepath, page).result()
+    except Exception as e:
+        print(f"⚠️ 生成缩略图失败: {filepath.name} ({e})")
+        return jsonify({"error": "无法生成缩略图"}), 415
+    return immutable_response(send_from_directory(thumb.parent, thumb.name))
+
+
+@app.route("/api/pdf/<filename>/pages", methods=["GET"])
+def list_pdf_pages(filename):
+    """PDF 的页数和每页缩略图地址（发送时在 files 条目中用 pages 选择页码）"""
+    filepath = find_image_file(filename)
+    if not filepath or not asset_visible(filename, request_user()) or not is_pdf(filepath):
+        return jsonify({"error": "PDF 文件不存在"}), 404
+    try:
+        page_count = pdf_page_count(filepath)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 415
+    if page_count is None:
+        return jsonify({"error": "服务器未安装 pypdfium2，无法按页处理 PDF"}), 501
+    return jsonify({
+        "filename": filepath.name,
+        "page_count": page_count,
+        "max_selected_pages": PDF_MAX_SELECTED_PAGES,
+        "pages": [{"page": n, "thumbnail": f"/thumbnails/{filepath.name}?page={n}"} for n in range(1, page_count + 1)]
+    })
+
+
+@app.route("/api/renditions", methods=["GET"])
+def list_rendition_presets():
+    """已配置的派生版本预设"""
+    return jsonify({"presets": RENDITION_PRESETS})
+
+
+@app.route("/api/renditions/<filename>", methods=["GET", "POST"])
+def renditions_for_image(filename):
+    """GET 查看生成图片的派生版本；POST 按 {"presets": [...]} 重新生成（省略时生成 auto 预设）"""
+    filepath = resolve_asset(GENERATED_DIR, filename)
+    if not filepath or not asset_visible(filename, request_user()):
+        return jsonify({"error": "文件不存在"}), 404
+    if request.method == "POST":
+        presets = request_renditions({"renditions": (request.get_json(silent=True) or {}).get("presets")})
+        if not presets:
+            return jsonify({"error": "没有可用的派生版本预设"}), 400
+        start_renditions(filepath, presets, get_asset_meta(filepath.name))
+    return jsonify({"filename": filepath.name, "renditions": rendition_status(filepath)})
+
+
+@app.route("/api/renditions/<filename>/events", methods=["GET"])
+def subscribe_renditions(filename):
+    """订阅派生版本进度 (SSE)：先发送当前状态，之后每个预设完成或失败时推送，全部结束后关闭"""
+    filepath = resolve_asset(GENERATED_DIR, filename)
+    if not filepath or not asset_visible(filename, request_user()):
+        return jsonify({"error": "文件不存在"}), 404
+    
+    def generate():
+        since = 0.0
+        reported = {}
+        while True:
+            now = time.monotonic()
+            items = rendition_status(filepath)
+            for item in items:
+                if reported.get(item["preset"]) != item["status"]:
+                    reported[item["preset"]] = item["status"]
+                    yield f"data: {json.dumps({'type': 'rendition', **item})}\n\n"
+            if not any(item["status"] == "queued" for item in items):
+                yield f"data: {json.dumps({'type': 'renditions_done', 'renditions': items})}\n\n"
+                return
+            if not wait_rendition_change(filepath.name, since, CHANGE_STREAM_HEARTBEAT):
+                yield ": ping\n\n"
+            since = now
+    
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
+@traced("build_history")
 def build_history_contents(history: list, types_module):
     """构建历史消息内容"""
     contents = []
@@ -293,27 +4757,24 @@ def build_history_contents(history: list, types_module):
         
         # 添加文本
         if msg.get("text"):
-            parts.append(msg["text"])
+            parts.append(types_module.Part.from_text(text=msg["text"]))
         
         # 添加图片（如果有的话）
         if msg.get("image"):
             image_path = msg["image"]
             # 处理路径
             if image_path.startswith("/generated/"):
-                filename = image_path.replace("/generated/", "")
-                filepath = GENERATED_DIR / filename
+                filepath = resolve_asset(GENERATED_DIR, image_path.replace("/generated/", ""))
             elif image_path.startswith("/uploads/"):
-                filename = image_path.replace("/uploads/", "")
-                filepath = UPLOADS_DIR / filename
+                filepath = resolve_asset(UPLOADS_DIR, image_path.replace("/uploads/", ""))
             else:
                 filepath = None
             
-            if filepath and filepath.exists():
-                with open(filepath, "rb") as fp:
-                    img_data = fp.read()
+            if filepath:
+                img_data, mime_type = load_model_input(filepath, "image/png")
                 parts.append(types_module.Part.from_bytes(
                     data=img_data,
-                    mime_type="image/png"
+                    mime_type=mime_type
                 ))
         
         if parts:
@@ -322,6 +4783,159 @@ def build_history_contents(history: list, types_module):
     return contents
 
 
+def stream_generation(client, contents, config, image_prefix: str = "", done_message: str = "生成完成!",
+                      empty_message: str = "未生成图片，可能被安全策略拦截", postprocess=None, done_extra=None,
+                      thought_policy: str = THOUGHT_IMAGE_POLICY, asset_meta: dict = None, usage: dict = None,
+                      renditions: list = None, grounding: bool = False):
+    """调用模型流式生成并产出 SSE 事件（标准生成、图像编辑、草稿定稿、搜索增强生成共用）
+
+    thought_policy: 思考过程图片的保留策略
+    asset_meta: 记录到元数据索引的生成参数（见 request_asset_meta）
+    usage: 用量记录（见 new_usage_record），填入 token 数和输出信息
+    renditions: 保存后要生成的派生版本预设（见 request_renditions），在 done 事件中返回初始状态
+    grounding: 解析搜索来源（随最后的分片返回），发送 grounding 事件并合并进 done 事件
+
+    postprocess: 保存前对最终图片字节的处理（如局部编辑的回贴）
+    done_extra: 保存成功后调用，参数为文件名，返回合并进 done 事件的字段
+    """
+    response_stream = client.models.generate_content_stream(
+        model="gemini-3-pro-image-preview",
+        contents=contents,
+        config=config
+    )
+    
+    final_image = None  # bytes，或大图落盘后的临时文件路径
+    all_text = ""
+    thinking_text = ""
+    thinking_images = []
+    grounding_metadata = None
+    finish_reason = None
+    
+    for chunk in traced_model_stream(response_stream):
+        note_usage_metadata(usage, getattr(chunk, "usage_metadata", None))
+        if chunk.candidates:
+            grounding_metadata = chunk.candidates[0].grounding_metadata or grounding_metadata
+            finish_reason = chunk.candidates[0].finish_reason or finish_reason
+        # 处理各个 part
+        if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+            for part in chunk.candidates[0].content.parts:
+                # 检查是否是思考过程
+                if hasattr(part, 'thought') and part.thought:
+                    if part.text:
+                        thinking_text += part.text
+                        yield f"data: {json.dumps({'type': 'thinking', 'text': part.text})}\n\n"
+                    elif part.inline_data:
+                        # 思考过程中的图片（按保留策略处理）
+                        event, record = save_thought_image(part.inline_data.data, thought_policy, asset_meta)
+                        if record:
+                            thinking_images.append(record)
+                        if event:
+                            yield f"data: {json.dumps(event)}\n\n"
+                else:
+                    # 普通内容
+                    if part.text:
+                        all_text += part.text
+                        yield f"data: {json.dumps({'type': 'text', 'text': part.text})}\n\n"
+                    elif part.inline_data:
+                        print(f"🖼️ 收到图片分片: {len(part.inline_data.data)} bytes")
+                        if isinstance(final_image, Path):
+                            final_image.unlink(missing_ok=True)  # 后到的图片覆盖之前的
+                        final_image = spill_large_buffer(part.inline_data.data)
+    # 循环变量仍引用最后一个分片（含图片的 inline_data），保存前释放，避免原始字节与保存时的副本同时驻留
+    chunk = part = None
+    
+    if final_image is not None and postprocess:
+        with trace_stage("postprocess"):
+            final_image = postprocess(read_spilled_buffer(final_image))
+    
+    grounding_data = None
+    if grounding:
+        grounding_data = parse_grounding_metadata(grounding_metadata)
+        if grounding_metadata:
+            yield f"data: {json.dumps({'type': 'grounding', 'data': grounding_data})}\n\n"
+    
+    if not final_image:
+        if finish_reason and finish_reason != "STOP":
+            empty_message = f"生成被中断: {finish_reason}"
+        yield f"data: {json.dumps({'type': 'error', 'message': empty_message})}\n\n"
+        return
+    
+    if isinstance(final_image, Path):
+        filename, img_base64 = save_spilled_image(final_image, image_prefix, asset_meta)
+    else:
+        filename, img_base64 = save_image_from_bytes(final_image, image_prefix, asset_meta)
+    del final_image
+    note_usage_output(usage, filename)
+    done_event = {
+        'type': 'done',
+        'message': done_message,
+        'full_text': all_text,
+        'thinking': thinking_text,
+        'thinking_images': thinking_images
+    }
+    if grounding:
+        done_event["grounding"] = grounding_data
+    if done_extra:
+        done_event.update(done_extra(filename))
+    if renditions:
+        done_event["renditions"] = start_renditions(asset_path(GENERATED_DIR, filename), renditions, asset_meta)
+    
+    yield f"data: {json.dumps({'type': 'image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_base64})}\n\n"
+    yield f"data: {json.dumps(done_event)}\n\n"
+
+
+# ============ 草稿 -> 定稿 ============
+# 草稿模式先用 1K 快速出图；用户确认后把缓存的请求内容 + 草稿图一起发送，
+# 以 2K/4K 输出最终版本，无需重新读取和处理参考图、历史消息。
+
+DRAFT_CACHE_SIZE = int(os.getenv("DRAFT_CACHE_SIZE", 32))
+DRAFT_CACHE_TTL = 3600  # 草稿请求缓存保留 1 小时
+DRAFT_IMAGE_SIZE = "1K"
+
+_draft_cache = OrderedDict()  # draft_id -> 请求内容缓存（LRU）
+_draft_cache_lock = threading.Lock()
+
+
+def cache_draft_request(contents, aspect_ratio: str, include_text: bool, user: str = DEFAULT_USER) -> str:
+    """缓存草稿请求的内容，返回 draft_id"""
+    draft_id = str(uuid.uuid4())
+    with _draft_cache_lock:
+        _draft_cache[draft_id] = {
+            "contents": contents,
+            "aspect_ratio": aspect_ratio,
+            "include_text": include_text,
+            "draft_filename": None,
+            "user": user,
+            "created": time.time()
+        }
+        while len(_draft_cache) > DRAFT_CACHE_SIZE:
+            _draft_cache.popitem(last=False)
+    return draft_id
+
+
+def get_draft_request(draft_id: str):
+    """读取草稿缓存，过期或不存在时返回 None"""
+    with _draft_cache_lock:
+        entry = _draft_cache.get(draft_id)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > DRAFT_CACHE_TTL:
+            _draft_cache.pop(draft_id, None)
+            return None
+        _draft_cache.move_to_end(draft_id)
+        return entry
+
+
+def draft_done_extra(draft_id: str):
+    """草稿生成完成后记录草稿图文件名，并在 done 事件中返回 draft_id"""
+    def extra(filename):
+        with _draft_cache_lock:
+            if draft_id in _draft_cache:
+                _draft_cache[draft_id]["draft_filename"] = filename
+        return {"draft": True, "draft_id": draft_id}
+    return extra
+
+
 @app.route("/api/generate", methods=["POST"])
 def generate_image():
     """生成图片 (SSE 流式响应) - 标准模式"""
@@ -331,16 +4945,31 @@ def generate_image():
     aspect_ratio = str(data.get("aspect_ratio", "1:1")).strip() or "1:1"
     image_size = str(data.get("image_size", "1K")).strip() or "1K"
     include_text = data.get("include_text", True)  # 是否同时返回文本
-    history = data.get("history", [])  # 历史消息
+    history = request_history(data)  # 历史消息
+    draft = bool(data.get("draft", False))  # 草稿模式：先以 1K 快速出图
+    thought_policy = resolve_thought_policy(data)
     
     # 验证参数
     if aspect_ratio not in VALID_ASPECT_RATIOS:
         aspect_ratio = "1:1"
     if image_size not in VALID_IMAGE_SIZES:
         image_size = "1K"
+    if draft:
+        image_size = DRAFT_IMAGE_SIZE
+    asset_meta = request_asset_meta(data, "draft" if draft else "standard", aspect_ratio=aspect_ratio, image_size=image_size)
     
     if not prompt and not files:
         return jsonify({"error": "请输入提示词或上传文件"}), 400
+    if hidden_request_input(files, history):
+        return jsonify({"error": "文件不存在"}), 404
+    page_error = normalize_page_selections(files)
+    if page_error:
+        return jsonify({"error": page_error}), 400
+    rejected = reject_generation(request_user())
+    if rejected:
+        return rejected
+    input_paths = request_input_paths(files, history)
+    usage = new_usage_record(asset_meta, history, input_paths)
     
     def generate():
         try:
@@ -355,16 +4984,15 @@ def generate_image():
                 # 添加当前用户消息
                 current_parts = []
                 if prompt:
-                    current_parts.append(prompt)
+                    current_parts.append(types.Part.from_text(text=prompt))
                 for f in files:
                     filepath = find_image_file(f["filename"])
                     if filepath and filepath.exists():
-                        with open(filepath, "rb") as fp:
-                            file_data = fp.read()
-                        current_parts.append(types.Part.from_bytes(
-                            data=file_data,
-                            mime_type=f["mime_type"]
-                        ))
+                        for file_data, mime_type in load_file_inputs(filepath, f):
+                            current_parts.append(types.Part.from_bytes(
+                                data=file_data,
+                                mime_type=mime_type
+                            ))
                 if current_parts:
                     contents.append(types.Content(role="user", parts=current_parts))
                 print(f"📜 使用上下文记忆，共 {len(contents)} 轮消息")
@@ -375,14 +5003,13 @@ def generate_image():
                     parts.append(prompt)
                 
                 for f in files:
-                    filepath = UPLOADS_DIR / f["filename"]
-                    if filepath.exists():
-                        with open(filepath, "rb") as fp:
-                            file_data = fp.read()
-                        parts.append(types.Part.from_bytes(
-                            data=file_data,
-                            mime_type=f["mime_type"]
-                        ))
+                    filepath = resolve_asset(UPLOADS_DIR, f["filename"])
+                    if filepath:
+                        for file_data, mime_type in load_file_inputs(filepath, f):
+                            parts.append(types.Part.from_bytes(
+                                data=file_data,
+                                mime_type=mime_type
+                            ))
                 contents = parts
             
             # 配置响应模态
@@ -398,59 +5025,116 @@ def generate_image():
                 )
             )
             
-            yield f"data: {json.dumps({'type': 'start', 'message': '开始生成...'})}\n\n"
+            done_extra = None
+            if draft:
+                done_extra = draft_done_extra(cache_draft_request(contents, aspect_ratio, include_text, usage["user"]))
+            
+            yield f"data: {json.dumps({'type': 'status', 'message': '正在生成草稿...' if draft else '开始生成...'})}\n\n"
             
             print(f"🛰️ 请求模型: gemini-3-pro-image-preview, aspect_ratio={aspect_ratio}, image_size={image_size}")
-            response_stream = client.models.generate_content_stream(
-                model="gemini-3-pro-image-preview",
-                contents=contents,
-                config=config
+            yield from stream_generation(
+                client, contents, config,
+                done_message="草稿完成!" if draft else "生成完成!",
+                done_extra=done_extra,
+                thought_policy=thought_policy,
+                asset_meta=asset_meta,
+                usage=usage,
+                renditions=None if draft else request_renditions(data)
             )
-            
-            final_image_bytes = None
-            all_text = ""
-            thinking_text = ""
-            thinking_images = []
-            
-            for chunk in response_stream:
-                # 处理各个 part
-                if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
-                    for part in chunk.candidates[0].content.parts:
-                        # 检查是否是思考过程
-                        if hasattr(part, 'thought') and part.thought:
-                            if part.text:
-                                thinking_text += part.text
-                                yield f"data: {json.dumps({'type': 'thinking', 'text': part.text})}\n\n"
-                            elif part.inline_data:
-                                # 思考过程中的图片
-                                img_data = part.inline_data.data
-                                filename, img_b64 = save_image_from_bytes(img_data, "thought_")
-                                thinking_images.append({
-                                    "filename": filename,
-                                    "path": f"/generated/{filename}"
-                                })
-                                yield f"data: {json.dumps({'type': 'thinking_image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_b64})}\n\n"
-                        else:
-                            # 普通内容
-                            if part.text:
-                                all_text += part.text
-                                yield f"data: {json.dumps({'type': 'text', 'text': part.text})}\n\n"
-                            elif part.inline_data:
-                                final_image_bytes = part.inline_data.data
-                                print(f"🖼️ 收到图片分片: {len(final_image_bytes)} bytes")
-            
-            if final_image_bytes:
-                filename, img_base64 = save_image_from_bytes(final_image_bytes)
                 
-                yield f"data: {json.dumps({'type': 'image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_base64})}\n\n"
-                yield f"data: {json.dumps({'type': 'done', 'message': '生成完成!', 'full_text': all_text, 'thinking': thinking_text, 'thinking_images': thinking_images})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+    
+    return Response(
+        with_tenant_slot(usage["user"], with_generation_slot(request_priority(data), with_memory_budget(image_size, input_paths, with_usage(usage, generate())))),
+        mimetype="text/event-stream"
+    )
+
+
+@app.route("/api/generate/promote", methods=["POST"])
+def promote_draft():
+    """草稿定稿 (SSE 流式响应)：以草稿图和原始请求为上下文，输出 2K/4K 最终图"""
+    data = request.json or {}
+    draft_id = str(data.get("draft_id", ""))
+    image_size = str(data.get("image_size", "4K")).strip() or "4K"
+    prompt = str(data.get("prompt", "")).strip()  # 可选的补充说明
+    thought_policy = resolve_thought_policy(data)
+    
+    if image_size not in VALID_IMAGE_SIZES:
+        image_size = "4K"
+    
+    entry = get_draft_request(draft_id)
+    if entry and entry.get("user", DEFAULT_USER) != request_user():
+        return jsonify({"error": "草稿不存在"}), 404
+    if not entry or not entry["draft_filename"]:
+        return jsonify({"error": "草稿已过期，请重新生成"}), 410
+    draft_path = resolve_asset(GENERATED_DIR, entry["draft_filename"])
+    if not draft_path:
+        return jsonify({"error": "草稿图片不存在，请重新生成"}), 410
+    # 定稿沿用草稿的原始提示词
+    draft_meta = get_asset_meta(entry["draft_filename"]) or {}
+    asset_meta = request_asset_meta(
+        data, "promote", aspect_ratio=entry["aspect_ratio"], image_size=image_size,
+        parent=entry["draft_filename"], prompt=draft_meta.get("prompt")
+    )
+    rejected = reject_generation(request_user())
+    if rejected:
+        return rejected
+    usage = new_usage_record(asset_meta, input_paths=[draft_path])
+    
+    def generate():
+        try:
+            from google.genai import types
+            
+            client = get_vertex_client()
+            
+            # 复用缓存的请求内容：原请求 -> 模型草稿 -> 定稿指令
+            cached = entry["contents"]
+            if cached and isinstance(cached[0], types.Content):
+                contents = list(cached)
             else:
-                yield f"data: {json.dumps({'type': 'error', 'message': '未生成图片，可能被安全策略拦截'})}\n\n"
-                
+                contents = [types.Content(role="user", parts=[
+                    types.Part.from_text(text=p) if isinstance(p, str) else p for p in cached
+                ])]
+            with open(draft_path, "rb") as fp:
+                contents.append(types.Content(role="model", parts=[
+                    types.Part.from_bytes(data=fp.read(), mime_type="image/png")
+                ]))
+            instruction = "请以上面的草稿为基础，保持构图、主体、配色和文字内容不变，输出细节完整的高分辨率最终版本。"
+            if prompt:
+                instruction += f"补充要求：{prompt}"
+            contents.append(types.Content(role="user", parts=[types.Part.from_text(text=instruction)]))
+            
+            config = types.GenerateContentConfig(
+                response_modalities=["TEXT", "IMAGE"] if entry["include_text"] else ["IMAGE"],
+                image_config=types.ImageConfig(
+                    aspect_ratio=entry["aspect_ratio"],
+                    image_size=image_size
+                )
+            )
+            
+            yield f"data: {json.dumps({'type': 'status', 'message': f'正在生成 {image_size} 定稿...'})}\n\n"
+            
+            print(f"⬆️ 草稿定稿: {draft_id}, image_size={image_size}")
+            yield from stream_generation(
+                client, contents, config,
+                done_message="定稿完成!",
+                done_extra=lambda filename: {"promoted_from": draft_id},
+                thought_policy=thought_policy,
+                asset_meta=asset_meta,
+                usage=usage,
+                renditions=request_renditions(data)
+            )
+        
         except Exception as e:
+            import traceback
+            traceback.print_exc()
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
     
-    return Response(generate(), mimetype="text/event-stream")
+    return Response(
+        with_tenant_slot(usage["user"], with_generation_slot(request_priority(data), with_memory_budget(image_size, [draft_path], with_usage(usage, generate())))),
+        mimetype="text/event-stream"
+    )
 
 
 @app.route("/api/generate-with-search", methods=["POST"])
@@ -460,6 +5144,7 @@ def generate_with_search():
     prompt = data.get("prompt", "")
     aspect_ratio = str(data.get("aspect_ratio", "1:1")).strip() or "1:1"
     image_size = str(data.get("image_size", "1K")).strip() or "1K"
+    thought_policy = resolve_thought_policy(data)
     
     if aspect_ratio not in VALID_ASPECT_RATIOS:
         aspect_ratio = "1:1"
@@ -468,6 +5153,12 @@ def generate_with_search():
     
     if not prompt:
         return jsonify({"error": "请输入提示词"}), 400
+    asset_meta = request_asset_meta(data, "search", aspect_ratio=aspect_ratio, image_size=image_size)
+    renditions = request_renditions(data)
+    rejected = reject_generation(request_user())
+    if rejected:
+        return rejected
+    usage = new_usage_record(asset_meta)
     
     def generate():
         try:
@@ -487,92 +5178,184 @@ def generate_with_search():
                 tools=[google_search]
             )
             
-            yield f"data: {json.dumps({'type': 'start', 'message': '正在搜索并生成...'})}\n\n"
+            yield f"data: {json.dumps({'type': 'status', 'message': '正在搜索并生成...'})}\n\n"
             
             print(f"🔍 搜索增强生成: {prompt[:50]}...")
-            
-            # 使用非流式调用以获取完整的 grounding metadata
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=prompt,
-                config=config
+            yield from stream_generation(
+                client, prompt, config,
+                done_message="搜索增强生成完成!",
+                empty_message="未生成图片",
+                thought_policy=thought_policy,
+                asset_meta=asset_meta,
+                usage=usage,
+                renditions=renditions,
+                grounding=True
             )
-            
-            # 检查响应状态
-            if response.candidates[0].finish_reason != types.FinishReason.STOP:
-                reason = response.candidates[0].finish_reason
-                yield f"data: {json.dumps({'type': 'error', 'message': f'生成被中断: {reason}'})}\n\n"
-                return
-            
-            final_image_bytes = None
-            all_text = ""
-            thinking_text = ""
-            thinking_images = []
-            
-            for part in response.candidates[0].content.parts:
-                if hasattr(part, 'thought') and part.thought:
-                    if part.text:
-                        thinking_text += part.text
-                        yield f"data: {json.dumps({'type': 'thinking', 'text': part.text})}\n\n"
-                    elif part.inline_data:
-                        img_data = part.inline_data.data
-                        filename, img_b64 = save_image_from_bytes(img_data, "thought_")
-                        thinking_images.append({"filename": filename, "path": f"/generated/{filename}"})
-                        yield f"data: {json.dumps({'type': 'thinking_image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_b64})}\n\n"
-                else:
-                    if part.text:
-                        all_text += part.text
-                        yield f"data: {json.dumps({'type': 'text', 'text': part.text})}\n\n"
-                    elif part.inline_data:
-                        final_image_bytes = part.inline_data.data
-            
-            # 解析 grounding 数据
-            grounding_data = {}
-            if response.candidates[0].grounding_metadata:
-                grounding_data = parse_grounding_metadata(response.candidates[0].grounding_metadata)
-                yield f"data: {json.dumps({'type': 'grounding', 'data': grounding_data})}\n\n"
-            
-            if final_image_bytes:
-                filename, img_base64 = save_image_from_bytes(final_image_bytes)
-                
-                yield f"data: {json.dumps({'type': 'image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_base64})}\n\n"
-                yield f"data: {json.dumps({'type': 'done', 'message': '搜索增强生成完成!', 'full_text': all_text, 'thinking': thinking_text, 'thinking_images': thinking_images, 'grounding': grounding_data})}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'error', 'message': '未生成图片'})}\n\n"
-                
+        
         except Exception as e:
             import traceback
             traceback.print_exc()
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
     
-    return Response(generate(), mimetype="text/event-stream")
+    return Response(
+        with_tenant_slot(usage["user"], with_generation_slot(request_priority(data), with_memory_budget(image_size, [], with_usage(usage, generate())))),
+        mimetype="text/event-stream"
+    )
 
 
 def find_image_file(filename: str):
     """在 uploads 和 generated 目录中查找图片文件"""
-    # 先在 uploads 目录查找
-    filepath = UPLOADS_DIR / filename
-    if filepath.exists():
-        return filepath
+    # 文件名可能带有路径前缀（如 /generated/xxx.png），resolve_asset 只取最后一段
+    return resolve_asset(UPLOADS_DIR, filename) or resolve_asset(GENERATED_DIR, filename)
+
+
+# ============ 局部区域编辑 ============
+# 只把框选区域（或遮罩覆盖区域）加少量上下文裁剪后发送给模型，
+# 返回结果按原尺寸缩放后用羽化遮罩贴回原图，大图的局部修改不再整图上传。
+
+def parse_edit_region(region):
+    """解析归一化编辑区域 {x, y, width, height}（取值 0~1），无效时返回 None"""
+    if not isinstance(region, dict):
+        return None
+    try:
+        x, y, w, h = (float(region[k]) for k in ("x", "y", "width", "height"))
+    except (KeyError, TypeError, ValueError):
+        return None
+    x, y = min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+    w, h = min(w, 1.0 - x), min(h, 1.0 - y)
+    if w <= 0 or h <= 0:
+        return None
+    return x, y, w, h
+
+
+def closest_aspect_ratio(width: float, height: float) -> str:
+    """选择与给定宽高最接近的模型支持比例"""
+    def ratio(value):
+        rw, rh = value.split(":")
+        return int(rw) / int(rh)
+    return min(VALID_ASPECT_RATIOS, key=lambda r: abs(math.log((width / height) / ratio(r))))
+
+
+def expand_crop_box(bbox: tuple, image_size: tuple, margin: int, aspect_ratio: str) -> tuple:
+    """在目标区域四周加上下文，并扩展到指定比例（受原图边界限制）"""
+    left, top, right, bottom = bbox[0] - margin, bbox[1] - margin, bbox[2] + margin, bbox[3] + margin
+    rw, rh = (int(v) for v in aspect_ratio.split(":"))
+    w, h = right - left, bottom - top
+    if w * rh < h * rw:
+        extra = (h * rw / rh - w) / 2
+        left, right = left - extra, right + extra
+    else:
+        extra = (w * rh / rw - h) / 2
+        top, bottom = top - extra, bottom + extra
     
-    # 再在 generated 目录查找
-    filepath = GENERATED_DIR / filename
-    if filepath.exists():
-        return filepath
+    def fit(lo, hi, limit):
+        # 超出边界时整体平移，仍放不下则截断到原图范围
+        if hi - lo >= limit:
+            return 0, limit
+        if lo < 0:
+            lo, hi = 0, hi - lo
+        if hi > limit:
+            lo, hi = lo - (hi - limit), limit
+        return lo, hi
     
-    # 处理可能带有 edit_ 或其他前缀的文件名
-    # 也处理路径中可能包含的目录前缀
-    clean_filename = filename.split('/')[-1]  # 移除可能的路径前缀
+    left, right = fit(left, right, image_size[0])
+    top, bottom = fit(top, bottom, image_size[1])
     
-    filepath = UPLOADS_DIR / clean_filename
-    if filepath.exists():
-        return filepath
+    # 一条边被原图截断时，把另一条边收回到比例（不小于目标区域），否则贴回时会被拉伸变形
+    w, h = right - left, bottom - top
+    if w * rh > h * rw:
+        keep = max(h * rw / rh, min(bbox[2], image_size[0]) - max(bbox[0], 0))
+        center = (max(bbox[0], 0) + min(bbox[2], image_size[0])) / 2
+        left, right = fit(center - keep / 2, center + keep / 2, image_size[0])
+    elif w * rh < h * rw:
+        keep = max(w * rh / rw, min(bbox[3], image_size[1]) - max(bbox[1], 0))
+        center = (max(bbox[1], 0) + min(bbox[3], image_size[1])) / 2
+        top, bottom = fit(center - keep / 2, center + keep / 2, image_size[1])
+    return tuple(int(round(v)) for v in (left, top, right, bottom))
+
+
+def open_oriented_image(filepath: Path):
+    """打开图片并按 EXIF 旋转，返回已解码的 RGB/RGBA 图像"""
+    from PIL import Image, ImageOps
+    
+    with Image.open(filepath) as img:
+        if img.width * img.height > INGEST_MAX_PIXELS:
+            raise ValueError("图片像素过大")
+        img = ImageOps.exif_transpose(img)
+        return img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+
+def prepare_region_edit(filepath: Path, region=None, mask_path=None) -> dict:
+    """裁剪局部编辑区域（在 ingest 线程池中执行）
+
+    返回发送给模型的裁剪图，以及回贴需要的裁剪框、羽化遮罩、比例和输出分辨率
+    """
+    from PIL import Image, ImageDraw, ImageFilter, ImageOps
     
-    filepath = GENERATED_DIR / clean_filename
-    if filepath.exists():
-        return filepath
+    original = open_oriented_image(filepath)
+    width, height = original.size
     
-    return None
+    mask = None
+    if mask_path:
+        with Image.open(mask_path) as m:
+            mask = ImageOps.exif_transpose(m).convert("L").resize((width, height))
+        mask = mask.point(lambda v: 255 if v >= 128 else 0)
+        bbox = mask.getbbox()
+        if not bbox:
+            raise ValueError("遮罩中没有选中区域")
+    else:
+        x, y, w, h = region
+        bbox = (int(x * width), int(y * height),
+                max(int((x + w) * width), int(x * width) + 1),
+                max(int((y + h) * height), int(y * height) + 1))
+    
+    margin = max(REGION_MIN_CONTEXT, int(max(bbox[2] - bbox[0], bbox[3] - bbox[1]) * REGION_CONTEXT_RATIO))
+    aspect_ratio = closest_aspect_ratio(bbox[2] - bbox[0] + 2 * margin, bbox[3] - bbox[1] + 2 * margin)
+    crop_box = expand_crop_box(bbox, (width, height), margin, aspect_ratio)
+    # 目标区域本身比比例更宽或更高时裁剪框无法保持比例，按最终裁剪框重新选择
+    aspect_ratio = closest_aspect_ratio(crop_box[2] - crop_box[0], crop_box[3] - crop_box[1])
+    crop = original.crop(crop_box)
+    
+    needed_edge = max(crop.size)
+    image_size = next((name for name, edge in REGION_SIZE_STEPS if needed_edge <= edge), "4K")
+    
+    # 羽化遮罩：编辑区域为白色，边缘在上下文范围内渐变，避免贴回时出现接缝
+    if mask is None:
+        feather = Image.new("L", crop.size, 0)
+        ImageDraw.Draw(feather).rectangle(
+            (bbox[0] - crop_box[0], bbox[1] - crop_box[1], bbox[2] - crop_box[0] - 1, bbox[3] - crop_box[1] - 1),
+            fill=255
+        )
+    else:
+        feather = mask.crop(crop_box)
+    feather = feather.filter(ImageFilter.GaussianBlur(max(2, margin // 3)))
+    
+    crop.thumbnail((MODEL_INPUT_MAX_EDGE, MODEL_INPUT_MAX_EDGE), Image.LANCZOS)
+    buffer = BytesIO()
+    crop.save(buffer, format="PNG")
+    
+    return {
+        "crop_bytes": buffer.getvalue(),
+        "crop_box": crop_box,
+        "feather": feather,
+        "aspect_ratio": aspect_ratio,
+        "image_size": image_size
+    }
+
+
+def composite_region_edit(filepath: Path, plan: dict, edited_bytes: bytes) -> bytes:
+    """把模型返回的局部结果羽化贴回原图，返回完整图片的 PNG 字节"""
+    from PIL import Image
+    
+    original = open_oriented_image(filepath)
+    left, top, right, bottom = plan["crop_box"]
+    with Image.open(BytesIO(edited_bytes)) as edited:
+        edited = edited.convert(original.mode).resize((right - left, bottom - top), Image.LANCZOS)
+    original.paste(edited, (left, top), plan["feather"])
+    
+    buffer = BytesIO()
+    original.save(buffer, format="PNG")
+    return buffer.getvalue()
 
 
 @app.route("/api/edit-image", methods=["POST"])
@@ -584,6 +5367,9 @@ def edit_image():
     aspect_ratio = str(data.get("aspect_ratio", "")).strip()  # 编辑模式可能保持原比例
     image_size = str(data.get("image_size", "1K")).strip() or "1K"
     edit_type = data.get("edit_type", "general")  # general, translate, style
+    region = parse_edit_region(data.get("region"))  # 局部编辑：归一化框选区域
+    mask = data.get("mask")  # 局部编辑：遮罩图片 {"filename": ...}，白色为修改区域
+    thought_policy = resolve_thought_policy(data)
     
     if image_size not in VALID_IMAGE_SIZES:
         image_size = "1K"
@@ -593,6 +5379,27 @@ def edit_image():
     
     if not prompt:
         return jsonify({"error": "请输入编辑指令"}), 400
+    asset_meta = request_asset_meta(
+        data, "edit", aspect_ratio=aspect_ratio or None, image_size=image_size,
+        parent=str(files[0].get("filename", "")).split("/")[-1] or None
+    )
+    
+    mask_name = mask.get("filename") if isinstance(mask, dict) else None
+    if hidden_request_input(files, extra=(mask_name,) if mask_name else ()):
+        return jsonify({"error": "文件不存在"}), 404
+    mask_path = None
+    if mask_name:
+        mask_path = find_image_file(mask_name)
+        if not mask_path:
+            return jsonify({"error": "遮罩图片不存在"}), 400
+    page_error = normalize_page_selections(files)
+    if page_error:
+        return jsonify({"error": page_error}), 400
+    rejected = reject_generation(request_user())
+    if rejected:
+        return rejected
+    input_paths = request_input_paths(files)
+    usage = new_usage_record(asset_meta, input_paths=input_paths)
     
     def generate():
         try:
@@ -603,15 +5410,26 @@ def edit_image():
             # 构建内容 - 图片在前，指令在后
             contents = []
             
-            for f in files:
+            # 局部编辑：第一张图只发送裁剪区域，其余图片作为参考照常发送
+            region_plan = None
+            region_source = None
+            if region or mask_path:
+                region_source = find_image_file(files[0]["filename"])
+                if not region_source:
+                    yield f"data: {json.dumps({'type': 'error', 'message': '要编辑的图片不存在'})}\n\n"
+                    return
+                region_plan = _ingest_pool.submit(prepare_region_edit, region_source, region, mask_path).result()
+                contents.append(types.Part.from_bytes(data=region_plan["crop_bytes"], mime_type="image/png"))
+                print(f"✂️ 局部编辑: 裁剪 {region_plan['crop_box']}，比例 {region_plan['aspect_ratio']}，输出 {region_plan['image_size']}")
+            
+            for f in (files[1:] if region_plan else files):
                 filepath = find_image_file(f["filename"])
                 if filepath and filepath.exists():
-                    with open(filepath, "rb") as fp:
-                        file_data = fp.read()
-                    contents.append(types.Part.from_bytes(
-                        data=file_data,
-                        mime_type=f["mime_type"]
-                    ))
+                    for file_data, mime_type in load_file_inputs(filepath, f):
+                        contents.append(types.Part.from_bytes(
+                            data=file_data,
+                            mime_type=mime_type
+                        ))
                     print(f"📎 已加载图片: {filepath}")
             
             # 根据编辑类型构建提示
@@ -622,11 +5440,17 @@ def edit_image():
             else:
                 full_prompt = prompt
             
+            if region_plan:
+                full_prompt = f"第一张图片是原图中需要修改的局部区域（四周带有少量上下文），请只修改该区域，保持边缘与周围自然衔接、构图和尺寸不变：{full_prompt}"
+            
             contents.append(full_prompt)
             
             # 配置
             image_config_params = {"image_size": image_size}
-            if aspect_ratio and aspect_ratio in VALID_ASPECT_RATIOS:
+            if region_plan:
+                # 局部编辑按裁剪区域的比例和实际需要的分辨率请求
+                image_config_params = {"image_size": region_plan["image_size"], "aspect_ratio": region_plan["aspect_ratio"]}
+            elif aspect_ratio and aspect_ratio in VALID_ASPECT_RATIOS:
                 image_config_params["aspect_ratio"] = aspect_ratio
             
             config = types.GenerateContentConfig(
@@ -634,57 +5458,41 @@ def edit_image():
                 image_config=types.ImageConfig(**image_config_params)
             )
             
-            yield f"data: {json.dumps({'type': 'start', 'message': '正在编辑图片...'})}\n\n"
+            yield f"data: {json.dumps({'type': 'status', 'message': '正在编辑图片...'})}\n\n"
             
             print(f"✏️ 图像编辑: {full_prompt[:50]}...")
-            response_stream = client.models.generate_content_stream(
-                model="gemini-3-pro-image-preview",
-                contents=contents,
-                config=config
-            )
+            postprocess = None
+            if region_plan:
+                def postprocess(edited_bytes):
+                    return _ingest_pool.submit(composite_region_edit, region_source, region_plan, edited_bytes).result()
             
-            final_image_bytes = None
-            all_text = ""
-            thinking_text = ""
-            thinking_images = []
-            
-            for chunk in response_stream:
-                if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
-                    for part in chunk.candidates[0].content.parts:
-                        if hasattr(part, 'thought') and part.thought:
-                            if part.text:
-                                thinking_text += part.text
-                                yield f"data: {json.dumps({'type': 'thinking', 'text': part.text})}\n\n"
-                            elif part.inline_data:
-                                img_data = part.inline_data.data
-                                filename, img_b64 = save_image_from_bytes(img_data, "thought_")
-                                thinking_images.append({"filename": filename, "path": f"/generated/{filename}"})
-                                yield f"data: {json.dumps({'type': 'thinking_image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_b64})}\n\n"
-                        else:
-                            if part.text:
-                                all_text += part.text
-                                yield f"data: {json.dumps({'type': 'text', 'text': part.text})}\n\n"
-                            elif part.inline_data:
-                                final_image_bytes = part.inline_data.data
-                                print(f"🖼️ 编辑结果: {len(final_image_bytes)} bytes")
-            
-            if final_image_bytes:
-                filename, img_base64 = save_image_from_bytes(final_image_bytes, "edit_")
-                
-                yield f"data: {json.dumps({'type': 'image', 'filename': filename, 'path': f'/generated/{filename}', 'base64': img_base64})}\n\n"
-                yield f"data: {json.dumps({'type': 'done', 'message': '编辑完成!', 'full_text': all_text, 'thinking': thinking_text, 'thinking_images': thinking_images})}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'error', 'message': '编辑失败，未生成图片'})}\n\n"
+            yield from stream_generation(
+                client, contents, config,
+                image_prefix="edit_",
+                done_message="编辑完成!",
+                empty_message="编辑失败，未生成图片",
+                postprocess=postprocess,
+                thought_policy=thought_policy,
+                asset_meta=asset_meta,
+                usage=usage,
+                renditions=request_renditions(data)
+            )
                 
         except Exception as e:
             import traceback
             traceback.print_exc()
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
     
-    return Response(generate(), mimetype="text/event-stream")
+    # 局部编辑需要解码整张原图并回贴，按 4K 估算
+    budget_size = "4K" if (region or mask_path) else image_size
+    return Response(
+        with_tenant_slot(usage["user"], with_generation_slot(request_priority(data), with_memory_budget(budget_size, input_paths, with_usage(usage, generate())))),
+        mimetype="text/event-stream"
+    )
 
 
-if __name__ == "__main__":
+def run_server():
+    """启动 Web 服务"""
     print("=" * 50)
     print("🎨 Gemini 图片生成器 - 增强版")
     print("=" * 50)
@@ -706,4 +5514,110 @@ if __name__ == "__main__":
     print("  - GOOGLE_CLOUD_LOCATION (可选，默认 global)")
     print("=" * 50)
     
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    try:
+        build_static_assets()
+    except OSError as e:
+        print(f"⚠️ 生成静态资源失败，页面将使用未压缩的原始文件: {e}")
+    start_asset_migration()
+    start_asset_reindex()
+    start_search_reindex()
+    start_asset_gc()
+    app.run(host="0.0.0.0", port=5000, debug=DEBUG_MODE)
+
+
+def main(argv=None):
+    """命令行入口：默认启动服务，也提供维护命令"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Gemini 图片生成器")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("serve", help="启动 Web 服务（默认）")
+    migrate_parser = subparsers.add_parser("migrate-assets", help="把旧版平铺存放的文件迁移到分片目录")
+    migrate_parser.add_argument("--rate", type=float, default=0, help="每秒最多迁移的文件数，0 表示不限速")
+    gc_parser = subparsers.add_parser("gc", help="回收未被任何对话引用的文件，并执行配额淘汰")
+    gc_parser.add_argument("--dry-run", action="store_true", help="只输出报告，不删除文件")
+    gc_parser.add_argument("--rate", type=float, default=0, help="每秒最多删除的文件数，0 表示不限速")
+    subparsers.add_parser("reindex-assets", help="为元数据索引中缺失的已有文件补录元数据")
+    subparsers.add_parser("reindex-search", help="重建对话全文索引")
+    subparsers.add_parser("outline-details", help="把已有对话中的思考过程等大字段移到外置存储")
+    export_parser = subparsers.add_parser("export", help="把对话及其引用的文件导出为 tar 归档")
+    export_parser.add_argument("output", help="输出文件路径，- 表示标准输出")
+    export_parser.add_argument("--conversation", action="append", default=[], help="只导出指定对话（可重复）")
+    export_parser.add_argument("--user", default=DEFAULT_USER, help="导出哪个用户的对话")
+    import_parser = subparsers.add_parser("import", help="导入 export 生成的归档（中断后重新执行会继续）")
+    import_parser.add_argument("archive", help="归档文件路径")
+    import_parser.add_argument("--user", default=DEFAULT_USER, help="导入到哪个用户名下")
+    dedupe_parser = subparsers.add_parser("dedupe-report", help="列出 data/generated 中视觉上近似重复的图片")
+    dedupe_parser.add_argument("--max-distance", type=int, default=DUPLICATE_MAX_DISTANCE, help="判定为重复的最大汉明距离")
+    dedupe_parser.add_argument("--json", action="store_true", help="以 JSON 输出")
+    subparsers.add_parser("build-assets", help="生成带内容哈希的静态文件和预压缩版本（启动服务时也会自动执行）")
+    usage_parser = subparsers.add_parser("usage-report", help="汇总模型调用的 token 用量")
+    usage_parser.add_argument("--group", choices=list(USAGE_GROUPS), default="day", help="汇总维度")
+    usage_parser.add_argument("--days", type=int, default=7, help="统计最近几天，0 表示全部")
+    usage_parser.add_argument("--json", action="store_true", help="以 JSON 输出")
+    args = parser.parse_args(argv)
+    
+    if args.command == "migrate-assets":
+        moved = migrate_flat_assets(rate_limit=args.rate, verbose=True)
+        print(f"✅ 迁移完成，共移动 {moved} 个文件")
+    elif args.command == "gc":
+        plan = plan_asset_gc()
+        print(format_gc_report(plan))
+        if not args.dry_run:
+            removed, freed = sweep_assets(plan, rate_limit=args.rate)
+            print(f"✅ 已删除 {removed} 个文件，释放 {freed / (1024 * 1024):.1f} MB")
+    elif args.command == "reindex-assets":
+        added = reindex_assets(verbose=True)
+        print(f"✅ 索引完成，补录 {added} 个文件")
+    elif args.command == "reindex-search":
+        count = reindex_search(verbose=True)
+        print(f"✅ 全文索引完成，共 {count} 个对话")
+    elif args.command == "outline-details":
+        before = after = 0
+        for conv in iter_stored_conversations():
+            before += conversation_path(conv["id"], conv["owner"]).stat().st_size
+            outline_conversation(conv)
+            write_conversation(conv)
+            after += conversation_path(conv["id"], conv["owner"]).stat().st_size
+        print(f"✅ 对话存储 {before / 1024:.0f} KB -> {after / 1024:.0f} KB")
+    elif args.command == "export":
+        import sys
+        
+        out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            for chunk in iter_export_archive(args.conversation or None, normalize_user(args.user)):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        if args.output != "-":
+            print(f"✅ 已导出到 {args.output}（{Path(args.output).stat().st_size / (1024 * 1024):.1f} MB）")
+    elif args.command == "import":
+        archive_path = Path(args.archive).resolve()
+        stat = archive_path.stat()
+        user = normalize_user(args.user)
+        # 以归档路径、大小和目标用户标识导入任务，同一文件重复执行时从上次的位置继续
+        key = f"{archive_path}:{stat.st_size}" + ("" if user == DEFAULT_USER else f":{user}")
+        import_id = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        checkpoint = load_import_checkpoint(import_id)
+        if checkpoint and checkpoint["done"]:
+            import_checkpoint_path(import_id).unlink()  # 已完成的归档再次导入时重新扫描（已有数据会被跳过）
+        elif checkpoint:
+            print(f"⏯️ 从第 {checkpoint['conversations']} 个对话之后继续导入")
+        import_archive(archive_path, import_id, user, verbose=True)
+    elif args.command == "dedupe-report":
+        report = build_duplicate_report(args.max_distance)
+        print(json.dumps(report, ensure_ascii=False, indent=2) if args.json else format_duplicate_report(report))
+    elif args.command == "build-assets":
+        manifest = build_static_assets(verbose=True)
+        print(f"✅ 已生成 {len(manifest)} 个静态文件到 {STATIC_DIST_DIR}")
+    elif args.command == "usage-report":
+        since = (datetime.now() - timedelta(days=args.days - 1)).strftime("%Y-%m-%d") if args.days > 0 else None
+        items = summarize_usage(args.group, since, limit=1000)
+        print(json.dumps(items, ensure_ascii=False, indent=2) if args.json else format_usage_report(args.group, items))
+    else:
+        run_server()
+
+
+if __name__ == "__main__":
+    main()
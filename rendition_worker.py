@@ -0,0 +1,89 @@
+"""
+派生版本的图片处理（派生版本进程池的执行目标）
+
+只依赖标准库和 Pillow，导入时没有副作用。进程池以 spawn 启动子进程并按模块名导入执行目标，
+执行目标放在 app.py 中时，每个子进程都会重新执行 app 模块的启动逻辑（迁移数据、创建线程池、读取配置等）。
+"""
+
+import json
+import math
+import os
+import uuid
+
+RENDITION_MAX_PIXELS = 8192 * 8192  # 输出像素上限，超出时等比缩小（scale/width/height 组合可能放大到数亿像素）
+
+
+def render_rendition(source: str, target: str, preset: dict, stamp: dict) -> dict:
+    """按预设生成一个派生版本（在进程池中执行），返回尺寸和字节数"""
+    from PIL import Image, ImageOps, PngImagePlugin
+    
+    with Image.open(source) as img:
+        out = ImageOps.exif_transpose(img)
+        out.load()
+    
+    if preset.get("aspect"):
+        # 按目标比例居中裁剪
+        ratio = preset["aspect"][0] / preset["aspect"][1]
+        width, height = out.size
+        if width / height > ratio:
+            crop_w = round(height * ratio)
+            left = (width - crop_w) // 2
+            out = out.crop((left, 0, left + crop_w, height))
+        else:
+            crop_h = round(width / ratio)
+            top = (height - crop_h) // 2
+            out = out.crop((0, top, width, top + crop_h))
+    
+    width, height = out.size
+    factor = preset.get("scale", 1.0)
+    if preset.get("width") or preset.get("height"):
+        # 等比缩放到给定宽/高之内（可放大，用于打印尺寸）
+        factor = min(preset.get("width", math.inf) / width, preset.get("height", math.inf) / height)
+    if preset.get("max_edge"):
+        factor = min(factor, preset["max_edge"] / max(width, height))
+    factor = min(factor, math.sqrt(RENDITION_MAX_PIXELS / (width * height)))
+    if abs(factor - 1.0) > 1e-3:
+        out = out.resize((max(1, round(width * factor)), max(1, round(height * factor))), Image.LANCZOS)
+    
+    fmt = preset["format"]
+    has_alpha = out.mode in ("RGBA", "LA") or (out.mode == "P" and "transparency" in out.info)
+    if fmt == "JPEG" or not has_alpha:
+        if has_alpha:
+            # JPEG 不支持透明，铺在背景色上
+            rgba = out.convert("RGBA")
+            background = Image.new("RGB", rgba.size, preset["background"])
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            out = background
+        else:
+            out = out.convert("RGB")
+    else:
+        out = out.convert("RGBA")
+    
+    save_kwargs = {"format": fmt}
+    if fmt in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = preset["quality"]
+    if fmt == "PNG":
+        save_kwargs["optimize"] = True
+    if preset.get("dpi"):
+        save_kwargs["dpi"] = (preset["dpi"], preset["dpi"])
+    if "metadata" in preset:
+        fields = {**stamp, **preset["metadata"]}
+        if fmt == "PNG":
+            info = PngImagePlugin.PngInfo()
+            for key, value in fields.items():
+                info.add_itxt(key, value)
+            save_kwargs["pnginfo"] = info
+        else:
+            # EXIF 的文本标签只能存 ASCII，完整信息（含中文提示词）以 Unicode 写入 UserComment
+            exif = Image.Exif()
+            for tag, key in ((0x010E, "prompt"), (0x0131, "software"), (0x0132, "created"),
+                             (0x013B, "artist"), (0x8298, "copyright")):
+                if fields.get(key) and fields[key].isascii():
+                    exif[tag] = fields[key]
+            exif.get_ifd(0x8769)[0x9286] = b"UNICODE\0" + json.dumps(fields, ensure_ascii=False).encode("utf-16-le")
+            save_kwargs["exif"] = exif.tobytes()
+    
+    tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    out.save(tmp_path, **save_kwargs)
+    os.replace(tmp_path, target)
+    return {"width": out.size[0], "height": out.size[1], "bytes": os.path.getsize(target)}
@@ -11,9 +11,17 @@ const state = {
     isGenerating: false,
     currentMode: 'standard', // standard, search, edit
     settingsVisible: false,
-    enableContext: false  // 上下文窗口开关，默认关闭以节省算力
+    enableContext: false,  // 上下文窗口开关，默认关闭以节省算力
+    editRegion: null,  // 局部编辑区域（相对第一张图的归一化坐标）
+    draftMode: false,  // 草稿模式：先出 1K 草稿，满意后再定稿
+    changeSource: null,  // 当前对话的变更订阅 (EventSource)
+    renditionStatus: {}  // 派生版本路径 -> 本次会话中的生成状态（queued / done / error）
 };
 
+// 超过该大小的文件使用分片上传（可断点续传）
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const CHUNK_MAX_RETRIES = 5;
+
 // Mode configurations
 const modeConfig = {
     standard: {
@@ -42,6 +50,8 @@ const modeConfig = {
 // ============ DOM Elements ============
 const elements = {
     newChatBtn: document.getElementById('newChatBtn'),
+    galleryBtn: document.getElementById('galleryBtn'),
+    searchInput: document.getElementById('searchInput'),
     conversationsList: document.getElementById('conversationsList'),
     messagesContainer: document.getElementById('messagesContainer'),
     messagesList: document.getElementById('messagesList'),
@@ -52,6 +62,7 @@ const elements = {
     promptInput: document.getElementById('promptInput'),
     aspectRatio: document.getElementById('aspectRatio'),
     imageSize: document.getElementById('imageSize'),
+    thoughtImages: document.getElementById('thoughtImages'),
     editType: document.getElementById('editType'),
     editTypeGroup: document.getElementById('editTypeGroup'),
     sendBtn: document.getElementById('sendBtn'),
@@ -64,20 +75,47 @@ const elements = {
     downloadLink: document.getElementById('downloadLink'),
     mobileMenuBtn: document.getElementById('mobileMenuBtn'),
     sidebar: document.getElementById('sidebar'),
-    enableContext: document.getElementById('enableContext')
+    enableContext: document.getElementById('enableContext'),
+    enableDraft: document.getElementById('enableDraft')
 };
 
 // ============ Initialization ============
 document.addEventListener('DOMContentLoaded', () => {
+    registerServiceWorker();
     loadConversations();
     setupEventListeners();
     autoResizeTextarea();
     updateModeUI();
 });
 
+// Service Worker 在本地缓存对话和图片；缓存的对话列表在后台确认有变化时通知页面刷新
+function registerServiceWorker() {
+    if (!('serviceWorker' in navigator)) return;
+    navigator.serviceWorker.register('/sw.js').catch(error => {
+        console.warn('Service worker registration failed:', error);
+    });
+    navigator.serviceWorker.addEventListener('message', (event) => {
+        if (event.data?.type === 'data-updated' && new URL(event.data.url).pathname === '/api/conversations') {
+            refreshConversations();
+        }
+    });
+}
+
 function setupEventListeners() {
+    // 滚动或窗口尺寸变化时更新消息渲染窗口
+    elements.messagesContainer.addEventListener('scroll', scheduleMessageWindowUpdate, { passive: true });
+    window.addEventListener('resize', scheduleMessageWindowUpdate);
+
     // New Chat
     elements.newChatBtn.addEventListener('click', createNewConversation);
+    if (elements.galleryBtn) elements.galleryBtn.addEventListener('click', openGallery);
+    if (elements.searchInput) {
+        let searchTimer = null;
+        elements.searchInput.addEventListener('input', () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => runSearch(elements.searchInput.value.trim()), 250);
+        });
+    }
 
     // File Upload
     elements.uploadBtn.addEventListener('click', () => elements.fileInput.click());
@@ -120,6 +158,14 @@ function setupEventListeners() {
         });
     }
 
+    // Draft Toggle
+    if (elements.enableDraft) {
+        elements.enableDraft.addEventListener('change', (e) => {
+            state.draftMode = e.target.checked;
+            showToast(state.draftMode ? '已启用草稿模式，先生成 1K 草稿' : '已关闭草稿模式', 'info');
+        });
+    }
+
     // Mobile Menu
     if (elements.mobileMenuBtn) {
         elements.mobileMenuBtn.addEventListener('click', () => {
@@ -176,6 +222,7 @@ function setMode(mode) {
 
 function updateModeUI() {
     const config = modeConfig[state.currentMode];
+    renderUploadedFiles();
     
     // Update mode buttons
     document.querySelectorAll('.mode-btn').forEach(btn => {
@@ -214,6 +261,32 @@ async function loadConversations() {
     }
 }
 
+// 用最新的对话列表更新本地状态：本地序号更新的对话保持不变，当前对话只同步变化的消息
+async function refreshConversations() {
+    try {
+        const response = await fetch('/api/conversations');
+        const fresh = await response.json();
+        const local = new Map(state.conversations.map(c => [c.id, c]));
+        state.conversations = fresh.map(conv => {
+            const existing = local.get(conv.id);
+            if (existing && (existing.seq || 0) >= (conv.seq || 0)) return existing;
+            if (existing && conv.id === state.currentConversationId) {
+                Object.assign(existing, conv);
+                if (!state.isGenerating) syncMessages(existing.messages);
+                return existing;
+            }
+            return conv;
+        });
+        if (state.currentConversationId && !state.conversations.some(c => c.id === state.currentConversationId)) {
+            const current = local.get(state.currentConversationId);
+            if (current) state.conversations.unshift(current);  // 由变更订阅处理删除
+        }
+        renderConversationsList();
+    } catch (error) {
+        console.error('Failed to refresh conversations:', error);
+    }
+}
+
 function renderConversationsList() {
     elements.conversationsList.innerHTML = state.conversations.map(conv => `
         <div class="conversation-item ${conv.id === state.currentConversationId ? 'active' : ''}" 
@@ -237,6 +310,66 @@ function renderConversationsList() {
     `).join('');
 }
 
+// ============ Search ============
+const SEARCH_FIELD_LABELS = { title: '标题', prompt: '提示词', text: '回复', thinking: '思考', grounding: '搜索' };
+let searchSeq = 0;  // 丢弃过期请求的结果
+
+async function runSearch(query) {
+    const seq = ++searchSeq;
+    if (!query) {
+        renderConversationsList();
+        return;
+    }
+    try {
+        const response = await fetch(`/api/search?q=${encodeURIComponent(query)}&limit=50`);
+        const result = await response.json();
+        if (seq !== searchSeq) return;
+        if (result.error) throw new Error(result.error);
+        renderSearchResults(result);
+    } catch (error) {
+        if (seq === searchSeq) elements.conversationsList.innerHTML = `<div class="search-empty">搜索失败: ${escapeHtml(error.message)}</div>`;
+    }
+}
+
+// 片段按高亮区间拆分后分别转义，避免拼接 HTML
+function highlightSnippet(snippet, highlights) {
+    let html = '';
+    let last = 0;
+    for (const [start, end] of highlights) {
+        html += escapeHtml(snippet.slice(last, start)) + `<mark>${escapeHtml(snippet.slice(start, end))}</mark>`;
+        last = end;
+    }
+    return html + escapeHtml(snippet.slice(last));
+}
+
+function renderSearchResults(result) {
+    if (result.items.length === 0) {
+        elements.conversationsList.innerHTML = '<div class="search-empty">没有找到相关内容</div>';
+        return;
+    }
+    elements.conversationsList.innerHTML = `<div class="search-empty">共 ${result.total} 条结果</div>` + result.items.map(item => `
+        <div class="conversation-item search-result" onclick="openSearchResult('${item.conversation_id}', ${item.message_index ?? -1}, '${item.message_id || ''}')">
+            <div class="search-result-title">${escapeHtml(item.conversation_title || '新创作')} · ${SEARCH_FIELD_LABELS[item.field] || item.field}</div>
+            <div class="search-result-snippet">${highlightSnippet(item.snippet, item.highlights)}</div>
+        </div>
+    `).join('');
+}
+
+async function openSearchResult(convId, messageIndex, messageId = '') {
+    elements.searchInput.value = '';
+    searchSeq++;
+    await loadConversation(convId);
+    if (messageIndex < 0) return;
+    // 命中的消息不在当前分支上时先切换过去
+    const conv = state.conversations.find(c => c.id === convId);
+    if (messageId && conv && !conv.messages.some(m => m.id === messageId)) {
+        await switchBranch(messageId);
+    }
+    if (messageIndex < state.conversations.find(c => c.id === convId).messages.length) {
+        scrollToMessage(messageIndex);
+    }
+}
+
 // 开始编辑会话名称
 function startEditConversation(convId) {
     const conv = state.conversations.find(c => c.id === convId);
@@ -325,6 +458,7 @@ async function loadConversation(convId) {
     state.currentConversationId = convId;
     renderConversationsList();
     renderMessages(conv.messages || []);
+    subscribeConversation(convId);
 
     state.uploadedFiles = [];
     renderUploadedFiles();
@@ -339,57 +473,367 @@ async function deleteConversation(convId) {
 
     try {
         await fetch(`/api/conversations/${convId}`, { method: 'DELETE' });
-        state.conversations = state.conversations.filter(c => c.id !== convId);
+        removeConversationLocally(convId);
+    } catch (error) {
+        console.error('Failed to delete conversation:', error);
+    }
+}
 
-        if (state.currentConversationId === convId) {
-            state.currentConversationId = null;
-            if (state.conversations.length > 0) {
-                loadConversation(state.conversations[0].id);
-            } else {
-                renderMessages([]);
-                elements.welcomeScreen.style.display = 'flex';
+function removeConversationLocally(convId) {
+    state.conversations = state.conversations.filter(c => c.id !== convId);
+
+    if (state.currentConversationId === convId) {
+        state.currentConversationId = null;
+        if (state.changeSource) {
+            state.changeSource.close();
+            state.changeSource = null;
+        }
+        if (state.conversations.length > 0) {
+            loadConversation(state.conversations[0].id);
+        } else {
+            renderMessages([]);
+            elements.welcomeScreen.style.display = 'flex';
+        }
+    }
+    renderConversationsList();
+}
+
+// ============ 对话同步 ============
+// 订阅当前对话的变更（其他标签页的追加、删除、切换分支等），按序号应用差异，不重新下载整个对话
+function subscribeConversation(convId) {
+    if (state.changeSource) state.changeSource.close();
+    state.changeSource = null;
+    const conv = state.conversations.find(c => c.id === convId);
+    if (!conv || !window.EventSource) return;
+
+    const source = new EventSource(`/api/conversations/${convId}/events?since=${conv.seq || 0}`);
+    source.onmessage = (event) => {
+        try {
+            applyConversationChanges(convId, JSON.parse(event.data));
+        } catch (e) {
+            console.error('Sync error:', e);
+        }
+    };
+    source.onerror = () => {
+        // 断开后按最新序号重新订阅（EventSource 自动重连会沿用旧的 since）
+        source.close();
+        if (state.changeSource !== source) return;
+        state.changeSource = null;
+        setTimeout(() => {
+            if (state.currentConversationId === convId && !state.changeSource) subscribeConversation(convId);
+        }, 3000);
+    };
+    state.changeSource = source;
+}
+
+function applyConversationChanges(convId, data) {
+    const conv = state.conversations.find(c => c.id === convId);
+    if (!conv) return;
+
+    if (data.type === 'deleted') {
+        removeConversationLocally(convId);
+        return;
+    }
+    if (data.type === 'reset') {
+        Object.assign(conv, data.conversation);
+    } else {
+        for (const change of data.changes || []) {
+            if (change.seq <= (conv.seq || 0)) continue;  // 本标签页自己的修改已从接口结果中应用
+            const messages = conv.messages.slice(0, change.from).concat(change.messages);
+            if (messages.length !== change.length) {
+                // 本地列表与服务器不一致（如重试时截断过），重新订阅以获取完整的当前分支
+                conv.seq = 0;
+                subscribeConversation(convId);
+                return;
             }
+            conv.messages = messages;
+            conv.title = change.title;
+            conv.updated_at = change.updated_at;
+            conv.seq = change.seq;
         }
-        renderConversationsList();
-    } catch (error) {
-        console.error('Failed to delete conversation:', error);
+    }
+    renderConversationsList();
+    // 生成过程中列表末尾有尚未保存的消息，完成后会统一同步
+    if (convId === state.currentConversationId && !state.isGenerating) {
+        syncMessages(conv.messages);
     }
 }
 
-async function updateConversation(messages, title = null) {
+// 在 parentId 之后追加消息；parentId 已有后续时服务器会新建分支，返回当前分支的消息
+async function appendMessages(parentId, messages, title = null) {
     if (!state.currentConversationId) return;
 
-    const data = { messages };
+    const data = { parent_id: parentId, messages };
     if (title) data.title = title;
 
     try {
-        await fetch(`/api/conversations/${state.currentConversationId}`, {
-            method: 'PUT',
+        const response = await fetch(`/api/conversations/${state.currentConversationId}/messages`, {
+            method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify(data)
         });
+        const view = await response.json();
+        if (view.error) throw new Error(view.error);
 
-        const conv = state.conversations.find(c => c.id === state.currentConversationId);
+        const conv = state.conversations.find(c => c.id === view.id);
         if (conv) {
-            conv.messages = messages;
-            if (title) conv.title = title;
+            conv.messages = view.messages;
+            conv.title = view.title;
+            conv.seq = view.seq;
+            // 与服务器返回的结果同步（新建分支时显示分支切换，未保存的失败消息被移除）
+            if (view.id === state.currentConversationId) syncMessages(conv.messages);
             renderConversationsList();
         }
     } catch (error) {
-        console.error('Failed to update conversation:', error);
+        console.error('Failed to append messages:', error);
+    }
+}
+
+// 切换到包含 messageId 的分支
+async function switchBranch(messageId) {
+    if (!state.currentConversationId || state.isGenerating || !messageId) return;
+
+    try {
+        const response = await fetch(`/api/conversations/${state.currentConversationId}/branches/switch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ message_id: messageId })
+        });
+        const view = await response.json();
+        if (view.error) throw new Error(view.error);
+
+        const conv = state.conversations.find(c => c.id === view.id);
+        if (conv) {
+            conv.messages = view.messages;
+            conv.seq = view.seq;
+            if (view.id === state.currentConversationId) syncMessages(conv.messages);
+        }
+    } catch (error) {
+        console.error('Failed to switch branch:', error);
+        showToast('切换分支失败', 'error');
     }
 }
 
 // ============ Message Rendering ============
+// 消息列表按窗口渲染：只为可视区域附近的消息创建 DOM，窗口外的消息用列表上下内边距占位。
+// 高度未测量的消息按估计值计算，渲染后测量，图片加载等引起的变化由 ResizeObserver 更新。
+// 追加、删除、切换分支时只重建发生变化的消息之后的部分，工作量与对话长度无关。
+const MESSAGE_OVERSCAN_PX = 1200;  // 可视区域上下额外渲染的高度
+const MESSAGE_GAP = 28;            // 与 .messages-list 的 gap 一致
+const MESSAGE_LIST_PADDING = 24;   // 与 .messages-list 的 padding-bottom 一致
+
+const messageView = {
+    messages: [],
+    heights: [],       // 已测量的高度，未测量为 undefined
+    offsets: null,     // offsets[i] 为第 i 条消息的顶部位置（含间距），高度变化时置空重算
+    nodes: new Map(),  // 消息下标 -> 已渲染的元素
+    frame: 0
+};
+
+const messageResizeObserver = window.ResizeObserver ? new ResizeObserver(entries => {
+    const container = elements.messagesContainer;
+    const listTop = messageListTop();
+    let changed = false;
+    for (const entry of entries) {
+        const index = Number(entry.target.dataset.index);
+        const height = entry.target.offsetHeight;
+        if (!height || messageView.heights[index] === height) continue;
+        const previous = messageView.heights[index] ?? estimateMessageHeight(messageView.messages[index]);
+        const top = listTop + messageOffsets()[index];
+        messageView.heights[index] = height;
+        messageView.offsets = null;
+        changed = true;
+        // 可视区域上方的消息高度变化时补偿滚动位置，避免内容跳动
+        if (top + previous < container.scrollTop) container.scrollTop += height - previous;
+    }
+    if (changed) scheduleMessageWindowUpdate();
+}) : null;
+
+function estimateMessageHeight(msg) {
+    if (!msg) return 0;
+    if (msg.role === 'user') return msg.files?.length ? 180 : 90;
+    return msg.image ? 620 : 160;
+}
+
+function messageOffsets() {
+    if (!messageView.offsets) {
+        const { messages, heights } = messageView;
+        const offsets = new Array(messages.length + 1);
+        offsets[0] = 0;
+        for (let i = 0; i < messages.length; i++) {
+            offsets[i + 1] = offsets[i] + (heights[i] ?? estimateMessageHeight(messages[i])) + MESSAGE_GAP;
+        }
+        messageView.offsets = offsets;
+    }
+    return messageView.offsets;
+}
+
+// 顶部位置不超过 y 的最后一条消息
+function messageIndexAt(offsets, y) {
+    let low = 0;
+    let high = offsets.length - 2;
+    while (low < high) {
+        const mid = (low + high + 1) >> 1;
+        if (offsets[mid] <= y) low = mid;
+        else high = mid - 1;
+    }
+    return Math.max(0, low);
+}
+
+function messageListTop() {
+    const container = elements.messagesContainer;
+    return elements.messagesList.getBoundingClientRect().top - container.getBoundingClientRect().top + container.scrollTop;
+}
+
+function createMessageNode(index, animate) {
+    const template = document.createElement('template');
+    template.innerHTML = renderMessage(messageView.messages[index], index).trim();
+    const node = template.content.firstElementChild;
+    node.dataset.index = index;
+    if (!animate) node.style.animation = 'none';
+    if (messageResizeObserver) messageResizeObserver.observe(node);
+    return node;
+}
+
+function removeMessageNode(index) {
+    const node = messageView.nodes.get(index);
+    if (!node) return;
+    if (messageResizeObserver) messageResizeObserver.unobserve(node);
+    node.remove();
+    messageView.nodes.delete(index);
+}
+
+// 按当前滚动位置增删窗口内的消息元素；animateFrom 之后新建的元素播放入场动画
+function updateMessageWindow(animateFrom = Infinity) {
+    const { messages, nodes } = messageView;
+    const list = elements.messagesList;
+    const container = elements.messagesContainer;
+    const count = messages.length;
+    let offsets = messageOffsets();
+
+    const listTop = messageListTop();
+    const viewTop = container.scrollTop - listTop - MESSAGE_OVERSCAN_PX;
+    const viewBottom = container.scrollTop + container.clientHeight - listTop + MESSAGE_OVERSCAN_PX;
+    const start = count ? messageIndexAt(offsets, viewTop) : 0;
+    const end = count ? messageIndexAt(offsets, viewBottom) + 1 : 0;
+
+    for (const index of [...nodes.keys()]) {
+        if (index < start || index >= end) removeMessageNode(index);
+    }
+
+    // 从后往前插入，保证顺序；生成中的占位等非消息元素始终留在最后
+    const created = [];
+    let before = list.querySelector(':scope > :not([data-index])');
+    for (let i = end - 1; i >= start; i--) {
+        let node = nodes.get(i);
+        if (!node) {
+            node = createMessageNode(i, i >= animateFrom);
+            list.insertBefore(node, before);
+            nodes.set(i, node);
+            created.push(i);
+        }
+        before = node;
+    }
+
+    // 新元素立即测量，使占位高度准确
+    for (const i of created) {
+        const height = nodes.get(i).offsetHeight;
+        if (height && height !== messageView.heights[i]) {
+            messageView.heights[i] = height;
+            messageView.offsets = null;
+        }
+    }
+    offsets = messageOffsets();
+    list.style.paddingTop = `${offsets[start]}px`;
+    list.style.paddingBottom = `${offsets[count] - offsets[end] + MESSAGE_LIST_PADDING}px`;
+}
+
+function scheduleMessageWindowUpdate() {
+    if (messageView.frame) return;
+    messageView.frame = requestAnimationFrame(() => {
+        messageView.frame = 0;
+        updateMessageWindow();
+    });
+}
+
+function resetMessageView() {
+    for (const index of [...messageView.nodes.keys()]) removeMessageNode(index);
+    elements.messagesList.innerHTML = '';
+    messageView.messages = [];
+    messageView.heights = [];
+    messageView.offsets = null;
+}
+
+// 整体替换消息列表（切换对话时），滚动到底部
 function renderMessages(messages) {
-    if (messages.length === 0) {
-        elements.welcomeScreen.style.display = 'flex';
-        elements.messagesList.innerHTML = '';
-    } else {
-        elements.welcomeScreen.style.display = 'none';
-        elements.messagesList.innerHTML = messages.map((msg, i) => renderMessage(msg, i)).join('');
-        scrollToBottom();
+    resetMessageView();
+    messageView.messages = [...messages];
+    elements.welcomeScreen.style.display = messages.length === 0 ? 'flex' : 'none';
+    if (messages.length > 0) scrollToBottom();
+}
+
+// 把消息列表更新为 messages：相同前缀的消息保留已渲染的元素（内容变化的单独重建），之后的部分重新渲染
+function syncMessages(messages) {
+    const old = messageView.messages;
+    let prefix = 0;
+    while (prefix < old.length && prefix < messages.length && old[prefix].id && old[prefix].id === messages[prefix].id) {
+        prefix++;
+    }
+
+    for (let i = 0; i < prefix; i++) {
+        if (old[i] === messages[i] || messageSignature(old[i]) === messageSignature(messages[i])) continue;
+        messageView.messages[i] = messages[i];
+        messageView.heights[i] = undefined;
+        const node = messageView.nodes.get(i);
+        if (node) {
+            const fresh = createMessageNode(i, false);
+            if (messageResizeObserver) messageResizeObserver.unobserve(node);
+            node.replaceWith(fresh);
+            messageView.nodes.set(i, fresh);
+        }
     }
+    for (const index of [...messageView.nodes.keys()]) {
+        if (index >= prefix) removeMessageNode(index);
+    }
+
+    messageView.messages = [...messages];
+    messageView.heights.length = prefix;
+    messageView.offsets = null;
+    elements.welcomeScreen.style.display = messages.length === 0 && !elements.messagesList.children.length ? 'flex' : 'none';
+    updateMessageWindow();
+}
+
+// 影响渲染结果的可变字段（分支信息、外置摘要），用于判断已渲染的消息是否需要重建
+function messageSignature(msg) {
+    return JSON.stringify([msg.branch, msg.details?.fields, msg.image, msg.error, !!msg.thinking, !!msg.grounding]);
+}
+
+function scrollToMessage(index) {
+    const container = elements.messagesContainer;
+    container.scrollTop = messageListTop() + messageOffsets()[index] - container.clientHeight / 3;
+    updateMessageWindow();
+    messageView.nodes.get(index)?.scrollIntoView({ behavior: 'smooth', block: 'center' });
+}
+
+// 列表中缩略显示的小图（思考图片、上传文件预览）使用缩略图，原图只在点击查看时加载
+function thumbnailUrl(path) {
+    if (!path || path.startsWith('data:')) return path;
+    return `/thumbnails/${path.split('/').pop()}`;
+}
+
+
+function renderBranchSwitcher(msg) {
+    const branch = msg.branch;
+    if (!branch || branch.count < 2) return '';
+    const prev = branch.siblings[branch.index - 1];
+    const next = branch.siblings[branch.index + 1];
+    return `
+        <div class="branch-switcher">
+            <button onclick="switchBranch('${prev || ''}')" ${prev ? '' : 'disabled'} title="上一个版本">‹</button>
+            <span>${branch.index + 1} / ${branch.count}</span>
+            <button onclick="switchBranch('${next || ''}')" ${next ? '' : 'disabled'} title="下一个版本">›</button>
+        </div>
+    `;
 }
 
 function renderMessage(msg, index) {
@@ -399,19 +843,27 @@ function renderMessage(msg, index) {
             content += `<div class="uploaded-files-preview" style="margin-top: 10px;">
                 ${msg.files.map(f =>
                 f.mime_type.startsWith('image/')
-                    ? `<div class="file-preview-item"><img src="${f.path}" alt="Image" onclick="viewImage('${f.path}')"></div>`
+                    ? `<div class="file-preview-item"><img src="${thumbnailUrl(f.path)}" alt="Image" loading="lazy" decoding="async" onclick="viewImage('${f.path}')"></div>`
                     : `<span class="file-badge">📄 ${escapeHtml(f.original_name)}</span>`
             ).join('')}
             </div>`;
         }
         if (msg.mode) {
             const modeInfo = modeConfig[msg.mode];
-            content += `<div style="font-size: 11px; color: var(--text-muted); margin-top: 6px;">${modeInfo?.icon || ''} ${modeInfo?.label || msg.mode}</div>`;
+            const regionLabel = msg.region ? ' · 局部区域' : '';
+            content += `<div style="font-size: 11px; color: var(--text-muted); margin-top: 6px;">${modeInfo?.icon || ''} ${modeInfo?.label || msg.mode}${regionLabel}</div>`;
         }
+        content += renderBranchSwitcher(msg);
         
         // 用户消息操作按钮（放在气泡左侧）
         const userActions = `
             <div class="user-message-actions">
+                <button class="user-action-btn" onclick="retryMessage(${index}, false)" title="修改后重新发送">
+                    <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                        <path d="M12 20h9"></path>
+                        <path d="M16.5 3.5a2.121 2.121 0 0 1 3 3L7 19l-4 1 1-4L16.5 3.5z"></path>
+                    </svg>
+                </button>
                 <button class="user-action-btn" onclick="retryMessage(${index})" title="重试">
                     <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
                         <polyline points="23 4 23 10 17 10"></polyline>
@@ -435,7 +887,7 @@ function renderMessage(msg, index) {
             </div>
         `;
     } else {
-        let content = '';
+        let content = renderBranchSwitcher(msg);
 
         // Response Text
         if (msg.text) {
@@ -443,20 +895,25 @@ function renderMessage(msg, index) {
         }
 
         // Thinking Process with Timeline
+        const outlined = msg.details?.fields || {};
         if (msg.thinking || (msg.thinking_images && msg.thinking_images.length > 0)) {
             content += renderThinkingProcess(msg.thinking, msg.thinking_images);
+        } else if (outlined.thinking || outlined.thinking_images) {
+            content += renderThinkingStub(msg);
         }
 
         // Grounding Sources
         if (msg.grounding && (msg.grounding.sources?.length > 0 || msg.grounding.search_queries?.length > 0)) {
             content += renderGroundingSources(msg.grounding);
+        } else if (outlined.grounding !== undefined && !msg.grounding) {
+            content += `<div class="details-stub" onclick="loadGroundingDetails(this, '${msg.id}')">🔍 搜索来源 (${outlined.grounding}) · 点击加载</div>`;
         }
 
         // Image
         if (msg.image) {
             content += `
                 <div class="image-wrapper">
-                    <img class="generated-image" src="${msg.image}" alt="Generated Image" onclick="viewImage('${msg.image}')">
+                    <img class="generated-image" src="${msg.image}" alt="Generated Image" loading="lazy" decoding="async" onclick="viewImage('${msg.image}')">
                     <div class="image-actions">
                         <a href="${msg.image}" download class="image-action-btn">
                             <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
@@ -480,8 +937,17 @@ function renderMessage(msg, index) {
                             </svg>
                             编辑
                         </button>
+                        ${msg.draft_id ? `
+                        <button class="image-action-btn" onclick="promoteDraft('${msg.draft_id}')" title="以此草稿生成高分辨率版本">
+                            <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                                <polyline points="17 11 12 6 7 11"></polyline>
+                                <line x1="12" y1="18" x2="12" y2="6"></line>
+                            </svg>
+                            高清定稿
+                        </button>` : ''}
                     </div>
                 </div>
+                ${renderRenditionLinks(msg)}
             `;
         }
 
@@ -519,7 +985,7 @@ function renderThinkingProcess(thinking, thinkingImages = []) {
             <div class="thinking-images">
                 ${thinkingImages.map(img => `
                     <div class="thinking-image-item" onclick="viewImage('${img.path}')">
-                        <img src="${img.path}" alt="Thinking image">
+                        <img src="${thumbnailUrl(img.path)}" alt="Thinking image" loading="lazy" decoding="async">
                     </div>
                 `).join('')}
             </div>
@@ -542,6 +1008,54 @@ function renderThinkingProcess(thinking, thinkingImages = []) {
     `;
 }
 
+// 思考过程已外置：先渲染折叠的标题，展开时再加载
+function renderThinkingStub(msg) {
+    const fields = msg.details.fields;
+    const parts = [];
+    if (fields.thinking) parts.push(`${fields.thinking} 字`);
+    if (fields.thinking_images) parts.push(`${fields.thinking_images} 张图片`);
+    return `
+        <div class="thinking-process">
+            <div class="thinking-header" onclick="toggleThinking(this)" data-message-id="${msg.id}">
+                <svg width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                    <circle cx="12" cy="12" r="10"></circle>
+                    <path d="M9.09 9a3 3 0 0 1 5.83 1c0 2-3 3-3 3"></path>
+                    <line x1="12" y1="17" x2="12.01" y2="17"></line>
+                </svg>
+                <span>思考过程 <span style="font-weight: 400; color: var(--text-muted);">(${parts.join('，')})</span></span>
+                <svg class="chevron" width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" style="margin-left: auto; transform: rotate(-90deg);"><polyline points="6 9 12 15 18 9"></polyline></svg>
+            </div>
+            <div class="thinking-content hidden"></div>
+        </div>
+    `;
+}
+
+// 加载消息的外置详情，并合并回当前对话中的消息（之后保存对话时服务器会重新外置）
+async function loadMessageDetails(messageId) {
+    const conv = state.conversations.find(c => c.id === state.currentConversationId);
+    const msg = conv?.messages.find(m => m.id === messageId);
+    if (msg && !msg.details) return msg;
+
+    const response = await fetch(`/api/conversations/${state.currentConversationId}/messages/${encodeURIComponent(messageId)}/details`);
+    const details = await response.json();
+    if (details.error) throw new Error(details.error);
+    if (msg) {
+        Object.assign(msg, details);
+        delete msg.details;
+    }
+    return details;
+}
+
+async function loadGroundingDetails(stub, messageId) {
+    stub.textContent = '加载中...';
+    try {
+        const details = await loadMessageDetails(messageId);
+        stub.outerHTML = details.grounding ? renderGroundingSources(details.grounding) : '';
+    } catch (error) {
+        stub.textContent = '加载失败: ' + error.message;
+    }
+}
+
 function renderGroundingSources(grounding) {
     if (!grounding) return '';
 
@@ -587,8 +1101,23 @@ function renderGroundingSources(grounding) {
     `;
 }
 
-function toggleThinking(header) {
+async function toggleThinking(header) {
     const content = header.nextElementSibling;
+    const messageId = header.dataset.messageId;
+    if (messageId && !content.dataset.loaded) {
+        // 外置的思考过程首次展开时加载
+        content.dataset.loaded = '1';
+        content.textContent = '加载中...';
+        try {
+            const details = await loadMessageDetails(messageId);
+            const rendered = document.createElement('div');
+            rendered.innerHTML = renderThinkingProcess(details.thinking, details.thinking_images);
+            content.innerHTML = rendered.querySelector('.thinking-content')?.innerHTML || '';
+        } catch (error) {
+            delete content.dataset.loaded;
+            content.textContent = '加载失败: ' + error.message;
+        }
+    }
     content.classList.toggle('hidden');
     const chevron = header.querySelector('.chevron');
     if (chevron) {
@@ -611,7 +1140,8 @@ async function deleteMessage(index) {
             const conv = state.conversations.find(c => c.id === state.currentConversationId);
             if (conv) {
                 conv.messages = result.messages;
-                renderMessages(conv.messages || []);
+                conv.seq = result.seq;
+                syncMessages(conv.messages || []);
                 renderConversationsList();
             }
         } else {
@@ -657,12 +1187,9 @@ async function deleteUserMessage(index) {
         const result = await response.json();
 
         if (result.success) {
-            // 重新加载对话
-            const freshResponse = await fetch(`/api/conversations/${state.currentConversationId}`);
-            const freshConv = await freshResponse.json();
-            
-            conv.messages = freshConv.messages || [];
-            renderMessages(conv.messages);
+            conv.messages = result.messages || [];
+            conv.seq = result.seq;
+            syncMessages(conv.messages);
             renderConversationsList();
             showToast('消息已删除', 'success');
         }
@@ -672,8 +1199,9 @@ async function deleteUserMessage(index) {
     }
 }
 
-// 重试用户消息（重新发送这条消息）
-async function retryMessage(index) {
+// 重试用户消息（resend 为 false 时只填回输入框供修改）
+// 新消息会作为原消息的兄弟分支保存，原来的结果保留，可通过分支切换找回
+async function retryMessage(index, resend = true) {
     if (!state.currentConversationId || state.isGenerating) return;
     
     const conv = state.conversations.find(c => c.id === state.currentConversationId);
@@ -687,61 +1215,49 @@ async function retryMessage(index) {
     const files = msg.files || [];
     const mode = msg.mode || 'standard';
     
-    // 如果有后续的助理回复，先删除它
-    if (conv.messages[index + 1]?.role === 'assistant') {
-        try {
-            await fetch(
-                `/api/conversations/${state.currentConversationId}/messages/${index + 1}`,
-                { method: 'DELETE' }
-            );
-        } catch (e) {
-            console.error('Failed to delete old reply:', e);
-        }
-    }
-    
-    // 删除原用户消息
-    try {
-        await fetch(
-            `/api/conversations/${state.currentConversationId}/messages/${index}`,
-            { method: 'DELETE' }
-        );
-    } catch (e) {
-        console.error('Failed to delete original message:', e);
-    }
+    // 本地只保留这条消息之前的部分，新消息接在它的上一条之后
+    conv.messages = conv.messages.slice(0, index);
+    syncMessages(conv.messages);
     
     // 设置模式
     setMode(mode);
     
     // 设置上传的文件
+    state.editRegion = msg.region || null;
     state.uploadedFiles = files.map(f => ({
         filename: f.filename,
         original_name: f.original_name,
         mime_type: f.mime_type,
-        path: f.path
+        path: f.path,
+        page_count: f.page_count,
+        pages: f.pages
     }));
     renderUploadedFiles();
     
     // 设置提示词并发送
     elements.promptInput.value = prompt;
-    
-    // 重新加载对话以获取最新状态
-    const freshResponse = await fetch(`/api/conversations/${state.currentConversationId}`);
-    const freshConv = await freshResponse.json();
-    conv.messages = freshConv.messages || [];
-    renderMessages(conv.messages);
+    if (!resend) {
+        elements.promptInput.focus();
+        return;
+    }
     
     // 发送消息
     sendMessage();
 }
 
+// 在列表末尾追加一条消息（尚未保存，保存后由 syncMessages 与服务器结果对齐）
 function addMessage(msg) {
     elements.welcomeScreen.style.display = 'none';
-    elements.messagesList.insertAdjacentHTML('beforeend', renderMessage(msg, -1));
-    scrollToBottom();
+    messageView.messages.push(msg);
+    messageView.offsets = null;
+    scrollToBottom(messageView.messages.length - 1);
 }
 
-function scrollToBottom() {
-    elements.messagesContainer.scrollTop = elements.messagesContainer.scrollHeight;
+function scrollToBottom(animateFrom = Infinity) {
+    const container = elements.messagesContainer;
+    container.scrollTop = container.scrollHeight;
+    updateMessageWindow(animateFrom);
+    container.scrollTop = container.scrollHeight;
 }
 
 // ============ File Upload ============
@@ -768,8 +1284,13 @@ async function handleDrop(e) {
 }
 
 async function uploadFile(file) {
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        return uploadFileChunked(file);
+    }
+
     const formData = new FormData();
     formData.append('file', file);
+    if (state.currentConversationId) formData.append('conversation_id', state.currentConversationId);
 
     try {
         const response = await fetch('/api/upload', {
@@ -790,23 +1311,312 @@ async function uploadFile(file) {
     }
 }
 
+// 分片上传：逐片发送，失败自动重试，页面刷新后同一文件可从已确认的偏移量继续
+async function uploadFileChunked(file) {
+    const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+
+    try {
+        let session = null;
+        const savedId = localStorage.getItem(resumeKey);
+        if (savedId) {
+            const res = await fetch(`/api/upload/chunked/${savedId}`);
+            if (res.ok) session = await res.json();
+        }
+        if (!session) {
+            const res = await fetch('/api/upload/chunked', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size, conversation_id: state.currentConversationId })
+            });
+            session = await res.json();
+            if (session.error) {
+                alert('上传失败: ' + session.error);
+                return;
+            }
+            localStorage.setItem(resumeKey, session.upload_id);
+        }
+
+        let offset = session.offset;
+        let retries = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + session.chunk_size);
+            const headers = { 'Content-Type': 'application/octet-stream' };
+            const digest = await sha256Hex(chunk);
+            if (digest) headers['X-Chunk-SHA256'] = digest;
+
+            let res = null;
+            try {
+                res = await fetch(`/api/upload/chunked/${session.upload_id}?offset=${offset}`, {
+                    method: 'PUT',
+                    headers,
+                    body: chunk
+                });
+            } catch (error) {
+                // 网络中断：稍后从服务端确认的偏移量重试
+                console.warn('Chunk upload interrupted:', error);
+            }
+            if (res) {
+                const result = await res.json().catch(() => ({}));
+                if (res.status === 404) throw new Error(result.error || '上传会话已过期');
+                // 409/400 时服务端同样返回已确认的偏移量
+                if (typeof result.offset === 'number') offset = result.offset;
+                retries = res.ok ? 0 : retries + 1;
+            } else {
+                retries++;
+            }
+
+            if (retries > CHUNK_MAX_RETRIES) throw new Error('网络不稳定，请稍后重试（已上传部分会保留）');
+            if (retries > 0) await new Promise(r => setTimeout(r, 500 * 2 ** retries));
+            showToast(`上传中 ${Math.floor(offset * 100 / file.size)}%`, 'info');
+        }
+
+        const res = await fetch(`/api/upload/chunked/${session.upload_id}/complete`, { method: 'POST' });
+        const result = await res.json();
+        localStorage.removeItem(resumeKey);
+        if (result.error) {
+            alert('上传失败: ' + result.error);
+            return;
+        }
+
+        state.uploadedFiles.push(result);
+        renderUploadedFiles();
+        showToast('上传完成', 'success');
+    } catch (error) {
+        console.error('Chunked upload failed:', error);
+        showToast('上传失败: ' + error.message, 'error');
+    }
+}
+
+async function sha256Hex(blob) {
+    // crypto.subtle 仅在安全上下文（HTTPS/localhost）可用，否则跳过分片校验
+    if (!window.crypto?.subtle) return null;
+    const buffer = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(buffer)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
 function renderUploadedFiles() {
-    elements.uploadedFiles.innerHTML = state.uploadedFiles.map((f, i) => `
+    elements.uploadedFiles.innerHTML = state.uploadedFiles.map((f, i) => {
+        // 编辑模式下第一张图片可以框选局部区域
+        const canSelectRegion = i === 0 && state.currentMode === 'edit' && f.mime_type.startsWith('image/');
+        // PDF 可以只选择部分页发送（服务端只渲染并发送这些页）
+        const canSelectPages = f.mime_type === 'application/pdf' && f.page_count;
+        return `
         <div class="file-preview-item">
             ${f.mime_type.startsWith('image/')
             ? `<img src="${f.path}" alt="${escapeHtml(f.original_name)}">`
+            : canSelectPages
+            ? `<img src="/thumbnails/${f.filename}${f.pages ? `?page=${parseInt(f.pages, 10)}` : ''}" alt="${escapeHtml(f.original_name)}">`
             : `<div style="display:flex;align-items:center;justify-content:center;height:100%;font-size:24px;background:var(--glass-bg);">📄</div>`}
+            ${canSelectRegion ? `<button class="file-region-btn ${state.editRegion ? 'active' : ''}" onclick="openRegionSelector()" title="框选局部编辑区域">${state.editRegion ? '局部' : '框选'}</button>` : ''}
+            ${canSelectPages ? `<button class="file-region-btn ${f.pages ? 'active' : ''}" onclick="choosePdfPages(${i})" title="选择要发送的页（共 ${f.page_count} 页）">${f.pages ? `第${escapeHtml(f.pages)}页` : `${f.page_count}页`}</button>` : ''}
             <button class="file-remove-btn" onclick="removeUploadedFile(${i})">✕</button>
         </div>
-    `).join('');
+    `;
+    }).join('');
+}
+
+function choosePdfPages(index) {
+    const file = state.uploadedFiles[index];
+    if (!file) return;
+    const value = prompt(`选择要发送的页（共 ${file.page_count} 页，如 1-3,5），留空发送整个文件`, file.pages || '');
+    if (value === null) return;
+    file.pages = value.replace(/\s+/g, '') || undefined;
+    renderUploadedFiles();
 }
 
 function removeUploadedFile(index) {
     state.uploadedFiles.splice(index, 1);
+    if (index === 0) state.editRegion = null;
     renderUploadedFiles();
     updateModeUI();
 }
 
+// ============ Region Selection ============
+// 在第一张图片上拖动框选区域，发送时只把该区域交给模型修改，结果在服务端贴回原图
+function openRegionSelector() {
+    const file = state.uploadedFiles[0];
+    if (!file) return;
+
+    const overlay = document.createElement('div');
+    overlay.className = 'lightbox active region-selector';
+    overlay.innerHTML = `
+        <div class="lightbox-backdrop"></div>
+        <div class="lightbox-content">
+            <div class="region-stage">
+                <img src="${file.path}" alt="Select region" draggable="false">
+                <div class="region-box" hidden></div>
+            </div>
+            <div class="lightbox-controls">
+                <button class="btn-control" data-action="clear">整图编辑</button>
+                <button class="btn-control" data-action="cancel">取消</button>
+                <button class="btn-control primary" data-action="confirm">确定区域</button>
+            </div>
+        </div>
+    `;
+    document.body.appendChild(overlay);
+
+    const stage = overlay.querySelector('.region-stage');
+    const box = overlay.querySelector('.region-box');
+    let region = state.editRegion ? { ...state.editRegion } : null;
+    let start = null;
+
+    const drawBox = () => {
+        box.hidden = !region;
+        if (!region) return;
+        box.style.left = `${region.x * 100}%`;
+        box.style.top = `${region.y * 100}%`;
+        box.style.width = `${region.width * 100}%`;
+        box.style.height = `${region.height * 100}%`;
+    };
+    const toRelative = (e) => {
+        const rect = stage.getBoundingClientRect();
+        return {
+            x: Math.min(Math.max((e.clientX - rect.left) / rect.width, 0), 1),
+            y: Math.min(Math.max((e.clientY - rect.top) / rect.height, 0), 1)
+        };
+    };
+
+    stage.addEventListener('pointerdown', (e) => {
+        start = toRelative(e);
+        stage.setPointerCapture(e.pointerId);
+    });
+    stage.addEventListener('pointermove', (e) => {
+        if (!start) return;
+        const p = toRelative(e);
+        region = {
+            x: Math.min(start.x, p.x),
+            y: Math.min(start.y, p.y),
+            width: Math.abs(p.x - start.x),
+            height: Math.abs(p.y - start.y)
+        };
+        drawBox();
+    });
+    stage.addEventListener('pointerup', () => {
+        start = null;
+        if (region && (region.width < 0.01 || region.height < 0.01)) region = null;
+        drawBox();
+    });
+
+    overlay.querySelector('.lightbox-controls').addEventListener('click', (e) => {
+        const action = e.target.closest('button')?.dataset.action;
+        if (!action) return;
+        if (action === 'confirm') state.editRegion = region;
+        if (action === 'clear') state.editRegion = null;
+        overlay.remove();
+        renderUploadedFiles();
+        if (action === 'confirm' && region) showToast('将只修改框选区域', 'info');
+    });
+    drawBox();
+}
+
+// ============ Gallery ============
+// 跨对话浏览所有生成图片，按游标分页，滚动到底部时加载下一页
+const GALLERY_PAGE_SIZE = 60;
+const GALLERY_MODE_LABELS = { standard: '标准', search: '搜索', edit: '编辑', draft: '草稿', promote: '定稿' };
+
+function openGallery() {
+    const overlay = document.createElement('div');
+    overlay.className = 'lightbox active gallery';
+    overlay.innerHTML = `
+        <div class="lightbox-backdrop"></div>
+        <div class="gallery-panel">
+            <div class="gallery-toolbar">
+                <select class="setting-select" data-filter="mode">
+                    <option value="">全部模式</option>
+                    ${Object.entries(GALLERY_MODE_LABELS).map(([v, l]) => `<option value="${v}">${l}</option>`).join('')}
+                </select>
+                <select class="setting-select" data-filter="image_size">
+                    <option value="">全部尺寸</option>
+                    <option value="1K">1K</option>
+                    <option value="2K">2K</option>
+                    <option value="4K">4K</option>
+                </select>
+                <select class="setting-select" data-filter="aspect_ratio">
+                    <option value="">全部比例</option>
+                    ${Array.from(elements.aspectRatio.options).map(o => `<option value="${o.value}">${o.value}</option>`).join('')}
+                </select>
+                <input type="date" class="setting-select" data-filter="from" title="开始日期">
+                <input type="date" class="setting-select" data-filter="to" title="结束日期">
+                <button class="btn-control" data-action="close">关闭</button>
+            </div>
+            <div class="gallery-grid"></div>
+            <div class="gallery-status"></div>
+        </div>
+    `;
+    document.body.appendChild(overlay);
+
+    const grid = overlay.querySelector('.gallery-grid');
+    const status = overlay.querySelector('.gallery-status');
+    let cursor = null;
+    let loading = false;
+    let exhausted = false;
+    let generation = 0;  // 过滤条件变化后丢弃旧请求的结果
+
+    const loadPage = async () => {
+        if (loading || exhausted) return;
+        loading = true;
+        const current = generation;
+        status.textContent = '加载中...';
+
+        const params = new URLSearchParams({ limit: GALLERY_PAGE_SIZE });
+        overlay.querySelectorAll('[data-filter]').forEach(el => {
+            if (el.value) params.set(el.dataset.filter, el.value);
+        });
+        if (cursor) params.set('cursor', cursor);
+
+        try {
+            const response = await fetch(`/api/gallery?${params}`);
+            const result = await response.json();
+            if (current !== generation) return;
+            if (result.error) throw new Error(result.error);
+
+            grid.insertAdjacentHTML('beforeend', result.items.map(item => `
+                <div class="gallery-item" data-path="${item.path}" data-conversation="${item.conversation_id || ''}" title="${escapeHtml(item.prompt || '')}">
+                    <img src="${item.thumbnail}" loading="lazy" alt="">
+                    <span class="gallery-meta">${GALLERY_MODE_LABELS[item.mode] || ''} ${item.image_size || ''}</span>
+                </div>
+            `).join(''));
+            cursor = result.next_cursor;
+            exhausted = !cursor;
+            status.textContent = exhausted ? (grid.children.length ? '' : '暂无图片') : '';
+        } catch (error) {
+            status.textContent = '加载失败: ' + error.message;
+        } finally {
+            if (current === generation) loading = false;
+        }
+    };
+
+    const reset = () => {
+        generation++;
+        cursor = null;
+        loading = false;
+        exhausted = false;
+        grid.innerHTML = '';
+        loadPage();
+    };
+
+    overlay.querySelectorAll('[data-filter]').forEach(el => el.addEventListener('change', reset));
+    overlay.querySelector('[data-action="close"]').addEventListener('click', () => overlay.remove());
+    overlay.querySelector('.lightbox-backdrop').addEventListener('click', () => overlay.remove());
+    grid.addEventListener('click', (e) => {
+        const item = e.target.closest('.gallery-item');
+        if (!item) return;
+        // 所属对话仍存在时跳转到对话，否则直接查看大图
+        const convId = item.dataset.conversation;
+        if (convId && state.conversations.some(c => c.id === convId)) {
+            overlay.remove();
+            loadConversation(convId);
+        } else {
+            viewImage(item.dataset.path);
+        }
+    });
+    grid.addEventListener('scroll', () => {
+        if (grid.scrollTop + grid.clientHeight >= grid.scrollHeight - 200) loadPage();
+    });
+
+    loadPage();
+}
+
 // ============ Send & Stream ============
 async function sendMessage() {
     const prompt = elements.promptInput.value.trim();
@@ -816,6 +1626,8 @@ async function sendMessage() {
     const editType = elements.editType.value;
     const mode = state.currentMode;
     const config = modeConfig[mode];
+    const region = mode === 'edit' ? state.editRegion : null;
+    const draft = mode === 'standard' && state.draftMode;
 
     // Validation
     if (!prompt && files.length === 0) {
@@ -842,6 +1654,7 @@ async function sendMessage() {
 
     // User Message
     const userMessage = {
+        id: newMessageId(),
         role: 'user',
         text: prompt,
         mode: mode,
@@ -849,18 +1662,84 @@ async function sendMessage() {
             filename: f.filename,
             original_name: f.original_name,
             mime_type: f.mime_type,
-            path: f.path
+            path: f.path,
+            page_count: f.page_count,
+            pages: f.pages
         }))
     };
+    if (region) userMessage.region = region;
+    if (draft) userMessage.draft = true;
     addMessage(userMessage);
 
     // Clear Input
     elements.promptInput.value = '';
     elements.promptInput.style.height = 'auto';
     state.uploadedFiles = [];
+    state.editRegion = null;
     renderUploadedFiles();
     updateModeUI();
 
+    // Build request body based on mode
+    const requestBody = {
+        prompt,
+        aspect_ratio: aspectRatio,
+        image_size: imageSize,
+        include_text: true
+    };
+    if (elements.thoughtImages && elements.thoughtImages.value) {
+        requestBody.thought_images = elements.thoughtImages.value;
+    }
+
+    if (mode === 'standard' || mode === 'edit') {
+        requestBody.files = files.map(f => ({ filename: f.filename, mime_type: f.mime_type, pages: f.pages }));
+    }
+
+    if (mode === 'edit') {
+        requestBody.edit_type = editType;
+        if (region) requestBody.region = region;
+    }
+
+    if (draft) {
+        requestBody.draft = true;
+    }
+
+    // 如果启用了上下文记忆，由服务器沿当前分支取最近 3 轮对话作为上下文
+    if (state.enableContext) {
+        const conv = state.conversations.find(c => c.id === state.currentConversationId);
+        const lastMessage = conv?.messages?.[conv.messages.length - 1];
+        if (lastMessage?.id) {
+            requestBody.context_parent = lastMessage.id;
+        }
+    }
+
+    const title = prompt ? prompt.substring(0, 24) + (prompt.length > 24 ? '...' : '') : '图片生成';
+    await runGeneration(config.endpoint, requestBody, userMessage, title);
+}
+
+// 草稿定稿：以草稿和原请求为上下文生成高分辨率版本
+async function promoteDraft(draftId) {
+    if (state.isGenerating || !state.currentConversationId) return;
+
+    // 设置中选择的是 1K 时默认定稿为 4K
+    const imageSize = elements.imageSize.value === '1K' ? '4K' : elements.imageSize.value;
+    const userMessage = {
+        id: newMessageId(),
+        role: 'user',
+        text: `高清定稿 (${imageSize})`,
+        mode: 'standard',
+        files: []
+    };
+    addMessage(userMessage);
+
+    const requestBody = { draft_id: draftId, image_size: imageSize };
+    if (elements.thoughtImages && elements.thoughtImages.value) {
+        requestBody.thought_images = elements.thoughtImages.value;
+    }
+    await runGeneration('/api/generate/promote', requestBody, userMessage, null);
+}
+
+// 发送请求并处理 SSE 流，完成后保存到当前对话
+async function runGeneration(endpoint, requestBody, userMessage, title) {
     // Start Generation
     state.isGenerating = true;
     elements.sendBtn.disabled = true;
@@ -895,7 +1774,12 @@ async function sendMessage() {
     `);
     scrollToBottom();
 
+    // 新消息接在当前分支末尾（重试时为被重试消息的上一条）
+    const currentConv = state.conversations.find(c => c.id === state.currentConversationId);
+    const parentId = currentConv?.messages?.[currentConv.messages.length - 1]?.id || null;
+
     const assistantMessage = { 
+        id: newMessageId(),
         role: 'assistant', 
         thinking: '', 
         thinking_images: [],
@@ -904,44 +1788,23 @@ async function sendMessage() {
         grounding: null,
         error: null 
     };
+    // 供服务器记录生成图片的归属
+    requestBody.conversation_id = state.currentConversationId;
+    requestBody.message_id = assistantMessage.id;
 
     try {
-        // Build request body based on mode
-        const requestBody = {
-            prompt,
-            aspect_ratio: aspectRatio,
-            image_size: imageSize,
-            include_text: true
-        };
-
-        if (mode === 'standard' || mode === 'edit') {
-            requestBody.files = files.map(f => ({ filename: f.filename, mime_type: f.mime_type }));
-        }
-
-        if (mode === 'edit') {
-            requestBody.edit_type = editType;
-        }
-
-        // 如果启用了上下文记忆，添加历史消息
-        if (state.enableContext) {
-            const conv = state.conversations.find(c => c.id === state.currentConversationId);
-            if (conv && conv.messages && conv.messages.length > 0) {
-                // 只发送最近的几轮对话，避免 token 过多
-                const recentMessages = conv.messages.slice(-6);  // 最多 3 轮对话 (6条消息)
-                requestBody.history = recentMessages.map(m => ({
-                    role: m.role,
-                    text: m.text || '',
-                    image: m.image || null
-                }));
-            }
-        }
-
-        const response = await fetch(config.endpoint, {
+        // 网页端的请求使用 interactive 优先级，不会排在脚本批量任务后面
+        const response = await fetch(endpoint, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: { 'Content-Type': 'application/json', 'X-Priority': 'interactive' },
             body: JSON.stringify(requestBody)
         });
 
+        if (!response.ok && !response.headers.get('Content-Type')?.includes('text/event-stream')) {
+            const result = await response.json().catch(() => ({}));
+            throw new Error(result.error || `请求失败 (${response.status})`);
+        }
+
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
         let buffer = '';
@@ -972,9 +1835,7 @@ async function sendMessage() {
 
         // Update Title
         const conv = state.conversations.find(c => c.id === state.currentConversationId);
-        const messages = [...(conv?.messages || []), userMessage, assistantMessage];
-        const title = prompt ? prompt.substring(0, 24) + (prompt.length > 24 ? '...' : '') : '图片生成';
-        updateConversation(messages, conv?.title === '新对话' ? title : null);
+        appendMessages(parentId, [userMessage, assistantMessage], title && conv?.title === '新对话' ? title : null);
 
     } catch (error) {
         console.error('Generation failed:', error);
@@ -994,6 +1855,8 @@ function handleStreamData(data, loadingId, assistantMessage) {
 
     switch (data.type) {
         case 'start':
+        case 'queued':
+        case 'status':
             if (loadingText) loadingText.textContent = data.message;
             break;
 
@@ -1008,18 +1871,25 @@ function handleStreamData(data, loadingId, assistantMessage) {
             scrollToBottom();
             break;
 
-        case 'thinking_image':
-            assistantMessage.thinking_images.push({
-                filename: data.filename,
-                path: data.path
-            });
-            if (thinkingContainer && thinkingContent) {
+        case 'thinking_image': {
+            // 仅实时显示的思考图片没有 path，不写入对话
+            if (data.path) {
+                assistantMessage.thinking_images.push({
+                    filename: data.filename,
+                    path: data.path
+                });
+            }
+            // 优先用内联数据显示，服务器异步写盘期间也能立即看到
+            const src = data.base64 ? `data:${data.mime || 'image/png'};base64,${data.base64}` : data.path;
+            if (src && thinkingContainer && thinkingContent) {
                 thinkingContainer.style.display = 'block';
                 // Add image preview to thinking content
-                const imgHtml = `<div class="thinking-images"><div class="thinking-image-item" onclick="viewImage('${data.path}')"><img src="${data.path}" alt="Thinking"></div></div>`;
+                const onclick = data.path ? ` onclick="viewImage('${data.path}')"` : '';
+                const imgHtml = `<div class="thinking-images"><div class="thinking-image-item"${onclick}><img src="${src}" alt="Thinking"></div></div>`;
                 thinkingContent.insertAdjacentHTML('beforeend', imgHtml);
             }
             break;
+        }
 
         case 'text':
             assistantMessage.text += data.text;
@@ -1050,6 +1920,16 @@ function handleStreamData(data, loadingId, assistantMessage) {
             if (data.grounding) {
                 assistantMessage.grounding = data.grounding;
             }
+            if (data.draft_id) {
+                assistantMessage.draft_id = data.draft_id;
+            }
+            if (data.promoted_from) {
+                assistantMessage.promoted_from = data.promoted_from;
+            }
+            if (data.renditions && data.renditions.length > 0) {
+                assistantMessage.renditions = data.renditions.map(r => ({ preset: r.preset, path: r.path }));
+                watchRenditions(assistantMessage.image, data.renditions);
+            }
             break;
 
         case 'error':
@@ -1058,6 +1938,40 @@ function handleStreamData(data, loadingId, assistantMessage) {
     }
 }
 
+// ============ Renditions ============
+// 服务端在图片保存后于后台生成派生版本（社交尺寸、网页 JPEG/WebP、打印 PNG 等），这里订阅进度并更新下载链接
+function renditionLabel(preset, status) {
+    if (status === 'queued') return `${preset} · 生成中`;
+    if (status === 'error') return `${preset} · 失败`;
+    return preset;
+}
+
+function renderRenditionLinks(msg) {
+    if (!msg.renditions || msg.renditions.length === 0) return '';
+    return `<div class="rendition-links">${msg.renditions.map(r => {
+        const status = state.renditionStatus[r.path] || 'done';
+        return `<a href="${r.path}" download class="rendition-link ${status}" data-rendition="${r.path}">${escapeHtml(renditionLabel(r.preset, status))}</a>`;
+    }).join('')}</div>`;
+}
+
+function watchRenditions(imagePath, renditions) {
+    for (const r of renditions) state.renditionStatus[r.path] = r.status;
+    const events = new EventSource(`/api/renditions/${imagePath.split('/').pop()}/events`);
+    events.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === 'rendition') {
+            state.renditionStatus[data.path] = data.status;
+            document.querySelectorAll(`[data-rendition="${data.path}"]`).forEach(link => {
+                link.className = `rendition-link ${data.status}`;
+                link.textContent = renditionLabel(data.preset, data.status);
+            });
+        } else if (data.type === 'renditions_done') {
+            events.close();
+        }
+    };
+    events.onerror = () => events.close();
+}
+
 // ============ Image Viewer ============
 function viewImage(src) {
     elements.viewerImage.src = src;
@@ -1180,12 +2094,19 @@ function escapeHtml(text) {
     return div.innerHTML;
 }
 
+// 消息 ID：服务器据此把生成的图片关联到具体消息
+function newMessageId() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+}
+
 // Make functions globally accessible
 window.loadConversation = loadConversation;
 window.deleteConversation = deleteConversation;
 window.deleteMessage = deleteMessage;
 window.deleteUserMessage = deleteUserMessage;
 window.retryMessage = retryMessage;
+window.switchBranch = switchBranch;
 window.toggleThinking = toggleThinking;
 window.startEditConversation = startEditConversation;
 window.handleEditKeydown = handleEditKeydown;
@@ -1195,3 +2116,9 @@ window.closeImageViewer = closeImageViewer;
 window.removeUploadedFile = removeUploadedFile;
 window.copyImageToClipboard = copyImageToClipboard;
 window.editGeneratedImage = editGeneratedImage;
+window.openRegionSelector = openRegionSelector;
+window.choosePdfPages = choosePdfPages;
+window.promoteDraft = promoteDraft;
+window.openGallery = openGallery;
+window.openSearchResult = openSearchResult;
+window.loadGroundingDetails = loadGroundingDetails;
@@ -0,0 +1,104 @@
+/**
+ * Gemini Studio - Service Worker
+ * 本地缓存对话数据和图片，重新打开页面时先用缓存渲染，再向服务器确认是否有变化
+ *
+ * - 图片（/generated、/uploads、/thumbnails）文件名唯一、内容不变：缓存优先，按条数淘汰最早的
+ * - 对话列表与单个对话：先返回缓存，后台带 If-None-Match 重新验证，有变化时更新缓存并通知页面
+ * - 其他请求（生成、上传、SSE 订阅等）不经过缓存
+ */
+
+const CACHE_VERSION = 'v1';
+const DATA_CACHE = `nb-data-${CACHE_VERSION}`;
+const THUMB_CACHE = `nb-thumbs-${CACHE_VERSION}`;
+const IMAGE_CACHE = `nb-images-${CACHE_VERSION}`;
+const CACHE_LIMITS = {
+    [THUMB_CACHE]: 2000,
+    [IMAGE_CACHE]: 300
+};
+const TRIM_EVERY = 50;  // 每写入多少条检查一次缓存条数
+
+let writesSinceTrim = 0;
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (event) => {
+    const current = [DATA_CACHE, THUMB_CACHE, IMAGE_CACHE];
+    event.waitUntil((async () => {
+        for (const name of await caches.keys()) {
+            if (name.startsWith('nb-') && !current.includes(name)) await caches.delete(name);
+        }
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (url.pathname.startsWith('/thumbnails/')) {
+        event.respondWith(cacheFirst(request, THUMB_CACHE));
+    } else if (url.pathname.startsWith('/generated/') || url.pathname.startsWith('/uploads/')) {
+        event.respondWith(cacheFirst(request, IMAGE_CACHE));
+    } else if (/^\/api\/conversations(\/[^/]+)?$/.test(url.pathname)) {
+        event.respondWith(staleWhileRevalidate(event, request));
+    }
+});
+
+async function cacheFirst(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+
+    const response = await fetch(request);
+    if (response.ok && response.status === 200) {
+        await cache.put(request, response.clone());
+        if (++writesSinceTrim >= TRIM_EVERY) {
+            writesSinceTrim = 0;
+            trimCaches();
+        }
+    }
+    return response;
+}
+
+// 按插入顺序删除超出上限的条目（Cache Storage 的 keys() 按写入顺序返回）
+async function trimCaches() {
+    for (const [name, limit] of Object.entries(CACHE_LIMITS)) {
+        const cache = await caches.open(name);
+        const keys = await cache.keys();
+        for (const key of keys.slice(0, Math.max(0, keys.length - limit))) {
+            await cache.delete(key);
+        }
+    }
+}
+
+async function staleWhileRevalidate(event, request) {
+    const cache = await caches.open(DATA_CACHE);
+    const cached = await cache.match(request);
+    const revalidate = revalidateData(cache, request, cached);
+    if (!cached) return revalidate;
+    event.waitUntil(revalidate.catch(() => null));
+    return cached;
+}
+
+// 带上缓存的 ETag 向服务器确认；返回 304 时保留缓存，有变化时更新缓存并通知页面
+async function revalidateData(cache, request, cached) {
+    const headers = new Headers(request.headers);
+    const etag = cached?.headers.get('ETag');
+    if (etag) headers.set('If-None-Match', etag);
+
+    const response = await fetch(request.url, { headers, cache: 'no-store', credentials: 'same-origin' });
+    if (response.status === 304 && cached) return cached.clone();
+    if (response.ok) {
+        await cache.put(request, response.clone());
+        if (cached) notifyClients({ type: 'data-updated', url: request.url });
+    }
+    return response;
+}
+
+async function notifyClients(message) {
+    for (const client of await self.clients.matchAll({ type: 'window' })) {
+        client.postMessage(message);
+    }
+}
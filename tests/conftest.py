@@ -0,0 +1,104 @@
+"""测试夹具：在临时数据目录中导入 app，并用假的 Vertex 客户端代替真实的模型调用"""
+
+import json
+import os
+import sys
+import tempfile
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+# 必须在导入 app 之前设置：数据目录指向临时目录，关闭多用户令牌（load_dotenv 不会覆盖已有的环境变量）
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="nanobanana-test-")
+os.environ["USER_TOKENS"] = ""
+os.environ["ADMIN_USERS"] = ""
+os.environ["FLASK_DEBUG"] = ""
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app as app_module  # noqa: E402
+from google.genai import types  # noqa: E402
+
+
+def png_bytes(size=(256, 256), color=(200, 30, 30)) -> bytes:
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def sse_events(response) -> list:
+    """解析 SSE 响应中的全部事件"""
+    return [
+        json.loads(line[len("data: "):])
+        for line in response.get_data(as_text=True).split("\n\n")
+        if line.startswith("data: ")
+    ]
+
+
+class FakeModels:
+    """按分片返回：思考文本、思考图片、正文、最终图片"""
+
+    def __init__(self):
+        self.calls = []
+        self.out_size = (256, 256)
+        self.grounding = None
+
+    def parts(self):
+        return [
+            types.Part(text="thinking...", thought=True),
+            types.Part(inline_data=types.Blob(data=png_bytes((64, 64), (0, 0, 255)), mime_type="image/png"), thought=True),
+            types.Part(text="here you go"),
+            types.Part(inline_data=types.Blob(data=png_bytes(self.out_size), mime_type="image/png")),
+        ]
+
+    def response(self, parts, grounding=None):
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(
+                content=types.Content(role="model", parts=parts),
+                finish_reason=types.FinishReason.STOP,
+                grounding_metadata=grounding
+            )],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=100, candidates_token_count=1200, thoughts_token_count=50, total_token_count=1350
+            )
+        )
+
+    def generate_content_stream(self, model, contents, config):
+        self.calls.append((contents, config))
+        parts = self.parts()
+        for i, part in enumerate(parts):
+            yield self.response([part], self.grounding if i == len(parts) - 1 else None)
+
+
+class FakeClient:
+    def __init__(self):
+        self.models = FakeModels()
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    fake = FakeClient()
+    monkeypatch.setattr(app_module, "get_vertex_client", lambda: fake)
+    return fake.models
+
+
+@pytest.fixture
+def tokens(monkeypatch):
+    """启用令牌认证：alice / bob 两个用户，返回 用户 -> 请求头"""
+    monkeypatch.setattr(app_module, "USER_TOKENS", {"token-alice": "alice", "token-bob": "bob"})
+    return {
+        "alice": {"Authorization": "Bearer token-alice"},
+        "bob": {"Authorization": "Bearer token-bob"},
+    }
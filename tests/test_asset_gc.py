@@ -0,0 +1,63 @@
+"""资源回收：API 生成结果视为存活，删除对话后引用的文件成为孤儿，配额按层级淘汰"""
+
+import time
+
+from conftest import sse_events
+
+FUTURE = time.time() + 10 ** 9  # 超过保护期
+
+
+def generate(client, headers=None):
+    events = sse_events(client.post("/api/generate", json={"prompt": "x"}, headers=headers))
+    return next(e for e in events if e["type"] == "image")
+
+
+def planned_names(plan, key):
+    return {item["path"].name for item in plan[key]}
+
+
+def test_unlinked_api_image_kept(app, client, fake_model):
+    image = generate(client)
+    assert image["filename"] not in planned_names(app.plan_asset_gc(FUTURE), "orphans")
+
+
+def test_deleted_conversation_assets_collected(app, client, fake_model):
+    image = generate(client)
+    conv_id = client.post("/api/conversations", json={}).get_json()["id"]
+    client.post(f"/api/conversations/{conv_id}/messages", json={"messages": [
+        {"role": "user", "text": "x"}, {"role": "assistant", "image": image["path"]}
+    ]})
+    assert image["filename"] not in planned_names(app.plan_asset_gc(FUTURE), "orphans")
+    # 保护期内不回收
+    client.delete(f"/api/conversations/{conv_id}")
+    assert image["filename"] not in planned_names(app.plan_asset_gc(), "orphans")
+
+    plan = app.plan_asset_gc(FUTURE)
+    assert image["filename"] in planned_names(plan, "orphans")
+    plan["orphans"] = [o for o in plan["orphans"] if o["path"].name == image["filename"]]
+    plan["evictions"] = []
+    assert app.sweep_assets(plan, rate_limit=0)[0] == 1
+    assert app.get_asset_meta(image["filename"]) is None
+    assert client.get(image["path"]).status_code == 404
+
+
+def test_eviction_tiers(app):
+    assert app.asset_eviction_tier("thought_abc.png") == 0
+    assert app.asset_eviction_tier("abc.model.jpg") == 1
+    assert app.asset_eviction_tier("abc.png") == 2
+
+
+def test_global_quota_evicts_thoughts_first(app, client, fake_model, monkeypatch):
+    events = sse_events(client.post("/api/generate", json={"prompt": "x", "thought_images": "full"}))
+    thought = next(e for e in events if e["type"] == "thinking_image")["filename"]
+    image = next(e for e in events if e["type"] == "image")["filename"]
+    for _ in range(100):
+        if app.resolve_asset(app.GENERATED_DIR, thought):
+            break
+        time.sleep(0.02)
+
+    monkeypatch.setattr(app, "ASSET_QUOTA_BYTES", 1)
+    names = [e["path"].name for e in app.plan_asset_gc()["evictions"]]
+    assert names.index(thought) < names.index(image)
+    tiers = [app.asset_eviction_tier(name) for name in names]
+    assert tiers == sorted(tiers)
@@ -0,0 +1,45 @@
+"""资源元数据索引：生成和上传时写入，保存对话时关联，可按条件查询和补录"""
+
+import hashlib
+
+from conftest import png_bytes, sse_events
+
+
+def test_generated_image_indexed(app, client, fake_model):
+    headers = {"X-User": "indexer"}
+    events = sse_events(client.post(
+        "/api/generate", json={"prompt": "猫咪海报", "aspect_ratio": "16:9", "image_size": "2K"}, headers=headers
+    ))
+    image = next(e for e in events if e["type"] == "image")
+    meta = client.get(f"/api/assets/{image['filename']}", headers=headers).get_json()
+    data = app.resolve_asset(app.GENERATED_DIR, image["filename"]).read_bytes()
+    assert (meta["width"], meta["height"], meta["format"]) == (256, 256, "PNG")
+    assert meta["bytes"] == len(data) and meta["sha256"] == hashlib.sha256(data).hexdigest()
+    assert (meta["kind"], meta["mode"], meta["prompt"]) == ("generated", "standard", "猫咪海报")
+    assert (meta["aspect_ratio"], meta["image_size"]) == ("16:9", "2K")
+
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={"messages": [
+        {"role": "user", "text": "猫咪海报"}, {"role": "assistant", "image": image["path"]}
+    ]})
+    assert app.get_asset_meta(image["filename"])["conversation_id"] == conv_id
+
+
+def test_query_filters_and_summary(client, fake_model):
+    headers = {"X-User": "querier"}
+    for size in ("1K", "1K", "2K"):
+        sse_events(client.post("/api/generate", json={"prompt": "x", "image_size": size}, headers=headers))
+    body = client.get("/api/assets", query_string={"kind": "generated", "image_size": "1K"}, headers=headers).get_json()
+    assert body["summary"]["count"] == 2 and len(body["items"]) == 2
+    assert body["summary"]["bytes"] == sum(item["bytes"] for item in body["items"])
+    page = client.get("/api/assets", query_string={"kind": "generated", "limit": 1, "offset": 1}, headers=headers).get_json()
+    assert len(page["items"]) == 1
+    assert client.get("/api/assets", query_string={"limit": "x"}, headers=headers).status_code == 400
+
+
+def test_reindex_adds_missing_files(app):
+    filepath = app.asset_path(app.GENERATED_DIR, "reindex-me.png", create=True)
+    filepath.write_bytes(png_bytes((32, 16)))
+    assert app.reindex_assets() >= 1
+    meta = app.get_asset_meta("reindex-me.png")
+    assert (meta["width"], meta["height"], meta["user"]) == (32, 16, app.DEFAULT_USER)
@@ -0,0 +1,48 @@
+"""对话分支：重试在同一父消息下追加兄弟分支，原有消息保留，可切换回任一分支"""
+
+from conftest import sse_events
+
+
+def post_messages(client, conv_id, headers, messages, parent_id=None):
+    response = client.post(f"/api/conversations/{conv_id}/messages", headers=headers,
+                           json={"parent_id": parent_id, "messages": messages})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_retry_keeps_original_branch(client, request):
+    headers = {"X-User": f"branch-{request.node.name}"}
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    first = post_messages(client, conv_id, headers, [
+        {"role": "user", "text": "画一只猫"}, {"role": "assistant", "text": "第一版"}
+    ])["messages"]
+    user_id, original_id = first[0]["id"], first[1]["id"]
+
+    retried = post_messages(client, conv_id, headers, [{"role": "assistant", "text": "第二版"}], parent_id=user_id)
+    assert [m["text"] for m in retried["messages"]] == ["画一只猫", "第二版"]
+    assert retried["messages"][1]["branch"] == {"index": 1, "count": 2, "siblings": [original_id, retried["messages"][1]["id"]]}
+
+    branches = client.get(f"/api/conversations/{conv_id}/branches", query_string={"message_id": original_id},
+                          headers=headers).get_json()
+    assert [(b["preview"], b["active"]) for b in branches["items"]] == [("第一版", False), ("第二版", True)]
+
+    switched = client.post(f"/api/conversations/{conv_id}/branches/switch", json={"message_id": original_id},
+                           headers=headers).get_json()
+    assert [m["text"] for m in switched["messages"]] == ["画一只猫", "第一版"]
+    assert client.post(f"/api/conversations/{conv_id}/messages", headers=headers,
+                       json={"parent_id": "missing", "messages": [{"role": "user"}]}).status_code == 400
+
+
+def test_generation_context_follows_branch(client, fake_model, request):
+    headers = {"X-User": f"branch-{request.node.name}"}
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    messages = post_messages(client, conv_id, headers, [
+        {"role": "user", "text": "画一只猫"}, {"role": "assistant", "text": "橘猫"}
+    ])["messages"]
+    post_messages(client, conv_id, headers, [{"role": "assistant", "text": "黑猫"}], parent_id=messages[0]["id"])
+
+    sse_events(client.post("/api/generate", headers=headers, json={
+        "prompt": "加一顶帽子", "conversation_id": conv_id, "context_parent": messages[1]["id"]
+    }))
+    contents = fake_model.calls[0][0]
+    assert [c.parts[0].text for c in contents] == ["画一只猫", "橘猫", "加一顶帽子"]
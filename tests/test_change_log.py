@@ -0,0 +1,59 @@
+"""对话变更日志：按 seq 返回差异，客户端依次应用即可得到最新消息；日志不连续时返回完整视图"""
+
+import pytest
+
+from conftest import sse_events
+
+
+def apply_changes(messages: list, changes: list) -> list:
+    """与前端相同的应用方式"""
+    for change in changes:
+        messages = messages[:change["from"]] + change["messages"]
+        assert len(messages) == change["length"]
+    return messages
+
+
+@pytest.fixture
+def conversation(client, request):
+    headers = {"X-User": f"changes-{request.node.name}"}
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    return conv_id, headers
+
+
+def test_changes_reproduce_conversation(client, conversation):
+    conv_id, headers = conversation
+    base = client.get(f"/api/conversations/{conv_id}", headers=headers).get_json()
+    added = client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={"messages": [
+        {"role": "user", "text": "a"}, {"role": "assistant", "text": "b"}, {"role": "user", "text": "c"}
+    ]}).get_json()
+    client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={
+        "parent_id": added["messages"][0]["id"], "messages": [{"role": "assistant", "text": "b2"}]
+    })
+    client.delete(f"/api/conversations/{conv_id}/messages/0", headers=headers)
+
+    result = client.get(f"/api/conversations/{conv_id}/changes", query_string={"since": base["seq"]}, headers=headers).get_json()
+    assert [c["seq"] for c in result["changes"]] == [base["seq"] + 1, base["seq"] + 2, base["seq"] + 3]
+    current = client.get(f"/api/conversations/{conv_id}", headers=headers).get_json()
+    assert result["seq"] == current["seq"]
+    assert apply_changes(base["messages"], result["changes"]) == current["messages"]
+    assert [m["text"] for m in current["messages"]] == ["b2"]
+
+    up_to_date = client.get(f"/api/conversations/{conv_id}/changes", query_string={"since": current["seq"]}, headers=headers)
+    assert up_to_date.get_json() == {"seq": current["seq"], "changes": []}
+
+
+def test_reset_when_log_incomplete(app, client, conversation):
+    conv_id, headers = conversation
+    client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={"messages": [{"role": "user", "text": "a"}]})
+    app._change_logs.pop(conv_id)  # 模拟服务重启
+    result = client.get(f"/api/conversations/{conv_id}/changes", query_string={"since": 0}, headers=headers).get_json()
+    assert result["reset"] and [m["text"] for m in result["conversation"]["messages"]] == ["a"]
+
+
+def test_deleted_conversation_reported(client, conversation):
+    conv_id, headers = conversation
+    assert client.get(f"/api/conversations/{conv_id}/changes", headers={"X-User": "intruder"}).status_code == 404
+    client.delete(f"/api/conversations/{conv_id}", headers=headers)
+    assert client.get(f"/api/conversations/{conv_id}/changes", headers=headers).get_json()["deleted"]
+    events = sse_events(client.get(f"/api/conversations/{conv_id}/events", headers=headers))
+    assert [e["type"] for e in events] == ["deleted"]
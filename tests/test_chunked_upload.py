@@ -0,0 +1,89 @@
+"""分片上传：按偏移量续传、分片校验、完成后入库，锁表不残留"""
+
+import hashlib
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def noise_png():
+    buffer = BytesIO()
+    Image.frombytes("RGB", (256, 256), os.urandom(256 * 256 * 3)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def init_upload(client, data: bytes, **extra):
+    response = client.post("/api/upload/chunked", json={"filename": "photo.png", "size": len(data), **extra})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_resume_after_offset_mismatch(app, client, noise_png):
+    session = init_upload(client, noise_png, chunk_size=1, sha256=hashlib.sha256(noise_png).hexdigest())
+    upload_id, chunk_size = session["upload_id"], session["chunk_size"]
+    assert chunk_size == app.STREAM_BLOCK_SIZE  # 过小的分片按读写块大小
+
+    first = client.put(f"/api/upload/chunked/{upload_id}?offset=0", data=noise_png[:chunk_size])
+    assert first.get_json()["offset"] == chunk_size
+
+    # 客户端以为第一个分片丢失而重发：返回服务端已确认的位置
+    stale = client.put(f"/api/upload/chunked/{upload_id}?offset=0", data=noise_png[:chunk_size])
+    assert stale.status_code == 409
+    offset = stale.get_json()["offset"]
+    assert offset == chunk_size
+    assert client.get(f"/api/upload/chunked/{upload_id}").get_json()["offset"] == chunk_size
+
+    incomplete = client.post(f"/api/upload/chunked/{upload_id}/complete", json={})
+    assert incomplete.status_code == 409
+
+    while offset < len(noise_png):
+        offset = client.put(
+            f"/api/upload/chunked/{upload_id}?offset={offset}", data=noise_png[offset:offset + chunk_size]
+        ).get_json()["offset"]
+
+    result = client.post(f"/api/upload/chunked/{upload_id}/complete", json={}).get_json()
+    assert (result["width"], result["height"]) == (256, 256)
+    assert client.get(result["path"]).status_code == 200
+    assert client.get(f"/api/upload/chunked/{upload_id}").status_code == 404
+    assert upload_id not in app._upload_locks
+
+
+def test_chunk_checksum_mismatch_rolls_back(client, noise_png):
+    session = init_upload(client, noise_png)
+    upload_id = session["upload_id"]
+    chunk = noise_png[:1000]
+    response = client.put(
+        f"/api/upload/chunked/{upload_id}?offset=0", data=chunk, headers={"X-Chunk-SHA256": "0" * 64}
+    )
+    assert response.status_code == 400
+    assert response.get_json()["offset"] == 0
+    ok = client.put(
+        f"/api/upload/chunked/{upload_id}?offset=0", data=chunk,
+        headers={"X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest()}
+    )
+    assert ok.get_json()["offset"] == 1000
+
+
+def test_chunk_beyond_declared_size_rejected(client):
+    session = init_upload(client, b"x" * 10)
+    response = client.put(f"/api/upload/chunked/{session['upload_id']}?offset=0", data=b"x" * 11)
+    assert response.status_code == 413
+
+
+def test_session_private_and_abortable(client, tokens, noise_png):
+    response = client.post(
+        "/api/upload/chunked", json={"filename": "a.png", "size": len(noise_png)}, headers=tokens["alice"]
+    )
+    upload_id = response.get_json()["upload_id"]
+    assert client.get(f"/api/upload/chunked/{upload_id}", headers=tokens["bob"]).status_code == 404
+    assert client.delete(f"/api/upload/chunked/{upload_id}", headers=tokens["bob"]).status_code == 404
+    assert client.delete(f"/api/upload/chunked/{upload_id}", headers=tokens["alice"]).status_code == 200
+    assert client.get(f"/api/upload/chunked/{upload_id}", headers=tokens["alice"]).status_code == 404
+
+
+def test_invalid_upload_id(client):
+    assert client.get("/api/upload/chunked/../../etc").status_code == 404
+    assert client.put("/api/upload/chunked/not-a-uuid?offset=0", data=b"x").status_code == 404
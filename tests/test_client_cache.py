@@ -0,0 +1,36 @@
+"""客户端缓存：对话接口按 ETag 重新验证，文件和缩略图允许浏览器长期缓存"""
+
+from io import BytesIO
+
+from conftest import png_bytes
+
+
+def test_conversation_etag_revalidation(client, request):
+    headers = {"X-User": f"cache-{request.node.name}"}
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    for url in ("/api/conversations", f"/api/conversations/{conv_id}"):
+        first = client.get(url, headers=headers)
+        etag = first.headers["ETag"]
+        assert "no-cache" in first.headers["Cache-Control"]
+        assert client.get(url, headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    client.put(f"/api/conversations/{conv_id}", json={"title": "改名"}, headers=headers)
+    changed = client.get(f"/api/conversations/{conv_id}", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200 and changed.get_json()["title"] == "改名"
+    # 其他用户的对话列表使用不同的 ETag
+    other = client.get("/api/conversations", headers={"X-User": "cache-other"})
+    assert other.headers["ETag"] != client.get("/api/conversations", headers=headers).headers["ETag"]
+
+
+def test_files_and_thumbnails_immutable(client):
+    filename = client.post(
+        "/api/upload", data={"file": (BytesIO(png_bytes()), "a.png")}, content_type="multipart/form-data"
+    ).get_json()["filename"]
+    for url in (f"/uploads/{filename}", f"/thumbnails/{filename}"):
+        cache_control = client.get(url).headers["Cache-Control"]
+        assert "immutable" in cache_control and "private" in cache_control and "no-cache" not in cache_control
+
+
+def test_service_worker_served_from_root(client):
+    response = client.get("/sw.js")
+    assert response.status_code == 200 and response.headers["Cache-Control"] == "no-cache"
@@ -0,0 +1,52 @@
+"""性能诊断：慢请求记录、单个请求时间线和 X-Profile 采样，未配置令牌时通过 ADMIN_LOCAL 开启"""
+
+import pytest
+
+
+@pytest.fixture
+def admin_local(app, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_LOCAL", True)
+    monkeypatch.setattr(app, "FLIGHT_RECORDER_MIN_MS", 0)
+
+
+def test_debug_endpoints_closed_by_default(client):
+    assert client.get("/api/debug/slow-requests").status_code == 403
+    assert client.get("/api/debug/profiles").status_code == 403
+
+
+def test_admin_local_grants_default_user_only(app, client, admin_local):
+    assert app.is_admin(app.DEFAULT_USER)
+    assert not app.is_admin("mallory")
+    assert client.get("/api/debug/slow-requests").status_code == 200
+    assert client.get("/api/debug/slow-requests", headers={"X-User": "mallory"}).status_code == 403
+
+
+def test_admin_local_ignored_with_tokens(app, client, tokens, admin_local):
+    assert not app.is_admin(app.DEFAULT_USER)
+    assert client.get("/api/debug/slow-requests", headers=tokens["alice"]).status_code == 403
+
+
+def test_profiled_request_trace(client, admin_local):
+    response = client.get("/api/conversations", headers={"X-Profile": "1"})
+    trace_id = response.headers["X-Trace-Id"]
+    response.close()
+
+    ids = [item["id"] for item in client.get("/api/debug/slow-requests").get_json()["items"]]
+    assert trace_id in ids
+    detail = client.get(f"/api/debug/requests/{trace_id}").get_json()
+    assert detail["path"] == "/api/conversations" and detail["profiled"]
+    assert "cumulative" in detail["profile"]
+    assert client.get("/api/debug/requests/missing").status_code == 404
+
+
+def test_generation_trace_records_stages(client, fake_model, admin_local):
+    response = client.post("/api/generate", json={"prompt": "x"})
+    response.get_data()
+    trace_id = response.headers["X-Trace-Id"]
+    response.close()
+
+    detail = client.get(f"/api/debug/requests/{trace_id}").get_json()
+    assert {"vertex", "save_image"} <= set(detail["stage_totals_ms"])
+    chunks = [e for e in detail["events"] if e["name"] == "chunk"]
+    assert [c["kinds"] for c in chunks] == [["thought_text"], ["thought_image"], ["text"], ["image"]]
+    assert detail["first_byte_ms"] is not None and detail["response_bytes"] > 0
@@ -0,0 +1,41 @@
+"""草稿 -> 定稿：草稿以 1K 生成并缓存请求，定稿复用缓存内容和草稿图"""
+
+from conftest import sse_events
+
+
+def generate_draft(client, headers=None):
+    events = sse_events(client.post(
+        "/api/generate", json={"prompt": "猫咪海报", "image_size": "4K", "draft": True}, headers=headers
+    ))
+    return next(e for e in events if e["type"] == "done"), next(e for e in events if e["type"] == "image")
+
+
+def test_draft_generated_at_1k(app, client, fake_model):
+    done, image = generate_draft(client)
+    assert done["draft"] is True and done["draft_id"]
+    assert fake_model.calls[0][1].image_config.image_size == "1K"
+    assert app.get_asset_meta(image["filename"])["mode"] == "draft"
+
+
+def test_promote_reuses_request_and_draft(app, client, fake_model):
+    done, draft_image = generate_draft(client)
+    events = sse_events(client.post("/api/generate/promote", json={"draft_id": done["draft_id"], "image_size": "2K"}))
+    final = next(e for e in events if e["type"] == "done")
+    assert final["promoted_from"] == done["draft_id"]
+
+    contents, config = fake_model.calls[1]
+    assert config.image_config.image_size == "2K"
+    assert [c.role for c in contents] == ["user", "model", "user"]
+    assert contents[0].parts[0].text == "猫咪海报"
+    assert contents[1].parts[0].inline_data.data == app.resolve_asset(app.GENERATED_DIR, draft_image["filename"]).read_bytes()
+
+    image = next(e for e in events if e["type"] == "image")
+    meta = app.get_asset_meta(image["filename"])
+    assert meta["mode"] == "promote" and meta["parent"] == draft_image["filename"] and meta["prompt"] == "猫咪海报"
+
+
+def test_promote_unknown_or_foreign_draft(client, tokens, fake_model):
+    assert client.post("/api/generate/promote", json={"draft_id": "missing"}, headers=tokens["alice"]).status_code == 410
+    done, _ = generate_draft(client, tokens["alice"])
+    response = client.post("/api/generate/promote", json={"draft_id": done["draft_id"]}, headers=tokens["bob"])
+    assert response.status_code == 404
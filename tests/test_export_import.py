@@ -0,0 +1,124 @@
+"""导出/导入归档：往返恢复对话和文件、后台导入进度、跨用户的文件名冲突"""
+
+import io
+import tarfile
+import time
+
+import pytest
+
+from conftest import sse_events
+
+
+def create_conversation(client, headers):
+    events = sse_events(client.post("/api/generate", json={"prompt": "猫咪海报"}, headers=headers))
+    image = next(e for e in events if e["type"] == "image")
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    response = client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={"messages": [
+        {"role": "user", "text": "猫咪海报"},
+        {"role": "assistant", "text": "here you go", "image": image["path"]},
+    ]})
+    assert response.status_code == 200
+    return conv_id, image["filename"]
+
+
+def upload_archive(client, headers, data: bytes) -> str:
+    session = client.post(
+        "/api/upload/chunked", json={"filename": "backup.tar", "size": len(data), "purpose": "import"}, headers=headers
+    ).get_json()
+    upload_id, offset = session["upload_id"], 0
+    while offset < len(data):
+        chunk = data[offset:offset + session["chunk_size"]]
+        offset = client.put(f"/api/upload/chunked/{upload_id}?offset={offset}", data=chunk, headers=headers).get_json()["offset"]
+    response = client.post(f"/api/upload/chunked/{upload_id}/complete", json={}, headers=headers)
+    assert response.status_code == 202
+    assert response.get_json()["running"] is True
+    return upload_id
+
+
+def wait_import(client, headers, import_id) -> dict:
+    for _ in range(100):
+        status = client.get(f"/api/import/{import_id}", headers=headers).get_json()
+        if not status.get("running"):
+            return status
+        time.sleep(0.05)
+    pytest.fail("导入未在预期时间内结束")
+
+
+def remove_asset(app, filename):
+    app.resolve_asset(app.GENERATED_DIR, filename).unlink()
+    app.forget_assets([filename])
+
+
+def test_round_trip_restores_conversation_and_assets(app, client, tokens, fake_model):
+    alice = tokens["alice"]
+    conv_id, filename = create_conversation(client, alice)
+    archive = client.get(f"/api/export?conversation_id={conv_id}", headers=alice).get_data()
+
+    assert client.delete(f"/api/conversations/{conv_id}", headers=alice).status_code == 200
+    remove_asset(app, filename)
+
+    status = wait_import(client, alice, upload_archive(client, alice, archive))
+    assert status["done"] and "error" not in status
+    assert status["conversations"] == 1 and status["assets"] >= 1
+
+    conv = client.get(f"/api/conversations/{conv_id}", headers=alice).get_json()
+    assert [m["role"] for m in conv["messages"]] == ["user", "assistant"]
+    assert client.get(f"/generated/{filename}", headers=alice).status_code == 200
+    assert client.get("/api/search", query_string={"q": "海报"}, headers=alice).get_json()["total"] >= 1
+
+
+def test_export_archive_layout(client, tokens, fake_model):
+    alice = tokens["alice"]
+    conv_id, filename = create_conversation(client, alice)
+    client.post(f"/api/conversations/{conv_id}/messages", headers=alice, json={"messages": [
+        {"role": "assistant", "text": "same image again", "image": f"/generated/{filename}"}
+    ]})
+    response = client.get(f"/api/export?conversation_id={conv_id}", headers=alice)
+    assert response.mimetype == "application/x-tar"
+    with tarfile.open(fileobj=io.BytesIO(response.get_data())) as tar:
+        names = tar.getnames()
+    assert names[0] == "manifest.json"
+    assert f"conversations/{conv_id}.json" in names
+    assert len([n for n in names if n.startswith("blobs/")]) == 1  # 相同内容只写一次
+    assert client.get(f"/api/export?conversation_id={conv_id}", headers=tokens["bob"]).status_code == 404
+
+
+def test_reimport_skips_existing_data(client, tokens, fake_model):
+    alice = tokens["alice"]
+    conv_id, _ = create_conversation(client, alice)
+    archive = client.get(f"/api/export?conversation_id={conv_id}", headers=alice).get_data()
+
+    status = wait_import(client, alice, upload_archive(client, alice, archive))
+    assert status["done"]
+    assert status["assets"] == 0 and status["skipped_assets"] >= 1
+    conv = client.get(f"/api/conversations/{conv_id}", headers=alice).get_json()
+    assert len(conv["messages"]) == 2
+
+
+def test_import_fails_on_other_tenants_filename(client, tokens, fake_model):
+    alice, bob = tokens["alice"], tokens["bob"]
+    conv_id, filename = create_conversation(client, alice)
+    archive = client.get(f"/api/export?conversation_id={conv_id}", headers=alice).get_data()
+    client.delete(f"/api/conversations/{conv_id}", headers=alice)
+
+    status = wait_import(client, bob, upload_archive(client, bob, archive))
+    assert not status["done"]
+    assert filename in status["error"]
+    assert client.get(f"/api/conversations/{conv_id}", headers=bob).status_code == 404
+    assert client.get(f"/generated/{filename}", headers=bob).status_code == 404
+
+
+def test_import_status_hidden_from_other_tenant(client, tokens, fake_model):
+    alice = tokens["alice"]
+    conv_id, _ = create_conversation(client, alice)
+    archive = client.get(f"/api/export?conversation_id={conv_id}", headers=alice).get_data()
+    import_id = upload_archive(client, alice, archive)
+    wait_import(client, alice, import_id)
+    assert client.get(f"/api/import/{import_id}", headers=tokens["bob"]).status_code == 404
+
+
+def test_invalid_archive_reports_error(client, tokens):
+    alice = tokens["alice"]
+    status = wait_import(client, alice, upload_archive(client, alice, b"not a tar" * 100))
+    assert not status["done"]
+    assert status["error"].startswith("归档无效")
@@ -0,0 +1,54 @@
+"""画廊：按创建时间倒序的游标分页，同一时间戳的条目不重复不遗漏"""
+
+from datetime import datetime
+
+from conftest import png_bytes
+
+USER = {"X-User": "gallery"}
+
+
+def add_image(app, name, created_at, mode="standard"):
+    filepath = app.asset_path(app.GENERATED_DIR, name, create=True)
+    filepath.write_bytes(png_bytes((64, 64)))
+    app.index_asset(filepath, "generated", {"user": "gallery", "mode": mode}, created_at=created_at)
+
+
+def test_cursor_pagination_covers_all_items(app, client):
+    base = datetime(2024, 5, 1, 12).timestamp()
+    names = [f"gal-{i:02d}.png" for i in range(7)]
+    for i, name in enumerate(names):
+        add_image(app, name, base + i // 3)  # 每三个共用一个时间戳
+
+    seen, cursor = [], None
+    while True:
+        body = client.get("/api/gallery", query_string={"limit": 3, **({"cursor": cursor} if cursor else {})},
+                          headers=USER).get_json()
+        seen += [item["filename"] for item in body["items"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert sorted(seen) == names and len(seen) == len(set(seen))
+    created = [datetime.fromisoformat(i["created_at"]) for i in client.get(
+        "/api/gallery", query_string={"limit": 200}, headers=USER
+    ).get_json()["items"]]
+    assert created == sorted(created, reverse=True)
+
+
+def test_date_and_mode_filters(app, client):
+    add_image(app, "gal-old.png", datetime(2023, 1, 2, 8).timestamp(), mode="search")
+    body = client.get("/api/gallery", query_string={"from": "2023-01-02", "to": "2023-01-02"}, headers=USER).get_json()
+    assert [i["filename"] for i in body["items"]] == ["gal-old.png"]
+    body = client.get("/api/gallery", query_string={"mode": "search"}, headers=USER).get_json()
+    assert [i["filename"] for i in body["items"]] == ["gal-old.png"]
+    assert client.get("/api/gallery", query_string={"from": "yesterday"}, headers=USER).status_code == 400
+    assert client.get("/api/gallery", query_string={"cursor": "!!"}, headers=USER).status_code == 400
+
+
+def test_thumbnail_cached(app, client):
+    add_image(app, "gal-thumb.png", datetime(2024, 1, 1).timestamp())
+    items = client.get("/api/gallery", query_string={"mode": "standard", "limit": 200}, headers=USER).get_json()["items"]
+    thumb_url = next(i["thumbnail"] for i in items if i["filename"] == "gal-thumb.png")
+    response = client.get(thumb_url, headers=USER)
+    assert response.status_code == 200 and response.mimetype == "image/jpeg"
+    assert app.thumbnail_path(app.resolve_asset(app.GENERATED_DIR, "gal-thumb.png")).exists()
+    assert client.get(thumb_url, headers={"X-User": "someone-else"}).status_code == 404
@@ -0,0 +1,58 @@
+"""上传入库：校验图片、按 EXIF 方向旋转、缩小后生成 model-ready 版本"""
+
+from io import BytesIO
+
+from PIL import Image
+
+from conftest import png_bytes
+
+
+def upload(client, data: bytes, name: str):
+    return client.post(
+        "/api/upload", data={"file": (BytesIO(data), name)}, content_type="multipart/form-data"
+    )
+
+
+def jpeg_bytes(size, orientation=None) -> bytes:
+    buffer = BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    Image.new("RGB", size, (10, 120, 30)).save(buffer, format="JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_model_ready_png_kept_as_is(client):
+    result = upload(client, png_bytes((300, 200)), "ref.png").get_json()
+    assert (result["width"], result["height"]) == (300, 200)
+    assert "model_filename" not in result
+
+
+def test_exif_orientation_applied(app, client):
+    result = upload(client, jpeg_bytes((300, 200), orientation=6), "photo.jpg").get_json()
+    assert (result["width"], result["height"]) == (200, 300)
+    variant = app.find_model_variant(app.resolve_asset(app.UPLOADS_DIR, result["filename"]))
+    with Image.open(variant[0]) as img:
+        assert img.size == (200, 300)
+
+
+def test_large_image_downscaled_for_model(app, client, fake_model, monkeypatch):
+    monkeypatch.setattr(app, "MODEL_INPUT_MAX_EDGE", 128)
+    result = upload(client, png_bytes((512, 256)), "big.png").get_json()
+    assert (result["width"], result["height"]) == (512, 256)
+    assert result["model_filename"].endswith(".jpg")
+
+    client.post("/api/generate", json={"prompt": "x", "files": [{"filename": result["filename"]}]}).get_data()
+    sent = fake_model.calls[0][0][1]
+    assert sent.inline_data.mime_type == "image/jpeg"
+    with Image.open(BytesIO(sent.inline_data.data)) as img:
+        assert img.size == (128, 64)
+
+
+def test_corrupt_and_oversized_files_rejected(app, client, monkeypatch):
+    response = upload(client, b"\x89PNG\r\n\x1a\nnot really", "broken.png")
+    assert response.status_code == 400
+    monkeypatch.setattr(app, "INGEST_MAX_PIXELS", 1000)
+    response = upload(client, png_bytes((100, 100)), "bomb.png")
+    assert response.status_code == 400
+    assert "像素过大" in response.get_json()["error"]
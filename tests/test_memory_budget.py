@@ -0,0 +1,56 @@
+"""内存预算：按输出尺寸估算预留，预算不足时排队，超时拒绝，结束后释放"""
+
+import threading
+import time
+
+from conftest import sse_events
+
+
+def test_estimate_grows_with_size_and_inputs(app, tmp_path):
+    small, large = app.estimate_generation_memory("1K", []), app.estimate_generation_memory("4K", [])
+    assert large > small
+    ref = tmp_path / "ref.bin"
+    ref.write_bytes(b"x" * 1000)
+    assert app.estimate_generation_memory("1K", [ref]) == small + 3000
+
+
+def test_oversized_request_admitted_alone(app):
+    budget = app.MemoryBudget(100)
+    assert budget.acquire(500)
+    assert not budget.acquire(1)
+    budget.release(500)
+    assert budget.acquire(1)
+    assert budget.snapshot()["reserved_bytes"] == 1
+
+
+def test_waiter_admitted_after_release(app):
+    budget = app.MemoryBudget(100)
+    budget.acquire(80)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(budget.acquire(50, timeout=5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert budget.snapshot()["waiting"] == 1
+    budget.release(80)
+    waiter.join()
+    assert result == [True] and budget.snapshot()["peak_bytes"] == 80
+
+
+def test_generation_queued_then_rejected(app, client, fake_model, monkeypatch):
+    budget = app.MemoryBudget(app.estimate_generation_memory("1K", []))
+    budget.acquire(1)
+    monkeypatch.setattr(app, "memory_budget", budget)
+    monkeypatch.setattr(app, "MEMORY_QUEUE_TIMEOUT", 0.05)
+    events = sse_events(client.post("/api/generate", json={"prompt": "x"}))
+    assert [e["type"] for e in events if e["type"] in ("queued", "error")] == ["queued", "error"]
+    assert not fake_model.calls
+    assert budget.snapshot()["rejected"] == 1
+
+
+def test_budget_released_after_generation(app, client, fake_model, monkeypatch):
+    budget = app.MemoryBudget(10 ** 12)
+    monkeypatch.setattr(app, "memory_budget", budget)
+    sse_events(client.post("/api/generate", json={"prompt": "x", "image_size": "4K"}))
+    snapshot = budget.snapshot()
+    assert snapshot["admitted"] == 1 and snapshot["reserved_bytes"] == 0
+    assert snapshot["peak_bytes"] == app.estimate_generation_memory("4K", [])
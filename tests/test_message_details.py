@@ -0,0 +1,41 @@
+"""消息详情外置：思考过程等大字段单独压缩存储，对话只保留摘要，展开时按需加载"""
+
+import pytest
+
+THINKING = "先确定构图，再选择配色。" * 500
+GROUNDING = {"sources": [{"title": "Cats", "uri": "https://example.com"}], "search_queries": ["cats"]}
+
+
+@pytest.fixture
+def conversation(client, request):
+    headers = {"X-User": f"details-{request.node.name}"}
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={"messages": [
+        {"role": "user", "text": "猫咪海报"},
+        {"role": "assistant", "text": "好的", "thinking": THINKING, "grounding": GROUNDING},
+        {"role": "user", "text": "再来一张"},
+        {"role": "assistant", "text": "短回复", "thinking": "很短"},
+    ]})
+    return conv_id, headers
+
+
+def test_large_fields_outlined(app, client, conversation):
+    conv_id, headers = conversation
+    messages = client.get(f"/api/conversations/{conv_id}", headers=headers).get_json()["messages"]
+    outlined = messages[1]
+    assert "thinking" not in outlined and "grounding" not in outlined
+    assert outlined["details"]["fields"] == {"thinking": len(THINKING), "grounding": 1}
+    assert outlined["details"]["stored_bytes"] < outlined["details"]["bytes"]
+    assert messages[3]["thinking"] == "很短" and "details" not in messages[3]  # 内容很少时保持内联
+
+    details = client.get(f"/api/conversations/{conv_id}/messages/{outlined['id']}/details", headers=headers).get_json()
+    assert details == {"thinking": THINKING, "grounding": GROUNDING}
+
+
+def test_details_private_and_removed_with_conversation(app, client, conversation):
+    conv_id, headers = conversation
+    msg_id = client.get(f"/api/conversations/{conv_id}", headers=headers).get_json()["messages"][1]["id"]
+    url = f"/api/conversations/{conv_id}/messages/{msg_id}/details"
+    assert client.get(url, headers={"X-User": "intruder"}).status_code == 404
+    client.delete(f"/api/conversations/{conv_id}", headers=headers)
+    assert not app.details_path(conv_id, msg_id).exists()
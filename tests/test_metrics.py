@@ -0,0 +1,15 @@
+"""运行指标：单用户部署可直接查看，多用户时仅管理员"""
+
+
+def test_metrics_visible_to_default_user_without_tokens(client):
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert "memory" in body and "scheduler" in body
+    assert client.get("/api/metrics", headers={"X-User": "mallory"}).status_code == 403
+
+
+def test_metrics_admin_only_with_tokens(app, client, tokens, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_USERS", {"alice"})
+    assert client.get("/api/metrics", headers=tokens["alice"]).status_code == 200
+    assert client.get("/api/metrics", headers=tokens["bob"]).status_code == 403
@@ -0,0 +1,61 @@
+"""PDF 输入：上传时读取页数，按所选页渲染为图片发送给模型，渲染结果缓存"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from conftest import png_bytes, sse_events
+
+pytest.importorskip("pypdfium2")
+
+
+def pdf_bytes(pages=3) -> bytes:
+    images = [Image.new("RGB", (400, 300), color) for color in ("red", "green", "blue", "white")[:pages]]
+    buffer = BytesIO()
+    images[0].save(buffer, format="PDF", save_all=True, append_images=images[1:])
+    return buffer.getvalue()
+
+
+def upload(client, data: bytes, name: str) -> dict:
+    response = client.post("/api/upload", data={"file": (BytesIO(data), name)}, content_type="multipart/form-data")
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_parse_page_selection(app):
+    assert app.parse_page_selection("1-3,5,2", 6) == [1, 2, 3, 5]
+    assert app.parse_page_selection([4, "1"], 6) == [4, 1]
+    assert app.format_page_selection([5, 1, 2, 3]) == "1-3,5"
+    for bad in ("0", "7", "3-1", "x", [], "1-"):
+        with pytest.raises(ValueError):
+            app.parse_page_selection(bad, 6)
+
+
+def test_selected_pages_sent_as_images(app, client, fake_model):
+    pdf = upload(client, pdf_bytes(), "deck.pdf")
+    assert pdf["page_count"] == 3 and pdf["mime_type"] == "application/pdf"
+    pages = client.get(f"/api/pdf/{pdf['filename']}/pages").get_json()
+    assert pages["page_count"] == 3
+
+    sse_events(client.post("/api/generate", json={
+        "prompt": "总结", "files": [{"filename": pdf["filename"], "pages": "1,3"}]
+    }))
+    sent = [p for p in fake_model.calls[0][0] if not isinstance(p, str)]
+    assert [p.inline_data.mime_type for p in sent] == ["image/jpeg", "image/jpeg"]
+    with Image.open(BytesIO(sent[1].inline_data.data)) as img:
+        assert img.getpixel((img.width // 2, img.height // 2))[2] > 200  # 第 3 页是蓝色
+    source = app.resolve_asset(app.UPLOADS_DIR, pdf["filename"])
+    assert app.pdf_page_path(source, 1).exists() and not app.pdf_page_path(source, 2).exists()
+    assert client.get(f"/thumbnails/{pdf['filename']}", query_string={"page": 2}).status_code == 200
+    assert client.get(f"/thumbnails/{pdf['filename']}", query_string={"page": 9}).status_code == 404
+
+
+def test_invalid_page_requests_rejected(client, fake_model):
+    pdf = upload(client, pdf_bytes(2), "short.pdf")
+    image = upload(client, png_bytes(), "photo.png")
+    for files in ([{"filename": pdf["filename"], "pages": "5"}], [{"filename": image["filename"], "pages": [1]}]):
+        assert client.post("/api/generate", json={"prompt": "x", "files": files}).status_code == 400
+    assert client.post("/api/upload", data={"file": (BytesIO(b"%PDF-1.4 broken"), "bad.pdf")},
+                       content_type="multipart/form-data").status_code == 400
+    assert not fake_model.calls
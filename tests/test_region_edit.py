@@ -0,0 +1,59 @@
+"""局部区域编辑：裁剪框保持比例且包含目标区域，结果羽化贴回原图"""
+
+import random
+from io import BytesIO
+
+from PIL import Image
+
+from conftest import png_bytes, sse_events
+
+
+def ratio(aspect_ratio: str) -> float:
+    w, h = aspect_ratio.split(":")
+    return int(w) / int(h)
+
+
+def test_crop_box_contains_region_and_stays_in_image(app):
+    rng = random.Random(7)
+    for _ in range(500):
+        size = (rng.randint(64, 4000), rng.randint(64, 4000))
+        x0, y0 = rng.randrange(size[0] - 1), rng.randrange(size[1] - 1)
+        bbox = (x0, y0, rng.randint(x0 + 1, size[0]), rng.randint(y0 + 1, size[1]))
+        aspect_ratio = rng.choice(sorted(app.VALID_ASPECT_RATIOS))
+        left, top, right, bottom = app.expand_crop_box(bbox, size, rng.randint(0, 200), aspect_ratio)
+        assert 0 <= left <= bbox[0] and 0 <= top <= bbox[1]
+        assert bbox[2] <= right <= size[0] and bbox[3] <= bottom <= size[1]
+
+
+def test_crop_box_keeps_aspect_after_clamping(app):
+    # 靠近左上角的小区域：平移后仍应保持 1:1，而不是被截断成任意比例
+    box = app.expand_crop_box((10, 10, 60, 60), (1000, 500), 40, "1:1")
+    assert box[0] == 0 and box[1] == 0
+    assert abs((box[2] - box[0]) - (box[3] - box[1])) <= 1
+    # 宽幅比例在矮图中放不下时，宽度收回到与高度匹配的比例
+    left, top, right, bottom = app.expand_crop_box((400, 50, 500, 250), (1000, 300), 50, "21:9")
+    assert (top, bottom) == (0, 300)
+    assert abs((right - left) / (bottom - top) - ratio("21:9")) < 0.02
+    assert left <= 400 and right >= 500
+
+
+def test_region_edit_composites_crop(app, client, fake_model):
+    upload = client.post(
+        "/api/upload", data={"file": (BytesIO(png_bytes((800, 400), (0, 0, 255))), "src.png")},
+        content_type="multipart/form-data"
+    ).get_json()
+    region = {"x": 0.05, "y": 0.1, "width": 0.1, "height": 0.2}
+    events = sse_events(client.post("/api/edit-image", json={
+        "prompt": "改成红色", "files": [{"filename": upload["filename"]}], "region": region
+    }))
+    image = next(e for e in events if e["type"] == "image")
+
+    contents, config = fake_model.calls[0]
+    with Image.open(BytesIO(contents[0].inline_data.data)) as crop:
+        assert max(crop.size) < 800
+        assert abs(crop.width / crop.height - ratio(config.image_config.aspect_ratio)) < 0.05
+
+    with Image.open(app.resolve_asset(app.GENERATED_DIR, image["filename"])) as result:
+        assert result.size == (800, 400)
+        assert result.getpixel((80, 80))[:3] == (200, 30, 30)  # 区域中心被替换
+        assert result.getpixel((700, 350))[:3] == (0, 0, 255)  # 裁剪框外保持原样
@@ -0,0 +1,68 @@
+"""派生版本：预设校验、裁剪缩放和像素上限、生成后按原图所属用户写入索引"""
+
+import json
+import time
+
+import pytest
+from PIL import Image
+
+from conftest import png_bytes, sse_events
+from rendition_worker import RENDITION_MAX_PIXELS, render_rendition
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.png"
+    path.write_bytes(png_bytes((400, 200)))
+    return path
+
+
+def test_parse_preset_validation(app):
+    preset = app.parse_rendition_preset("web", {"format": "jpg", "max_edge": 1024})
+    assert preset["format"] == "JPEG" and preset["max_edge"] == 1024
+    for name, bad in [("thumb", {}), ("web", {"format": "gif"}), ("web", {"width": 20000}), ("web", {"scale": 20})]:
+        with pytest.raises(ValueError):
+            app.parse_rendition_preset(name, bad)
+
+
+def test_aspect_crop_and_max_edge(app, source, tmp_path):
+    preset = app.parse_rendition_preset("square", {"format": "webp", "aspect": "1:1", "max_edge": 100})
+    result = render_rendition(str(source), str(tmp_path / "out.webp"), preset, {})
+    assert (result["width"], result["height"]) == (100, 100)
+
+
+def test_output_pixels_capped(app, source, tmp_path):
+    preset = app.parse_rendition_preset("print", {"format": "png", "scale": 8, "width": 16384, "height": 16384})
+    result = render_rendition(str(source), str(tmp_path / "out.png"), preset, {})
+    assert result["width"] * result["height"] <= RENDITION_MAX_PIXELS * 1.01
+    assert abs(result["width"] - 2 * result["height"]) <= 1
+
+
+def test_metadata_written_as_unicode(app, source, tmp_path):
+    preset = app.parse_rendition_preset("web", {"format": "jpeg", "metadata": {"artist": "测试"}})
+    target = tmp_path / "out.jpg"
+    render_rendition(str(source), str(target), preset, {"prompt": "猫咪海报"})
+    with Image.open(target) as img:
+        comment = img.getexif().get_ifd(0x8769)[0x9286]
+    fields = json.loads(comment[len(b"UNICODE\0"):].decode("utf-16-le"))
+    assert fields == {"prompt": "猫咪海报", "artist": "测试"}
+
+
+def test_generated_renditions_indexed_under_owner(app, client, fake_model, monkeypatch):
+    presets = {"web": app.parse_rendition_preset("web", {"format": "webp", "max_edge": 64})}
+    monkeypatch.setattr(app, "RENDITION_PRESETS", presets)
+    headers = {"X-User": "carol"}
+    events = sse_events(client.post("/api/generate", json={"prompt": "x"}, headers=headers))
+    done = next(e for e in events if e["type"] == "done")
+    image = next(e for e in events if e["type"] == "image")
+    assert [r["preset"] for r in done["renditions"]] == ["web"]
+
+    for _ in range(200):
+        status = client.get(f"/api/renditions/{image['filename']}", headers=headers).get_json()
+        if status["renditions"][0]["status"] != "queued":
+            break
+        time.sleep(0.05)
+    assert status["renditions"][0]["status"] == "done"
+    meta = app.get_asset_meta(done["renditions"][0]["filename"])
+    assert meta["user"] == "carol" and meta["kind"] == "rendition"
+    assert client.get(f"/api/renditions/{image['filename']}", headers={"X-User": "dave"}).status_code == 404
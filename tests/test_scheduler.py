@@ -0,0 +1,67 @@
+"""生成调度：加权公平排队、保留名额、不限并发和 interactive 优先级的认定"""
+
+from conftest import sse_events
+
+
+def test_unlimited_capacity_admits_every_priority(app):
+    scheduler = app.GenerationScheduler(0, 1, app.SCHEDULER_WEIGHTS)
+    tickets = [scheduler.enqueue(priority) for priority in ("background", "bulk", "interactive", "background")]
+    assert all(ticket["granted"] for ticket in tickets)
+
+
+def test_reserved_slot_only_for_interactive(app):
+    scheduler = app.GenerationScheduler(2, 1, app.SCHEDULER_WEIGHTS)
+    first = scheduler.enqueue("background")
+    second = scheduler.enqueue("background")
+    assert first["granted"] and not second["granted"]
+    interactive = scheduler.enqueue("interactive")
+    assert interactive["granted"]
+
+    scheduler.finish(first)
+    assert second["granted"]
+
+
+def test_weighted_fair_order(app):
+    scheduler = app.GenerationScheduler(1, 0, {"interactive": 8.0, "background": 3.0, "bulk": 1.0})
+    running = scheduler.enqueue("bulk")
+    waiting = [scheduler.enqueue("bulk") for _ in range(3)] + [scheduler.enqueue("background")]
+    order = []
+    scheduler.finish(running)
+    while any(not t["granted"] for t in waiting):
+        granted = next(t for t in waiting if t["granted"] and t not in order)
+        order.append(granted)
+        scheduler.finish(granted)
+    # 后到的 background 请求不用等前面所有 bulk 请求都完成
+    assert order.index(waiting[-1]) < 3
+
+
+def test_queue_info_reports_position(app):
+    scheduler = app.GenerationScheduler(1, 0, app.SCHEDULER_WEIGHTS)
+    scheduler.enqueue("background")
+    queued = scheduler.enqueue("background")
+    info = scheduler.queue_info(queued)
+    assert info["queue_position"] == 1
+    assert info["estimated_wait"] > 0
+
+
+def test_interactive_priority_requires_web_ui(app):
+    with app.app.test_request_context("/api/generate", headers={"X-Priority": "interactive"}):
+        assert app.request_priority({}) == "background"
+    with app.app.test_request_context("/api/generate", headers={"X-Priority": "interactive", "Sec-Fetch-Site": "same-origin"}):
+        assert app.request_priority({}) == "interactive"
+    with app.app.test_request_context("/api/generate"):
+        assert app.request_priority({"priority": "bulk"}) == "bulk"
+
+
+def test_interactive_allow_list(app, monkeypatch):
+    monkeypatch.setattr(app, "SCHEDULER_INTERACTIVE_USERS", {"robot"})
+    with app.app.test_request_context("/api/generate", headers={"X-Priority": "interactive", "X-User": "robot"}):
+        assert app.request_priority({}) == "interactive"
+
+
+def test_stream_has_single_start_event(client, fake_model):
+    events = sse_events(client.post("/api/generate", json={"prompt": "cat"}))
+    types = [e["type"] for e in events]
+    assert types.count("start") == 1
+    assert events[0]["type"] == "start" and events[0]["queue_position"] == 0
+    assert types[-1] == "done"
@@ -0,0 +1,56 @@
+"""全文搜索：中文按二元组切分、英文按单词前缀匹配，结果按用户隔离并带高亮片段"""
+
+import pytest
+
+
+def test_tokenizer_splits_cjk_bigrams(app):
+    assert app.search_tokens("生成一张logo设计图，4K海报") == "生成 成一 一张 张 logo 设计 计图 图 4k 海报 报"
+    assert app.search_tokens("猫") == "猫"
+    assert app.search_tokens("snake_case和カタカナ") == "snake case 和カ カタ タカ カナ ナ"
+
+
+def test_query_uses_phrases_and_prefixes(app):
+    match, terms = app.build_search_query("设计图 Logo")
+    assert match == '"设计 计图" AND "logo" *'
+    assert terms == ["设计图", "logo"]
+
+
+@pytest.fixture
+def conversation(client, request):
+    headers = {"X-User": f"search-{request.node.name}"}  # 每个测试使用独立的用户
+    conv_id = client.post("/api/conversations", json={}, headers=headers).get_json()["id"]
+    client.put(f"/api/conversations/{conv_id}", json={"title": "品牌物料"}, headers=headers)
+    client.post(f"/api/conversations/{conv_id}/messages", headers=headers, json={"messages": [
+        {"role": "user", "text": "帮我做一张咖啡店的logo设计图"},
+        {"role": "assistant", "text": "这是一个极简风格的 Logotype 方案", "thinking": "考虑咖啡豆元素"},
+    ]})
+    return conv_id, headers
+
+
+def search(client, headers, **params):
+    response = client.get("/api/search", query_string=params, headers=headers)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_search_matches_contiguous_text(client, conversation):
+    conv_id, headers = conversation
+    body = search(client, headers, q="设计图")
+    assert body["total"] == 1
+    item = body["items"][0]
+    assert item["conversation_id"] == conv_id and item["field"] == "prompt"
+    start, end = item["highlights"][0]
+    assert item["snippet"][start:end] == "设计图"
+    assert search(client, headers, q="图设")["total"] == 0
+
+
+def test_search_prefix_and_field_filter(client, conversation):
+    _, headers = conversation
+    assert {i["field"] for i in search(client, headers, q="logo")["items"]} == {"prompt", "text"}
+    assert [i["field"] for i in search(client, headers, q="咖啡", field="thinking")["items"]] == ["thinking"]
+    assert search(client, headers, q="品牌")["items"][0]["field"] == "title"
+
+
+def test_search_isolated_per_user(client, conversation):
+    assert search(client, {"X-User": "someone-else"}, q="设计图")["total"] == 0
+    assert client.get("/api/search").status_code == 400
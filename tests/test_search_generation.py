@@ -0,0 +1,42 @@
+"""搜索增强生成：与标准生成共用流式输出，附带搜索来源"""
+
+from google.genai import types
+
+from conftest import sse_events
+
+
+def test_search_generation_streams_with_grounding(app, client, fake_model):
+    fake_model.grounding = types.GroundingMetadata(
+        web_search_queries=["猫咪 海报"],
+        grounding_chunks=[types.GroundingChunk(web=types.GroundingChunkWeb(title="Cats", uri="https://example.com/cats"))]
+    )
+    events = sse_events(client.post("/api/generate-with-search", json={"prompt": "猫咪海报"}))
+    kinds = [e["type"] for e in events]
+    assert kinds.count("start") == 1
+    assert ["thinking", "text", "grounding", "image", "done"] == [k for k in kinds if k in ("thinking", "text", "grounding", "image", "done")]
+
+    done = events[-1]
+    assert done["message"] == "搜索增强生成完成!"
+    assert done["grounding"]["search_queries"] == ["猫咪 海报"]
+    assert done["grounding"]["sources"] == [{"title": "Cats", "uri": "https://example.com/cats"}]
+    config = fake_model.calls[0][1]
+    assert config.tools[0].google_search is not None
+
+    image = next(e for e in events if e["type"] == "image")
+    meta = app.get_asset_meta(image["filename"])
+    assert meta["mode"] == "search" and meta["prompt"] == "猫咪海报"
+
+
+def test_search_generation_without_sources(client, fake_model):
+    events = sse_events(client.post("/api/generate-with-search", json={"prompt": "x"}))
+    assert "grounding" not in [e["type"] for e in events]
+    assert events[-1]["grounding"] == {"sources": [], "search_queries": []}
+
+
+def test_interrupted_generation_reports_reason(client, fake_model, monkeypatch):
+    def blocked(model, contents, config):
+        yield types.GenerateContentResponse(candidates=[types.Candidate(finish_reason=types.FinishReason.SAFETY)])
+    monkeypatch.setattr(fake_model, "generate_content_stream", blocked)
+    events = sse_events(client.post("/api/generate-with-search", json={"prompt": "x"}))
+    assert events[-1]["type"] == "error"
+    assert "SAFETY" in events[-1]["message"]
@@ -0,0 +1,32 @@
+"""分片存储：文件路径由文件 ID 计算，旧版平铺文件在迁移前仍可解析"""
+
+from conftest import png_bytes
+
+
+def test_variants_share_shard_dir(app):
+    original = app.asset_path(app.UPLOADS_DIR, "abc123.png")
+    variant = app.asset_path(app.UPLOADS_DIR, "abc123.model.jpg")
+    assert original.parent == variant.parent
+    assert len(original.parent.relative_to(app.UPLOADS_DIR).parts) == 2
+
+
+def test_resolve_rejects_hidden_and_missing(app):
+    assert app.resolve_asset(app.UPLOADS_DIR, "") is None
+    assert app.resolve_asset(app.UPLOADS_DIR, "../layout.json") is None
+    assert app.resolve_asset(app.UPLOADS_DIR, ".hidden") is None
+    assert app.resolve_asset(app.UPLOADS_DIR, "missing.png") is None
+
+
+def test_legacy_flat_file_resolved_then_migrated(app, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "_legacy_layout", True)
+    monkeypatch.setattr(app, "LAYOUT_FILE", tmp_path / "layout.json")
+    legacy = app.UPLOADS_DIR / "legacy-flat.png"
+    legacy.write_bytes(png_bytes())
+    assert app.resolve_asset(app.UPLOADS_DIR, "/uploads/legacy-flat.png") == legacy
+    assert client.get("/uploads/legacy-flat.png").status_code == 200
+
+    assert app.migrate_flat_assets() >= 1
+    assert not legacy.exists()
+    assert app.resolve_asset(app.UPLOADS_DIR, "legacy-flat.png") == app.asset_path(app.UPLOADS_DIR, "legacy-flat.png")
+    assert app._legacy_layout is False
+    assert "sharded" in (tmp_path / "layout.json").read_text()
@@ -0,0 +1,83 @@
+"""感知哈希相似检索：近似重复分组与两两比较结果一致，上传后后台补算哈希"""
+
+import random
+import time
+from array import array
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+
+def make_index(app, hashes):
+    index = app.PerceptualIndex()
+    index._filenames = [f"img-{i}.png" for i in range(len(hashes))]
+    index._hashes = array("Q", hashes)
+    index._positions = {name: i for i, name in enumerate(index._filenames)}
+    index._loaded = True
+    return index
+
+
+def brute_force_groups(app, names, hashes, max_distance):
+    parent = list(range(len(names)))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            if app.hamming_distance(hashes[i], hashes[j]) <= max_distance:
+                parent[find(i)] = find(j)
+    groups = {}
+    for i, name in enumerate(names):
+        groups.setdefault(find(i), []).append(name)
+    return sorted(sorted(g) for g in groups.values() if len(g) > 1)
+
+
+def test_duplicate_groups_match_brute_force(app):
+    rng = random.Random(3)
+    hashes = []
+    for _ in range(40):
+        base = rng.getrandbits(64)
+        hashes.append(base)
+        for _ in range(rng.randint(0, 3)):
+            value = base
+            for bit in rng.sample(range(64), rng.randint(0, 8)):
+                value ^= 1 << bit
+            hashes.append(value)
+    index = make_index(app, hashes)
+    for max_distance in (0, 2, 5, 8):
+        expected = brute_force_groups(app, index._filenames, hashes, max_distance)
+        assert sorted(index.duplicate_groups(max_distance)) == expected
+
+
+def test_index_add_remove_and_search(app):
+    index = make_index(app, [0, 0b111, (1 << 64) - 1])
+    index.add("img-3.png", 0b1)
+    index.remove(["img-0.png"])
+    assert index.get("img-0.png") is None
+    assert index.search(0, 3, 10) == [("img-3.png", 1), ("img-1.png", 3)]
+
+
+def test_similar_found_after_async_hash(app, client):
+    def pattern(shift):
+        img = Image.new("RGB", (256, 256), "white")
+        ImageDraw.Draw(img).rectangle((40 + shift, 40, 160 + shift, 200), fill="black")
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    headers = {"X-User": "similar"}
+    names = [client.post(
+        "/api/upload", data={"file": (BytesIO(pattern(shift)), "p.png")}, headers=headers,
+        content_type="multipart/form-data"
+    ).get_json()["filename"] for shift in (0, 2)]
+    for _ in range(100):
+        if all(app.get_asset_meta(n)["phash"] for n in names):
+            break
+        time.sleep(0.02)
+
+    body = client.get(f"/api/assets/{names[0]}/similar", headers=headers).get_json()
+    assert [item["filename"] for item in body["items"]] == [names[1]]
+    assert client.get(f"/api/assets/{names[0]}/similar", headers={"X-User": "other"}).status_code == 404
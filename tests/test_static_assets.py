@@ -0,0 +1,46 @@
+"""带哈希的静态文件、预压缩版本和 JSON 响应压缩"""
+
+import gzip
+
+import pytest
+
+
+@pytest.fixture
+def dist(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STATIC_DIST_DIR", tmp_path)
+    monkeypatch.setattr(app, "STATIC_MANIFEST_FILE", tmp_path / "manifest.json")
+    monkeypatch.setattr(app, "_static_manifest", {})
+    return app.build_static_assets()
+
+
+def test_page_uses_hashed_bundle(app, client, dist):
+    assert not app.app.debug
+    html = client.get("/").get_data(as_text=True)
+    assert f"/assets/{dist['js/main.js']}" in html
+    assert "/static/js/main.js" not in html
+
+
+def test_hashed_asset_served_precompressed(client, dist):
+    response = client.get(f"/assets/{dist['js/main.js']}", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert b"function" in gzip.decompress(response.get_data())
+
+
+def test_debug_mode_uses_unhashed_files(app, dist, monkeypatch):
+    monkeypatch.setattr(app.app, "debug", True)
+    with app.app.test_request_context():
+        assert app.asset_url("js/main.js") == "/static/js/main.js"
+
+
+def test_debug_mode_is_opt_in(app):
+    assert app.DEBUG_MODE is False
+
+
+def test_json_response_compressed(app, client, monkeypatch):
+    monkeypatch.setattr(app, "RESPONSE_COMPRESS_MIN_BYTES", 0)
+    response = client.get("/api/conversations", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    body = gzip.decompress(response.get_data())
+    assert body[:1] in (b"[", b"{")
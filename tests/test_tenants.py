@@ -0,0 +1,92 @@
+"""多用户隔离：令牌认证、对话和文件的归属检查"""
+
+from io import BytesIO
+
+from conftest import png_bytes, sse_events
+
+
+def upload(client, headers, name="ref.png"):
+    response = client.post(
+        "/api/upload", data={"file": (BytesIO(png_bytes()), name)}, headers=headers,
+        content_type="multipart/form-data"
+    )
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()["filename"]
+
+
+def test_invalid_token_rejected(client, tokens):
+    assert client.get("/api/conversations", headers={"Authorization": "Bearer nope"}).status_code == 401
+
+
+def test_uploaded_file_hidden_from_other_tenant(client, tokens):
+    filename = upload(client, tokens["alice"])
+    assert client.get(f"/uploads/{filename}", headers=tokens["alice"]).status_code == 200
+    assert client.get(f"/uploads/{filename}", headers=tokens["bob"]).status_code == 404
+    assert client.get(f"/thumbnails/{filename}", headers=tokens["bob"]).status_code == 404
+    assert client.get(f"/api/assets/{filename}", headers=tokens["bob"]).status_code == 404
+
+
+def test_generation_rejects_other_tenant_inputs(client, tokens, fake_model):
+    filename = upload(client, tokens["alice"])
+    response = client.post(
+        "/api/generate", json={"prompt": "x", "files": [{"filename": filename}]}, headers=tokens["bob"]
+    )
+    assert response.status_code == 404
+    assert not fake_model.calls
+
+
+def test_generated_image_owned_by_caller(client, tokens, fake_model):
+    events = sse_events(client.post("/api/generate", json={"prompt": "x"}, headers=tokens["alice"]))
+    image = next(e for e in events if e["type"] == "image")
+    assert client.get(image["path"], headers=tokens["alice"]).status_code == 200
+    assert client.get(image["path"], headers=tokens["bob"]).status_code == 404
+
+
+def test_conversations_isolated(client, tokens):
+    conv_id = client.post("/api/conversations", json={}, headers=tokens["alice"]).get_json()["id"]
+    assert client.get(f"/api/conversations/{conv_id}", headers=tokens["alice"]).status_code == 200
+    assert client.get(f"/api/conversations/{conv_id}", headers=tokens["bob"]).status_code == 404
+    listed = client.get("/api/conversations", headers=tokens["bob"]).get_json()
+    assert conv_id not in [c["id"] for c in listed]
+
+
+def test_unindexed_file_only_visible_to_default_user(app, client):
+    filepath = app.asset_path(app.UPLOADS_DIR, "legacy-file.png", create=True)
+    filepath.write_bytes(png_bytes())
+    assert client.get("/uploads/legacy-file.png").status_code == 200
+    assert client.get("/uploads/legacy-file.png", headers={"X-User": "mallory"}).status_code == 404
+
+
+def test_admin_requires_token(app, tokens, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_USERS", {"alice"})
+    assert app.is_admin("alice")
+    assert not app.is_admin("bob")
+    monkeypatch.setattr(app, "USER_TOKENS", {})
+    assert not app.is_admin("alice")
+    assert not app.is_admin(app.DEFAULT_USER)
+
+
+def test_storage_quota_blocks_new_files(app, client, tokens, fake_model, monkeypatch):
+    upload(client, tokens["alice"])
+    monkeypatch.setattr(app, "TENANT_STORAGE_QUOTA_BYTES", 1)
+    response = client.post(
+        "/api/upload", data={"file": (BytesIO(png_bytes()), "more.png")}, headers=tokens["alice"],
+        content_type="multipart/form-data"
+    )
+    assert response.status_code == 507
+    assert client.post("/api/generate", json={"prompt": "x"}, headers=tokens["alice"]).status_code == 507
+    assert not fake_model.calls
+    assert client.get("/api/me", headers=tokens["alice"]).get_json()["storage_bytes"] > 1
+
+
+def test_concurrent_generation_limit_per_user(app, monkeypatch):
+    monkeypatch.setattr(app, "TENANT_MAX_CONCURRENT_GENERATIONS", 1)
+    first = app.with_tenant_slot("alice", iter(["data: running\n\n"]))
+    assert next(first) == "data: running\n\n"
+    assert app.active_generation_count("alice") == 1
+    assert '"error"' in next(app.with_tenant_slot("alice", iter(["data: second\n\n"])))
+    other = app.with_tenant_slot("bob", iter(["data: other\n\n"]))
+    assert next(other) == "data: other\n\n"
+    first.close()
+    other.close()
+    assert app.active_generation_count("alice") == 0
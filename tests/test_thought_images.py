@@ -0,0 +1,45 @@
+"""思考图片保留策略：full / preview 落盘，ephemeral 只随流内联发送，drop 丢弃"""
+
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+from conftest import sse_events
+
+
+def generate(client, policy):
+    events = sse_events(client.post("/api/generate", json={"prompt": "x", "thought_images": policy}))
+    thoughts = [e for e in events if e["type"] == "thinking_image"]
+    return thoughts, next(e for e in events if e["type"] == "done")
+
+
+def test_full_and_preview_saved(client, fake_model):
+    thoughts, done = generate(client, "full")
+    assert thoughts[0]["filename"].endswith(".png")
+    assert done["thinking_images"] == [{"filename": thoughts[0]["filename"], "path": thoughts[0]["path"]}]
+    thoughts, _ = generate(client, "preview")
+    assert thoughts[0]["filename"].endswith(".jpg")
+
+
+def test_drop_discards(client, fake_model):
+    thoughts, done = generate(client, "drop")
+    assert thoughts == [] and done["thinking_images"] == []
+
+
+def test_ephemeral_always_inline(app, client, fake_model, monkeypatch):
+    thoughts, done = generate(client, "ephemeral")
+    assert thoughts[0]["ephemeral"] and thoughts[0]["base64"] and "filename" not in thoughts[0]
+    assert done["thinking_images"] == []
+
+    # 超过内联上限时发送低分辨率 JPEG 预览，而不是丢掉图片
+    monkeypatch.setattr(app, "SSE_INLINE_IMAGE_MAX", 10)
+    thoughts, _ = generate(client, "ephemeral")
+    assert thoughts[0]["mime"] == "image/jpeg"
+    with Image.open(BytesIO(base64.b64decode(thoughts[0]["base64"]))) as img:
+        assert img.format == "JPEG"
+
+
+def test_invalid_policy_falls_back(app):
+    assert app.resolve_thought_policy({"thought_images": "bogus"}) == "full"
+    assert app.resolve_thought_policy({}) == app.THOUGHT_IMAGE_POLICY
@@ -0,0 +1,23 @@
+"""消息列表中的附件和思考图片使用缩略图：按最长边缩小，首次请求时生成并缓存"""
+
+from io import BytesIO
+
+from PIL import Image
+
+from conftest import sse_events
+
+
+def test_message_images_served_as_thumbnails(app, client, fake_model):
+    fake_model.out_size = (1024, 512)
+    events = sse_events(client.post("/api/generate", json={"prompt": "x"}))
+    image = next(e for e in events if e["type"] == "image")
+    thought = next(e for e in events if e["type"] == "thinking_image")
+
+    response = client.get(f"/thumbnails/{image['filename']}")
+    assert response.status_code == 200
+    with Image.open(BytesIO(response.get_data())) as thumb:
+        assert thumb.size == (app.THUMBNAIL_EDGE, app.THUMBNAIL_EDGE // 2)
+
+    # 思考图片异步落盘，缩略图请求会等待写入完成
+    assert client.get(f"/thumbnails/{thought['filename']}").status_code == 200
+    assert client.get("/thumbnails/missing.png").status_code == 404
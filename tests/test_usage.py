@@ -0,0 +1,54 @@
+"""用量记录：每次调用按 usage_metadata 记录 token 数和输出信息，按维度汇总，超出每日预算时拒绝"""
+
+import pytest
+
+from conftest import sse_events
+
+
+@pytest.fixture
+def user(request):
+    return {"X-User": f"usage-{request.node.name}"}
+
+
+def usage_by(client, headers, group):
+    return client.get("/api/usage", query_string={"group": group}, headers=headers).get_json()["items"]
+
+
+def test_generation_recorded(app, client, fake_model, user, monkeypatch):
+    monkeypatch.setattr(app, "USAGE_PRICE_INPUT_PER_M", 2.0)
+    monkeypatch.setattr(app, "USAGE_PRICE_OUTPUT_PER_M", 120.0)
+    sse_events(client.post("/api/generate", json={"prompt": "x", "image_size": "2K"}, headers=user))
+    sse_events(client.post("/api/generate-with-search", json={"prompt": "x"}, headers=user))
+
+    modes = {item["key"]: item for item in usage_by(client, user, "mode")}
+    assert set(modes) == {"standard", "search"}
+    standard = modes["standard"]
+    assert (standard["calls"], standard["succeeded"]) == (1, 1)
+    assert (standard["prompt_tokens"], standard["candidate_tokens"], standard["thought_tokens"]) == (100, 1200, 50)
+    assert standard["output_bytes"] > 0
+    assert standard["cost_usd"] == round((100 * 2.0 + 1250 * 120.0) / 1_000_000, 4)
+    assert {item["key"] for item in usage_by(client, user, "image_size")} == {"1K", "2K"}
+
+
+def test_failed_generation_recorded_as_error(client, fake_model, user, monkeypatch):
+    monkeypatch.setattr(fake_model, "parts", lambda: [])
+    events = sse_events(client.post("/api/generate", json={"prompt": "x"}, headers=user))
+    assert events[-1]["type"] == "error"
+    day = usage_by(client, user, "day")[0]
+    assert (day["calls"], day["succeeded"]) == (1, 0)
+
+
+def test_daily_budget_enforced(app, client, fake_model, user, monkeypatch):
+    monkeypatch.setattr(app, "USAGE_USER_BUDGETS", {user["X-User"]: 1000})
+    sse_events(client.post("/api/generate", json={"prompt": "x"}, headers=user))
+    budget = client.get("/api/usage/budget", headers=user).get_json()
+    assert (budget["used_tokens"], budget["budget_tokens"], budget["remaining_tokens"]) == (1350, 1000, 0)
+    assert client.post("/api/generate", json={"prompt": "x"}, headers=user).status_code == 429
+    assert len(fake_model.calls) == 1
+
+
+def test_usage_scoped_to_caller(client, fake_model, user):
+    sse_events(client.post("/api/generate", json={"prompt": "x"}, headers=user))
+    items = client.get("/api/usage", query_string={"group": "user", "user": "someone"}, headers=user).get_json()["items"]
+    assert [item["key"] for item in items] == [user["X-User"]]
+    assert client.get("/api/usage", query_string={"group": "bogus"}, headers=user).status_code == 400